@@ -0,0 +1,286 @@
+"""
+Micro-benchmarks of the performance critical parts of the pipeline. They run
+on synthetic volumes, so no patient data is needed:
+
+    python benchmarks.py
+"""
+import time
+from multiprocessing import cpu_count
+
+import numpy as np
+import skimage.morphology
+
+import forest
+import graph
+import morphology
+import mrf_solver
+from volume import PatientVolume
+
+def synthetic_patient(dim=(240, 240, 155), brain_radius=70, tumor_radius=20,
+                      seed=0):
+    """
+    Return coordinates and labels of a spherical brain with a spherical
+    tumor, mimicking the output of dp.load_patient.
+    """
+    rng = np.random.RandomState(seed)
+    X, Y, Z = np.mgrid[0:dim[0], 0:dim[1], 0:dim[2]]
+    c = np.asarray(dim) / 2
+    brain = (X-c[0])**2 + (Y-c[1])**2 + (Z-c[2])**2 < brain_radius**2
+    coord = np.c_[X[brain], Y[brain], Z[brain]].astype(np.int16)
+    tumor_dist = np.sqrt((coord[:,0]-c[0]-brain_radius/3)**2 +
+                         (coord[:,1]-c[1])**2 + (coord[:,2]-c[2])**2)
+    y = np.zeros(len(coord), dtype=np.int8)
+    y[tumor_dist < tumor_radius] = 2
+    y[tumor_dist < 0.7*tumor_radius] = 1
+    y[tumor_dist < 0.5*tumor_radius] = 3
+    y[tumor_dist < 0.3*tumor_radius] = 4
+    # Noisy prediction
+    pred = np.array(y)
+    flip = rng.rand(len(y)) < 0.02
+    pred[flip] = rng.randint(0, 5, flip.sum())
+    return coord, np.asarray(dim), y, pred
+
+def bench_patient_volume(n_repeats=3):
+    coord, dim, y, pred = synthetic_patient()
+    print "Scatter/gather of %d voxels in a %dx%dx%d volume" % \
+            (coord.shape[0], dim[0], dim[1], dim[2])
+
+    t0 = time.time()
+    D = np.ones((dim[0], dim[1], dim[2]), dtype=int) * -1
+    for i in range(coord.shape[0]):
+        D[coord[i,0], coord[i,1], coord[i,2]] = pred[i]
+    new_pred = []
+    for i in range(coord.shape[0]):
+        new_pred.append(D[coord[i,0], coord[i,1], coord[i,2]])
+    new_pred = np.array(new_pred, dtype=int)
+    t_loop = time.time() - t0
+
+    t0 = time.time()
+    vi = PatientVolume(coord, dim)
+    t_index = time.time() - t0
+    t0 = time.time()
+    for i in range(n_repeats):
+        D2 = vi.scatter(pred, reuse=True)
+        new_pred2 = vi.gather(D2, dtype=int)
+    t_vec = (time.time() - t0) / n_repeats
+
+    assert np.array_equal(D, D2), "Volumes differ"
+    assert np.array_equal(new_pred, new_pred2), "Gathered values differ"
+    print "  Python loops:   %.3f seconds" % t_loop
+    print "  PatientVolume:  %.3f seconds (+ %.3f seconds for the index)" % \
+            (t_vec, t_index)
+    print "  Speedup:        %.1fx" % (t_loop / max(t_vec, 1e-9))
+
+def bench_multi_radii(radii=range(1,11)):
+    coord, dim, y, pred = synthetic_patient()
+    vi = PatientVolume(coord, dim)
+    mask = vi.scatter(pred > 0, dtype=bool, fill=False)
+    print "Binary closing of a %dx%dx%d volume with radii %s" % \
+            (dim[0], dim[1], dim[2], list(radii))
+
+    t0 = time.time()
+    ref = [skimage.morphology.binary_closing(mask, skimage.morphology.ball(r))
+           for r in radii]
+    t_ball = time.time() - t0
+
+    t0 = time.time()
+    box, closed = morphology.binary_closings(mask, radii)
+    t_edt = time.time() - t0
+
+    for i in range(len(radii)):
+        assert np.array_equal(ref[i][box], closed[i]) and \
+                ref[i][box].sum() == ref[i].sum(), "Closings differ"
+    print "  skimage, one radius at a time: %.2f seconds" % t_ball
+    print "  Distance transform engine:     %.2f seconds" % t_edt
+    print "  Speedup:                       %.1fx" % (t_ball / max(t_edt, 1e-9))
+
+def bench_slab_closing(radii=range(1,11), jobs=[1, 2, 4, 8]):
+    coord, dim, y, pred = synthetic_patient()
+    # Noisy second-stage labels cropped to the tumor, as in post_process
+    tumor = y > 0
+    vi = PatientVolume(coord[tumor], dim, margin=max(radii)+1)
+    D = vi.scatter(pred[tumor], dtype=np.int8, fill=-1)
+    mask = D > 0
+    print "Slab-parallel closing of a %dx%dx%d volume" % D.shape
+    print "r\tthreads\tlabels (s)\tbinary (s)"
+    for r in radii:
+        ref_labels = skimage.morphology.closing(
+                D, skimage.morphology.ball(r))
+        ref_box, ref_binary = morphology.binary_closings(mask, [r], jobs=1)
+        for n in jobs:
+            t0 = time.time()
+            closed = morphology.closing(D, r, jobs=n)
+            t_labels = time.time() - t0
+            t0 = time.time()
+            box, binary = morphology.binary_closings(mask, [r], jobs=n)
+            t_binary = time.time() - t0
+            assert np.array_equal(closed, ref_labels), "Closings differ"
+            assert box == ref_box and np.array_equal(binary, ref_binary), \
+                    "Binary closings differ"
+            print "%d\t%d\t%.2f\t\t%.2f" % (r, n, t_labels, t_binary)
+
+def bench_decomposed_closing(radii=range(1,11)):
+    coord, dim, y, pred = synthetic_patient()
+    tumor = y > 0
+    vi = PatientVolume(coord[tumor], dim, margin=max(radii)+1)
+    D = vi.scatter(pred[tumor], dtype=np.int8, fill=-1)
+    print "Closing of a %dx%dx%d label volume, exact and decomposed ball" % \
+            D.shape
+    print "r\tElements\tExact (s)\tDecomposed (s)\tAgreement"
+    for r in radii:
+        t0 = time.time()
+        exact = morphology.closing(D, r, jobs=1, mode='exact')
+        t_exact = time.time() - t0
+        t0 = time.time()
+        decomposed = morphology.closing(D, r, jobs=1, mode='decomposed')
+        t_dec = time.time() - t0
+        print "%d\t%d/%d/%d\t\t%.2f\t\t%.2f\t\t%.4f" % \
+                ((r,) + morphology.ball_decomposition(r) +
+                 (t_exact, t_dec, np.mean(exact == decomposed)))
+
+def bench_forest(n_train=30000, n_test=1000000, n_features=60, n_trees=30,
+                 n_jobs=4):
+    from sklearn.ensemble import RandomForestClassifier
+    rng = np.random.RandomState(0)
+    xtr = rng.randn(n_train, n_features).astype(np.float32)
+    ytr = (xtr[:,0] + xtr[:,1]*xtr[:,2] > 0.5).astype(int) + \
+            (xtr[:,3] > 1) + (xtr[:,4] > 1.5)
+    model = RandomForestClassifier(n_trees, n_jobs=n_jobs, random_state=0)
+    model.fit(xtr, ytr)
+    packed = forest.pack_forest(model)
+    x = rng.randn(n_test, n_features).astype(np.float32)
+    print "Random forest inference, %d trees on %d voxels x %d features" % \
+            (n_trees, n_test, n_features)
+
+    t0 = time.time()
+    ref = model.predict_proba(x)
+    t_sk = time.time() - t0
+
+    t0 = time.time()
+    probs = packed.predict_proba(x, n_jobs=n_jobs)
+    t_packed = time.time() - t0
+
+    max_diff = np.abs(ref - probs).max()
+    assert max_diff < 1e-5, "Probabilities differ by %g" % max_diff
+    print "  sklearn predict_proba: %.2f seconds (%.0f voxels/s)" % \
+            (t_sk, n_test / t_sk)
+    print "  PackedForest:          %.2f seconds (%.0f voxels/s)" % \
+            (t_packed, n_test / t_packed)
+    print "  Speedup:               %.1fx (max difference %.1e)" % \
+            (t_sk / max(t_packed, 1e-9), max_diff)
+
+# Model of the bench_worker_memory workers, inherited when they are forked
+_bench_model = None
+
+def _private_mb():
+    """
+    Memory of this process not shared with others (e.g. with its parent
+    after a fork), in MB.
+    """
+    total = 0
+    with open('/proc/self/smaps') as f:
+        for line in f:
+            if line.startswith('Private_'):
+                total += int(line.split()[1])
+    return total / 1024.0
+
+def _bench_worker_predict(x):
+    before = _private_mb()
+    t0 = time.time()
+    _bench_model.predict_proba(x)
+    return time.time() - t0, _private_mb() - before
+
+def bench_worker_memory(n_train=100000, n_features=60, n_trees=30,
+                        n_workers=4):
+    """
+    Private memory and time of the first prediction of a stored forest in
+    each of n_workers forked workers, with the trees compiled in every worker
+    or once in the parent before the fork (as pipeline.imap_patients does).
+    """
+    import multiprocessing
+    import shutil
+    import tempfile
+    from sklearn.ensemble import RandomForestClassifier
+    import model_store
+    global _bench_model
+    rng = np.random.RandomState(0)
+    xtr = rng.randn(n_train, n_features).astype(np.float32)
+    ytr = (xtr[:,0] + xtr[:,1]*xtr[:,2] > 0.5).astype(int) + \
+            (xtr[:,3] > 1) + (xtr[:,4] > 1.5)
+    model = RandomForestClassifier(n_trees, random_state=0).fit(xtr, ytr)
+    x = rng.randn(1000, n_features).astype(np.float32)
+    store_dir = model_store.store_dir
+    model_store.store_dir = tempfile.mkdtemp()
+    try:
+        lazy = model_store.save('bench', forest.pack_forest(model, n_jobs=1),
+                                {})
+        print "Per-worker memory of a stored forest, %d trees, %d nodes, %d workers" % \
+                (n_trees, len(lazy.load().feature), n_workers)
+        for mode in ['workers', 'parent']:
+            _bench_model = model_store.LazyForest('bench', n_jobs=1)
+            if mode == 'parent':
+                _bench_model.compile()
+            pool = multiprocessing.Pool(n_workers)
+            try:
+                results = pool.map(_bench_worker_predict, [x] * n_workers)
+            finally:
+                pool.terminate()
+                pool.join()
+            seconds = np.mean([t for t, mb in results])
+            private = np.mean([mb for t, mb in results])
+            print "  Compiled in the %-8s first prediction %.3f seconds, %.1f MB private per worker" % \
+                    (mode + ':', seconds, private)
+    finally:
+        _bench_model = None
+        shutil.rmtree(model_store.store_dir)
+        model_store.store_dir = store_dir
+
+def bench_mrf(methods=['qpbo', 'icm'], jobs=4, gap=8):
+    """
+    Solve the MRF of a synthetic tumor cut into separate components by
+    removing every gap-th x plane, with 1 and jobs processes.
+    """
+    from methods import mrf_potentials
+    coord, dim, y, pred = synthetic_patient()
+    mask = (y > 0) & (coord[:,0] % gap != 0)
+    rng = np.random.RandomState(0)
+    # Noisy second-stage probabilities of the tumor voxels
+    probs = rng.dirichlet(np.ones(4), mask.sum()) * 0.6
+    probs[np.arange(mask.sum()), y[mask]-1] += 0.4
+    edges, adj = graph.build_graph(coord[mask])
+    potentials = mrf_potentials()
+    n_comp = mrf_solver.component_batches(adj, 1)[1]
+    print "MRF of %d voxels, %d edges, %d components, %d potentials, %d cores" % \
+            (mask.sum(), len(edges), n_comp, len(potentials), cpu_count())
+    for method in methods:
+        seconds = {}
+        for n in sorted(set([1, jobs])):
+            if n > 1:
+                # Start the pool before timing
+                mrf_solver._batch_pool(n)
+            t0 = time.time()
+            labels = None
+            energies = []
+            for pot in potentials:
+                labels, info = mrf_solver.solve(probs, pot, edges, adj,
+                                                coord[mask], init=labels,
+                                                method=method, jobs=n)
+                energies.append(info['energy'])
+            seconds[n] = time.time() - t0
+            print "  %s, %d processes: %.2f seconds (energy %.2f for the last potential)" % \
+                    (method, n, seconds[n], energies[-1])
+        print "  %s speedup with %d processes: %.1fx" % \
+                (method, jobs, seconds[1] / max(seconds[jobs], 1e-9))
+    mrf_solver.close_pool()
+
+def main():
+    bench_patient_volume()
+    bench_multi_radii()
+    bench_slab_closing()
+    bench_decomposed_closing()
+    bench_forest()
+    bench_worker_memory()
+    bench_mrf()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Quantile-binned features for faster forest training.
+
+A QuantileBinner maps every feature to at most 256 bins at quantiles
+computed once from a sample of the training patients. The bin codes of a
+patient are stored as uint8 next to its features in the feature cache, a
+quarter of the float32 size, and the forests are trained on them: with at
+most 255 thresholds per feature the split search has far fewer candidates.
+
+A split "code <= k" of a tree trained on the codes is the same as
+"x < edges[k]" on the raw feature, so raw_thresholds rewrites the
+thresholds of the trained forest into the raw feature space. The binning
+is thereby applied at inference without transforming the test patients,
+and the models work with forest.py, model_store.py and prob_cache.py as
+they are. The thresholds are rewritten through the pickle state of the
+sklearn trees, so binned training needs a sklearn that passes
+forest.tree_layout_error.
+
+Compare binned and raw training with:
+    python binning.py [n_bins]
+"""
+import hashlib
+import os
+import sys
+import time
+
+import numpy as np
+
+import data_processing as dp
+import feature_cache as fc
+import forest
+import streaming
+
+class QuantileBinner(object):
+    """
+    Per-feature quantile bins. The code of a value is the number of bin
+    edges <= value, so codes are in 0..n_bins-1.
+    """
+    def __init__(self, n_bins=256):
+        assert 2 <= n_bins <= 256, "Codes must fit in uint8"
+        self.n_bins = n_bins
+        self.edges = None
+
+    def fit(self, x):
+        qs = np.linspace(0, 100, self.n_bins + 1)[1:-1]
+        self.edges = [np.unique(np.percentile(x[:,j], qs).astype(np.float32))
+                      for j in range(x.shape[1])]
+        return self
+
+    @property
+    def key(self):
+        """
+        Digest of the bin edges, used to name the binned cache files.
+        """
+        h = hashlib.sha1()
+        for e in self.edges:
+            h.update(e.tostring())
+            h.update('|')
+        return h.hexdigest()[:16]
+
+    def transform(self, x, out=None):
+        if out is None:
+            out = np.empty(x.shape, dtype=np.uint8)
+        for j, e in enumerate(self.edges):
+            out[:,j] = np.searchsorted(e, x[:,j], side='right')
+        return out
+
+    def save(self, fname):
+        np.savez(fname, n_bins=self.n_bins, *self.edges)
+
+    @staticmethod
+    def load(fname):
+        f = np.load(fname)
+        binner = QuantileBinner(int(f['n_bins']))
+        binner.edges = [f['arr_%d' % j] for j in range(len(f.files) - 1)]
+        return binner
+
+def fit_binner(pats, n_bins=256, n_rows=200000, resolution=1,
+               load_hog=False):
+    """
+    Fit the bins on a uniform sample of the voxels of the patients.
+    """
+    t0 = time.time()
+    counts = streaming.label_counts(pats, resolution, load_hog)
+    x = streaming.sample_voxels(pats, counts, n_rows, range(5),
+                                resolution=resolution, load_hog=load_hog)[0]
+    binner = QuantileBinner(n_bins).fit(x)
+    print "Fitting %d bins on %d voxels took %.2f seconds." % \
+            (n_bins, len(x), time.time()-t0)
+    return binner
+
+def binned_fname(number, binner, resolution=1, load_hog=False,
+                 do_preprocess=True):
+    return os.path.join(fc.patient_dir(number, resolution, load_hog,
+                                       do_preprocess),
+                        'xbin_%s.u8' % binner.key)
+
+def open_binned(number, binner, resolution=1, load_hog=False,
+                do_preprocess=True, block_size=1 << 16):
+    """
+    Open the bin codes of a cached patient as an (n_voxels, n_features)
+    uint8 np.memmap, computing them first if needed. The codes are removed
+    together with the patient cache when it is rebuilt.
+    """
+    if fc.is_stale(number, resolution, load_hog, do_preprocess):
+        dp.cache_patient(number, do_preprocess, resolution, load_hog)
+    x, y, coord, meta = fc.open_patient(number, resolution, load_hog,
+                                        do_preprocess)
+    fname = binned_fname(number, binner, resolution, load_hog, do_preprocess)
+    if not os.path.isfile(fname):
+        tmp_fname = fname + '.tmp%d' % os.getpid()
+        xb = np.memmap(tmp_fname, dtype=np.uint8, mode='w+', shape=x.shape)
+        for b0 in range(0, x.shape[0], block_size):
+            binner.transform(x[b0:b0+block_size], out=xb[b0:b0+block_size])
+        xb.flush()
+        del xb
+        os.rename(tmp_fname, fname)
+    return np.memmap(fname, dtype=np.uint8, mode='r', shape=x.shape)
+
+def raw_thresholds(model, binner):
+    """
+    Rewrite in place the thresholds of a forest trained on bin codes so that
+    it can be applied to the raw float32 features. Returns the model.
+    """
+    forest.check_tree_layout('Binned training')
+    n_edges = max(len(e) for e in binner.edges)
+    E = np.empty((len(binner.edges), n_edges), dtype=np.float32)
+    E.fill(np.inf)
+    for j, e in enumerate(binner.edges):
+        E[j,:len(e)] = e
+    # code <= k  <=>  x < edges[k]  <=>  x <= the float32 below edges[k]
+    below = np.nextafter(E, np.float32(-np.inf))
+    for est in model.estimators_:
+        state = est.tree_.__getstate__()
+        nodes = state['nodes']
+        split = nodes['feature'] >= 0
+        k = np.floor(nodes['threshold'][split]).astype(np.intp)
+        nodes['threshold'][split] = below[nodes['feature'][split], k]
+        est.tree_.__setstate__(state)
+    return model
+
+def compare_binned(train_pats, test_pats, n_bins=256, n_trees=30,
+                   n_voxels=30000, resolution=1, load_hog=False):
+    """
+    Train the first-stage forest on raw and on binned features of the same
+    voxels and report the training time, the size of the training matrix
+    and the whole tumor dice of the forest on the test patients.
+    """
+    from sklearn.ensemble import RandomForestClassifier
+    from evaluation import dice
+
+    binner = fit_binner(train_pats, n_bins, resolution=resolution,
+                        load_hog=load_hog)
+    state = np.random.get_state()
+    xtr, ytr = dp.load_patients(train_pats, resolution=resolution,
+                                n_voxels=n_voxels, load_hog=load_hog)[:2]
+    np.random.set_state(state)
+    xtr_bin, ytr_bin = dp.load_patients(train_pats, resolution=resolution,
+                                        n_voxels=n_voxels, load_hog=load_hog,
+                                        binner=binner)[:2]
+    assert np.array_equal(ytr, ytr_bin), "Samples differ"
+    ytr = (np.asarray(ytr) > 0).astype(int)
+
+    results = {}
+    for name, x in [('raw', xtr), ('binned', xtr_bin)]:
+        t0 = time.time()
+        model = RandomForestClassifier(n_trees, n_jobs=16, random_state=0)
+        model.fit(x, ytr)
+        t_fit = time.time() - t0
+        if name == 'binned':
+            raw_thresholds(model, binner)
+        scores = []
+        for pat, (x_te, y_te, coord, dim) in dp.iter_patients(
+                test_pats, n_voxels=None, resolution=resolution,
+                load_hog=load_hog):
+            scores.append(dice(y_te > 0, model.predict(x_te) > 0))
+        results[name] = {'fit_seconds': t_fit, 'nbytes': x.nbytes,
+                         'dice': np.mean(scores)}
+
+    print "\nFirst-stage forest, %d trees on %d voxels, %d bins:" % \
+            (n_trees, len(ytr), n_bins)
+    print "Features\tFit (s)\tMatrix (MB)\tWhole tumor dice"
+    for name in ['raw', 'binned']:
+        r = results[name]
+        print "%s\t\t%.2f\t%.1f\t\t%.4f" % (name, r['fit_seconds'],
+                                            r['nbytes'] / 1e6, r['dice'])
+    return results
+
+def main():
+    n_bins = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    pats = fc.available_patients()
+    np.random.seed(0)
+    pats = list(np.random.permutation(pats))
+    n_train = max(1, int(0.8 * len(pats)))
+    compare_binned(pats[:n_train], pats[n_train:], n_bins)
+
+if __name__ == "__main__":
+    main()
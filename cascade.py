@@ -0,0 +1,136 @@
+"""
+Coarse-to-fine first-stage inference.
+
+The first-stage model is run on a strided subset of the voxels first (every
+stride-th voxel along each axis). Voxels of the subset with a tumor
+probability of at least coarse_threshold are dilated by a ball of the given
+radius and the model is run on the remaining voxels inside this candidate
+region only. Voxels outside the region are treated as background.
+
+The subset is taken from the full resolution features since model1 is
+trained on them; the features of the subsampled .mat files (resolution 2 and
+4) are computed at a different scale and would need a model of their own.
+"""
+import time
+
+import numpy as np
+
+import chunked
+import data_processing as dp
+import morphology
+import prob_cache
+import tuning
+from evaluation import confusion_matrix, region_scores
+from volume import patient_volume
+
+coarse_threshold = 0.3
+# Should be at least the stride so that the gaps of the subset are covered
+dilation = 4
+
+def coarse_idxs(coord, stride):
+    """
+    Indices of the voxels whose coordinates are all multiples of stride.
+    """
+    return np.nonzero(np.all(np.asarray(coord) % stride == 0, axis=1))[0]
+
+def candidate_region(coord, dim, seeds, radius=dilation):
+    """
+    Boolean mask of the voxels within radius of a seed voxel.
+    """
+    vol = patient_volume(coord, dim)
+    D = vol.scatter(seeds, dtype=bool, fill=False)
+    return vol.gather(morphology.binary_dilation(D, radius), dtype=bool)
+
+def _predict_rows(model, x, rows, patient, resolution, load_hog,
+                  block_size=None):
+    if patient is None:
+        if block_size is not None:
+            return chunked.predict_proba(model, x, rows, block_size)
+        return model.predict_proba(x[rows,:])
+    return prob_cache.predict_proba(model, x, patient, rows=rows,
+                                    resolution=resolution, load_hog=load_hog,
+                                    block_size=block_size)
+
+def predict_proba(model1, x, coord, dim, stride=2, threshold=coarse_threshold,
+                  radius=dilation, patient=None, resolution=1,
+                  load_hog=False, block_size=None):
+    """
+    First-stage probabilities with the coarse-to-fine cascade.
+
+    Input:
+        patient -- Patient number for prob_cache, None to not cache.
+        block_size -- Voxels per block of model1 (see chunked.py).
+
+    Output:
+        probs -- (n_voxels, 2) probabilities, background outside the region.
+        region -- Boolean mask of the voxels model1 was run on.
+    """
+    n = x.shape[0]
+    t0 = time.time()
+    is_coarse = np.zeros(n, dtype=bool)
+    is_coarse[coarse_idxs(coord, stride)] = True
+    probs = np.zeros((n, 2), dtype=np.float32)
+    probs[:,0] = 1
+    probs[is_coarse] = _predict_rows(model1, x, is_coarse, patient,
+                                     resolution, load_hog, block_size)
+    seeds = is_coarse & (probs[:,1] >= threshold)
+    region = candidate_region(coord, dim, seeds, radius)
+    fine = region & ~is_coarse
+    if fine.any():
+        probs[fine] = _predict_rows(model1, x, fine, patient, resolution,
+                                    load_hog, block_size)
+    region |= is_coarse
+    print "Cascade evaluated %.1f%% of the voxels in %.2f seconds." % \
+            (100.0 * np.count_nonzero(region) / max(n, 1), time.time()-t0)
+    return probs, region
+
+def compare_cascade(pats, model1, best_th=0.6, best_radius=6, min_voxels=3000,
+                    strides=[2], threshold=coarse_threshold, radius=dilation,
+                    resolution=1, load_hog=False, fscores=None):
+    """
+    Report per patient the speedup of the cascade over running model1 on all
+    voxels and the change in the dice scores of the first stage (threshold
+    and closing) against the ground truth.
+
+    Output:
+        List of dictionaries, one per patient and stride.
+    """
+    results = []
+    for pat, (x, y, coord, dim) in dp.iter_patients(
+            pats, n_voxels=None, resolution=resolution, load_hog=load_hog):
+        t0 = time.time()
+        probs = model1.predict_proba(x)
+        t_full = time.time() - t0
+        y1 = (np.asarray(y) > 0).astype(np.int8)
+
+        def stage1_dice(p):
+            pred = tuning.stage1_prediction(p[:,1], best_th, min_voxels)
+            pp_pred = dp.post_process(coord, dim, pred, binary_closing=True,
+                                      radius=best_radius)
+            cm = confusion_matrix(y1, pp_pred > 0, n_labels=2)
+            return region_scores(cm)['dice'][0]
+
+        d_full = stage1_dice(probs)
+        for stride in strides:
+            t0 = time.time()
+            cprobs, region = predict_proba(model1, x, coord, dim, stride,
+                                           threshold, radius)
+            t_cascade = time.time() - t0
+            d_cascade = stage1_dice(cprobs)
+            results.append({'patient': pat, 'stride': stride,
+                            'evaluated': np.mean(region),
+                            'speedup': t_full / max(t_cascade, 1e-9),
+                            'dice_full': d_full, 'dice_cascade': d_cascade})
+
+    s = "\nCascade (threshold=%.2f, radius=%d) against full inference:\n" % \
+            (threshold, radius)
+    s += "Patient\tStride\tVoxels\tSpeedup\tWhole tumor dice (full, cascade, loss)\n"
+    for r in results:
+        s += "%d\t%d\t%.1f%%\t%.2fx\t%.4f\t%.4f\t%.4f\n" % \
+                (r['patient'], r['stride'], 100*r['evaluated'], r['speedup'],
+                 r['dice_full'], r['dice_cascade'],
+                 r['dice_full'] - r['dice_cascade'])
+    print s
+    if fscores is not None:
+        fscores.write(s)
+    return results
@@ -0,0 +1,81 @@
+"""
+Out-of-core forest inference.
+
+The features of a patient are opened as a memmap of the feature cache (see
+feature_cache.py). Instead of handing all of them to predict_proba at once,
+which copies the whole feature matrix into memory, predict_proba streams
+them through the model in blocks of block_size voxels and writes the
+probabilities to a memmap backed by an anonymous temporary file. The memory
+needed per patient is then bounded by the block size, whatever the size of
+the volume.
+"""
+import tempfile
+
+import numpy as np
+
+# Directory of the temporary files of the output memmaps, None for the
+# system default
+tmp_dir = None
+block_size = 1 << 17
+
+def temp_memmap(shape, dtype=np.float32):
+    """
+    Zero-initialized np.memmap on a temporary file, removed when the memmap
+    is garbage collected.
+    """
+    if np.prod(shape) == 0:
+        # Empty files cannot be mapped
+        return np.zeros(shape, dtype=dtype)
+    with tempfile.TemporaryFile(dir=tmp_dir) as f:
+        # mmap keeps its own descriptor of the (already unlinked) file
+        return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+
+def blocks(n, rows=None, size=None):
+    """
+    Yield (b0, b1, local_rows, o0, o1): the voxels b0:b1, the rows among
+    them (None for all) and their slice o0:o1 of the output rows.
+    """
+    if size is None:
+        size = block_size
+    if rows is not None:
+        rows = np.asarray(rows)
+        if rows.dtype != bool:
+            mask = np.zeros(n, dtype=bool)
+            mask[rows] = True
+            assert np.count_nonzero(mask) == len(rows) and \
+                    np.all(np.diff(rows) > 0), \
+                    "Row indices must be sorted and unique"
+            rows = mask
+    o0 = 0
+    for b0 in range(0, n, size):
+        b1 = min(b0 + size, n)
+        local = None if rows is None else np.nonzero(rows[b0:b1])[0]
+        o1 = o0 + (b1 - b0 if local is None else len(local))
+        if o1 > o0:
+            yield b0, b1, local, o0, o1
+        o0 = o1
+
+def n_rows(n, rows=None):
+    if rows is None:
+        return n
+    rows = np.asarray(rows)
+    return np.count_nonzero(rows) if rows.dtype == bool else len(rows)
+
+def predict_proba(model, x, rows=None, size=None, out=None):
+    """
+    Return model.predict_proba(x[rows]) computed block by block.
+
+    Input:
+        rows -- Boolean mask or sorted indices of the voxels, None for all.
+        size -- Voxels per block, the module setting block_size if None.
+        out -- Output array, a temporary float32 memmap if None.
+    """
+    n = x.shape[0]
+    if out is None:
+        out = temp_memmap((n_rows(n, rows), len(model.classes_)))
+    for b0, b1, local, o0, o1 in blocks(n, rows, size):
+        xb = np.asarray(x[b0:b1])
+        if local is not None:
+            xb = xb[local]
+        out[o0:o1] = model.predict_proba(xb)
+    return out
@@ -0,0 +1,154 @@
+"""
+Cross-validation of the two-stage method with folds running concurrently.
+
+All patients are first converted once into the feature cache (see
+feature_cache.py), which the folds then share read-only through np.memmap, so
+a patient appearing in several folds is parsed only once. Every fold runs in
+its own process with its own random seed and log file, and the per-fold dice
+scores are collected into one JSON results file.
+"""
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+import numpy as np
+
+import data_processing as dp
+import methods
+import profiling
+
+def _run_fold(fold, train_pats, test_pats, fold_seed, fscores_fname,
+              results_fname, kwargs):
+    np.random.seed(fold_seed)
+    # Records of the fold only, collected by run_cv from its profile file
+    earlier = profiling.drain()
+    try:
+        with open(fscores_fname, 'w') as fscores:
+            t0 = time.time()
+            scores = methods.predict_two_stage(
+                    train_pats, test_pats, fscores, model_tag='_fold%d' % fold,
+                    seed=fold_seed, **kwargs)
+        profiling.write_json(_profile_fname(results_fname))
+    finally:
+        profiling.drain()
+        profiling.extend(earlier)
+    result = {'fold': fold,
+              'seed': fold_seed,
+              'train_patients': [int(p) for p in train_pats],
+              'test_patients': [int(p) for p in test_pats],
+              'dice_no_pp': [float(d) for d in scores['dice_no_pp']],
+              'dice': [float(d) for d in scores['dice']],
+              'seconds': time.time() - t0}
+    with open(results_fname, 'w') as f:
+        json.dump(result, f)
+
+def _profile_fname(results_fname):
+    return results_fname.replace('_results.json', '_profile.json')
+
+def run_cv(folds, res_dir, seed, fscores=None, n_fold_workers=1,
+           n_convert_workers=4, **kwargs):
+    """
+    Run methods.predict_two_stage on every fold.
+
+    Input:
+        folds -- List of (train_patients, test_patients) pairs.
+        res_dir -- Directory of the fold logs and of cv_results.json.
+        seed -- Fold i is run with random seed seed+i.
+        fscores -- An opened output file to which the fold logs are appended
+                   in fold order.
+        n_fold_workers -- Number of folds running at the same time.
+        kwargs -- Passed on to methods.predict_two_stage.
+
+    Output:
+        List of per-fold result dictionaries of the completed folds, also
+        written to res_dir/cv_results.json together with the failed folds.
+    """
+    all_pats = set()
+    for train_pats, test_pats in folds:
+        all_pats.update(int(p) for p in train_pats)
+        all_pats.update(int(p) for p in test_pats)
+    print "Converting %d patients to the feature cache..." % len(all_pats)
+    dp.convert_patients(sorted(all_pats),
+                        resolution=kwargs.get('resolution', 1),
+                        load_hog=kwargs.get('load_hog', False),
+                        n_workers=n_convert_workers)
+
+    fscores_fnames = []
+    results_fnames = []
+    tasks = []
+    for fold, (train_pats, test_pats) in enumerate(folds):
+        fscores_fnames.append(os.path.join(res_dir, 'fold%d_scores.txt' % fold))
+        results_fnames.append(os.path.join(res_dir, 'fold%d_results.json' % fold))
+        tasks.append((fold, list(train_pats), list(test_pats), seed + fold,
+                      fscores_fnames[-1], results_fnames[-1], kwargs))
+        # A fold fails if it leaves no results, so drop those of earlier runs
+        if os.path.isfile(results_fnames[-1]):
+            os.remove(results_fnames[-1])
+
+    if n_fold_workers > 1:
+        # Folds are run in non-daemonic processes as they may start process
+        # pools of their own
+        running = []
+        for task in tasks:
+            while len(running) >= n_fold_workers:
+                running = [p for p in running if p.is_alive()]
+                if len(running) >= n_fold_workers:
+                    time.sleep(1)
+            p = multiprocessing.Process(target=_run_fold, args=task)
+            p.start()
+            running.append(p)
+        for p in running:
+            p.join()
+    else:
+        for task in tasks:
+            try:
+                _run_fold(*task)
+            except Exception:
+                # Reported as a failed fold below, like a crashed process
+                error = traceback.format_exc()
+                print "Fold %d raised:\n%s" % (task[0], error)
+                if fscores is not None:
+                    fscores.write("\nFold %d raised:\n%s" % (task[0], error))
+
+    results = []
+    failed = []
+    for fold in range(len(folds)):
+        if not os.path.isfile(results_fnames[fold]):
+            print "Fold %d failed." % fold
+            failed.append(fold)
+            if fscores is not None:
+                fscores.write("\nFold %d failed.\n" % fold)
+            continue
+        with open(results_fnames[fold]) as f:
+            results.append(json.load(f))
+        profiling.extend(profiling.read_json(
+                _profile_fname(results_fnames[fold])))
+        if fscores is not None:
+            with open(fscores_fnames[fold]) as f:
+                fscores.write("\nFold %d:\n" % fold)
+                fscores.write(f.read())
+
+    if len(results) > 0:
+        dice = np.asarray([r['dice'] for r in results])
+        summary = {'folds': results,
+                   'dice_mean': list(np.mean(dice, 0)),
+                   'dice_std': list(np.std(dice, 0))}
+        print "\nCross-validation dice scores (whole, core, active):"
+        for r in results:
+            print "Fold %d:\t%.4f\t%.4f\t%.4f" % tuple([r['fold']] + r['dice'])
+        print "Mean:\t%.4f\t%.4f\t%.4f" % tuple(summary['dice_mean'])
+    else:
+        summary = {'folds': []}
+    # The means are over the completed folds only
+    summary['failed_folds'] = failed
+    if len(failed) > 0:
+        msg = "%d of %d folds failed: %s" % (len(failed), len(folds),
+                                            ', '.join(map(str, failed)))
+        print msg
+        if fscores is not None:
+            fscores.write("\n%s\n" % msg)
+    with open(os.path.join(res_dir, 'cv_results.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return results
@@ -1,12 +1,16 @@
-import skimage.morphology
 import scipy.io
-import time
+import scipy.ndimage
 import numpy as np
 import os
 import sys
-from pystruct.inference import inference_dispatch, compute_energy
+import multiprocessing
 
 from evaluation import dice_scores
+import feature_cache as fc
+from volume import PatientVolume, patient_volume
+import morphology
+import mrf_solver
+import profiling
 
 def preprocess(x):
     # Median to zero
@@ -16,62 +20,37 @@ def preprocess(x):
     return x
 
 def post_process(coord, dim, pred, pred_probs=None, remove_components=True,
-                 binary_closing=False, radius=6):
-    t0 = time.time()
-    # 3D data matrix
-    D = np.ones((dim[0], dim[1], dim[2]), dtype=int) * -1
-    for i in range(coord.shape[0]):
-        D[coord[i,0], coord[i,1], coord[i,2]] = pred[i]
-    
-    neighborhood = skimage.morphology.ball(radius)
+                 binary_closing=False, radius=6, se_mode=None):
+    st = profiling.start('post_process', len(pred))
+    # 3D data matrix cropped to the brain
+    vol = patient_volume(coord, dim, margin=radius+1)
+    D = vol.scatter(pred, dtype=np.int8, fill=-1, reuse=True)
     
     if binary_closing:
-        D2 = D > 0
-        D = skimage.morphology.binary_closing(D2, neighborhood)
+        box, closed = morphology.binary_closings(D > 0, [radius],
+                                                 mode=se_mode)
+        D = vol.empty(dtype=bool, fill=False, reuse=True)
+        if box is not None:
+            D[box] = closed[0]
+            if remove_components:
+                remove_small_components(D[box])
         #D[D3==0] = 0
         #D[np.logical_and(D==0, D3==1)] = 2
     else:
-        D = skimage.morphology.closing(D, neighborhood)
-    
-    if remove_components:
-        remove_small_components(D)
-
-    new_pred = []
-    for i in range(coord.shape[0]):
-        new_pred.append(D[coord[i,0], coord[i,1], coord[i,2]])
-    print "Post-processing took %.2f seconds." % (time.time()-t0)
-    return np.array(new_pred, dtype=int)
-
-def create_graph(coords):
-    n = coords.shape[0]
-    coords = coords.astype(np.int32)
-
-    t0 = time.time()
-    neighs = []
-    for i in range(-1,1):
-        for j in range(-1,1):
-            for k in range(-1,1):
-                if i==0 and j==0 and k==0:
-                    continue
-                neighs.append(np.array([i,j,k],dtype=np.int32))
-    vox_map = {}
-    edges = []
-    for l in range(n):
-        coord = coords[l,:]
-        coord_tup = tuple(coord)
-        assert coord_tup not in vox_map, "Same coordinate appearing twice %s" % str(coord_tup)
-        coord_idx = len(vox_map)
-        vox_map[coord_tup] = coord_idx
-        for neigh in neighs:
-            coord2 = coord + neigh
-            coord2_tup = tuple(coord2)
-            if coord2_tup in vox_map:
-                edges.append((coord_idx, vox_map[coord2_tup]))
-    print "Graph creation took %.2f seconds (%d edges)." % (time.time()-t0, len(edges))
-    edges = np.asarray(edges, dtype=np.int32)
-    return edges
-
-def mrf(probs, edges, potential=None):
+        D = morphology.closing(D, radius, mode=se_mode)
+        if remove_components:
+            remove_small_components(D)
+
+    new_pred = vol.gather(D, dtype=int)
+    print "Post-processing took %.2f seconds." % st.stop()
+    return new_pred
+
+def mrf(probs, edges, potential=None, adj=None, coord=None, init=None,
+        method=None, jobs=None):
+    """
+    Smooth the labels of the voxels of a graph with an MRF, see
+    mrf_solver.solve for the arguments.
+    """
     #probs2 = (-100 * np.log(probs)).astype(np.int32)
     #probs2 = (100 * probs).astype(np.int32)
     #min_prob = 0.001
@@ -82,57 +61,77 @@ def mrf(probs, edges, potential=None):
         n_labels = probs2.shape[1]
         potential = np.eye(n_labels, dtype=np.int32)
     print "%d labels." % probs2.shape[1]
-    t0 = time.time()
-    smoothed_pred = inference_dispatch(probs2, potential, edges,
-                                       inference_method='qpbo')
-    print "MRF took %.2f seconds." % (time.time()-t0)
+    st = profiling.start('mrf', len(probs2))
+    smoothed_pred, info = mrf_solver.solve(probs2, potential, edges, adj=adj,
+                                           coord=coord, init=init,
+                                           method=method, jobs=jobs)
+    print "MRF took %.2f seconds (%d components, largest %d, energy %.2f, slowest batch %.2f s)." % \
+            (st.stop(), info['n_components'], info['largest'],
+             info['energy'], max(info['batch_seconds']))
     return smoothed_pred
 
-def remove_small_components(D, min_component_size=3000):
-    t0 = time.time()
-    C, n_components = scipy.ndimage.measurements.label(D)
-    n_removed = 0
-    max_component_size = -1
-    for i in range(1,n_components+1):
-        component = np.nonzero(C==i)
-        if len(component[0]) > max_component_size:
-            max_component_size = len(component[0])
-    for i in range(1,n_components+1):
-        component = np.nonzero(C==i)
-        if len(component[0]) < min_component_size and \
-           len(component[0]) < max_component_size:
-            D[component] = 0
-            n_removed += 1
-
-    print "Removed %d out of %d components (%.2f seconds)." % (n_removed, n_components, time.time()-t0)
+def remove_small_components(D, min_component_size=3000, keep_largest=1,
+                              connectivity=1):
+    """
+    Set the voxels of small connected components of D to zero in place.
+
+    A component is removed if it has fewer than min_component_size voxels
+    and it is not one of the keep_largest largest components. Connectivity
+    is 1 (faces), 2 (edges) or 3 (corners) as in
+    scipy.ndimage.generate_binary_structure.
+
+    Output:
+        Dictionary with the number of components, the number removed and the
+        sizes of the components.
+    """
+    st = profiling.start('remove_small_components', D.size)
+    structure = scipy.ndimage.generate_binary_structure(3, connectivity)
+    C, n_components = scipy.ndimage.label(D, structure)
+    # Size of every component in one pass, index 0 is the background
+    sizes = np.bincount(C.ravel(), minlength=n_components+1)
+    sizes[0] = 0
+    remove = sizes < min_component_size
+    remove[0] = False
+    if keep_largest > 0 and n_components > 0:
+        # Components tied with the k-th largest one are kept as well
+        kth_size = np.sort(sizes[1:])[::-1][min(keep_largest, n_components)-1]
+        remove[sizes >= kth_size] = False
+    n_removed = int(np.sum(remove))
+    if n_removed > 0:
+        # Lookup table from component label to removal
+        D[remove[C]] = 0
+    return {'n_components': n_components, 'n_removed': n_removed,
+            'sizes': sizes[1:], 'seconds': st.stop()}
 
 def post_process_multi_radii(coord, dim, pred, radii, y=None,
-                             remove_components=True, binary_closing=False):
-    t0 = time.time()
-    # 3D data matrix
-    D_orig = np.ones((dim[0], dim[1], dim[2]), dtype=int) * -1
-    for i in range(coord.shape[0]):
-        D_orig[coord[i,0], coord[i,1], coord[i,2]] = pred[i]
+                             remove_components=True, binary_closing=False,
+                             se_mode=None):
+    st = profiling.start('post_process_multi_radii', len(pred))
+    # 3D data matrix cropped to the brain
+    vol = patient_volume(coord, dim, margin=max(radii)+1)
+    D_orig = vol.scatter(pred, dtype=np.int8, fill=-1, reuse=True)
 
-    all_preds = []
-    for r in radii:
-        D = np.array(D_orig) # Copy array
-        neighborhood = skimage.morphology.ball(r)
+    if binary_closing:
+        # All radii from the same distance transform
+        box, closed = morphology.binary_closings(D_orig > 0, radii,
+                                                 mode=se_mode)
 
+    all_preds = []
+    for i, r in enumerate(radii):
         if binary_closing:
-            D2 = D > 0
-            D = skimage.morphology.binary_closing(D2, neighborhood)
+            D = vol.empty(dtype=bool, fill=False, reuse=True)
+            if box is not None:
+                D[box] = closed[i]
+                if remove_components:
+                    remove_small_components(D[box])
             #D[D3==0] = 0
             #D[np.logical_and(D==0, D3==1)] = 2
         else:
-            D = skimage.morphology.closing(D, neighborhood)
-
-        if remove_components:
-            remove_small_components(D)
+            D = morphology.closing(D_orig, r, mode=se_mode)
+            if remove_components:
+                remove_small_components(D)
 
-        new_pred = []
-        for i in range(coord.shape[0]):
-            new_pred.append(D[coord[i,0], coord[i,1], coord[i,2]])
+        new_pred = vol.gather(D, dtype=int)
         all_preds.append(new_pred)
         # Evaluation
         if y is not None:
@@ -141,39 +140,25 @@ def post_process_multi_radii(coord, dim, pred, radii, y=None,
             dice_scores(y, temp_pred, patient_idxs=None,
                         label='Dice scores (r=%d):' % r)
 
-    ret = np.zeros((len(all_preds[0]), len(all_preds)))
-    for i, pred in enumerate(all_preds):
-        ret[:,i] = pred
-
-    print "Post-processing took %.2f seconds." % (time.time()-t0)
-    return np.asarray(ret, dtype=int)
+    print "Post-processing took %.2f seconds." % st.stop()
+    return np.column_stack(all_preds)
 
 class_counts = np.zeros(5)
 
-def load_patient(number, do_preprocess=True, n_voxels=None, stratified=False,
-                 resolution=1, load_hog=False):
-    if resolution == 1:
-        pat_fname = "Patient_Features_%d.mat" % number
-        pat_diff_fname = "Patient_Diff_Features_%d.mat" % number
-    elif resolution == 2:
-        pat_fname = "Patient_Features_SubsampleX2_%d.mat" % number
-        pat_diff_fname = "Patient_Diff_Features_SubsampleX2_%d.mat" % number
-    elif resolution == 4:
-        pat_fname = "Patient_Features_SubsampleX4_%d.mat" % number
-        pat_diff_fname = "Patient_Diff_Features_SubsampleX4_%d.mat" % number
-    else:
-        raise ValueError('Resolution must be 1, 2, or 4')
-    data = scipy.io.loadmat(os.path.join('data', pat_fname))
+def read_patient_mat(number, do_preprocess=True, resolution=1, load_hog=False):
+    """
+    Parse the .mat feature file(s) of a patient.
+    """
+    pat_fname, pat_diff_fname = fc.source_fnames(number, resolution)
+    data = scipy.io.loadmat(pat_fname)
     data = data['featuresMatrix']
 
     tumor_grade = data[0,0]
-    print "Patient %d, tumor grade: %d" % (number, tumor_grade)
 
     row0 = 5
     y = data[row0:, 1]
     x = data[row0:, 5:]
     coord = data[row0:, 2:5]
-    print "Features available: %d" % x.shape[1]
     #x = x[:, [19, 18, 10, 0, 79, 9, 70, 69, 8, 15, 60]]
     #x = data[row0:, 5:11]
     #x = data[row0:, [5,11,17,23]]
@@ -185,7 +170,7 @@ def load_patient(number, do_preprocess=True, n_voxels=None, stratified=False,
     coord = coord[ok_idxs,:]
 
     if load_hog:
-        diff_data = scipy.io.loadmat(os.path.join('data', pat_diff_fname))
+        diff_data = scipy.io.loadmat(pat_diff_fname)
         diff_x = diff_data['featuresMatrix']
         diff_x = diff_x[row0:, 5:]
         if diff_x.shape[0] > x.shape[0]:
@@ -211,117 +196,355 @@ def load_patient(number, do_preprocess=True, n_voxels=None, stratified=False,
         x = preprocess(x)
         pass
 
+    dim = data[3, :3]
+
+    # Make sure data type is float32 as it might be more memory efficient sklearn.fit
+    x = np.asarray(x, dtype=np.float32)
+
+    # Remove bad values
+    print "Max:", x.max(), " Min:", x.min()
+    x[np.isnan(x)] = 0
+
+    return x, y, coord, dim, tumor_grade
+
+def cache_patient(number, do_preprocess=True, resolution=1, load_hog=False):
+    """
+    Convert the .mat file(s) of a patient into the feature cache.
+    """
+    st = profiling.start('cache_patient', patient=number)
+    x, y, coord, dim, tumor_grade = read_patient_mat(
+            number, do_preprocess=do_preprocess, resolution=resolution,
+            load_hog=load_hog)
+    fc.write_patient(number, x, y, coord, dim, tumor_grade,
+                     resolution=resolution, load_hog=load_hog,
+                     do_preprocess=do_preprocess)
+    st.n_voxels = len(y)
+    print "Cached patient %d (%.2f seconds)." % (number, st.stop())
+
+def _cache_patient_args(args):
+    cache_patient(*args)
+
+def convert_patients(pats, do_preprocess=True, resolution=1, load_hog=False,
+                     n_workers=1):
+    """
+    One-time conversion of the given patients into the feature cache. Patients
+    whose cache is up to date are skipped.
+    """
+    stale = [pat for pat in sorted(set(pats))
+             if fc.is_stale(pat, resolution, load_hog, do_preprocess)]
+    tasks = [(pat, do_preprocess, resolution, load_hog) for pat in stale]
+    pool = None
+    if n_workers > 1 and len(tasks) > 1:
+        pool = _worker_pool(n_workers)
+    if pool is not None:
+        pool.map(_cache_patient_args, tasks)
+    else:
+        for task in tasks:
+            _cache_patient_args(task)
+
+def load_patient(number, do_preprocess=True, n_voxels=None, stratified=False,
+                 resolution=1, load_hog=False, binner=None):
+    if fc.is_stale(number, resolution, load_hog, do_preprocess):
+        cache_patient(number, do_preprocess, resolution, load_hog)
+    x, y, coord, meta = fc.open_patient(number, resolution, load_hog,
+                                        do_preprocess)
+    if binner is not None:
+        # uint8 bin codes instead of the features (see binning.py)
+        import binning
+        x = binning.open_binned(number, binner, resolution, load_hog,
+                                do_preprocess)
+
+    print "Patient %d, tumor grade: %d" % (number, meta['tumor_grade'])
+    print "Features available: %d" % x.shape[1]
+
     # Update class counts
-    new_counts = np.histogram(y, bins=range(6))[0]
+    new_counts = np.bincount(y, minlength=5)[:5]
     global class_counts
     class_counts += new_counts
 
     if n_voxels is not None and isinstance(n_voxels, int):
+        # Select the sampled rows first so that only they are read from the
+        # cache
         idxs = np.random.permutation(len(y))
         if not stratified:
             idxs = idxs[:min(n_voxels,len(y))]
-            y = y[idxs]
-            x = x[idxs,:]
-            coord = coord[idxs,:]
         else:
-            y = y[idxs]
-            x = x[idxs,:]
-            coord = coord[idxs,:]
-            x2 = np.zeros((0,x.shape[1]), dtype=np.float32)
-            y2 = np.zeros(0)
-            coord2 = np.zeros((0,3))
+            yp = y[idxs]
             n_batch = int(n_voxels / 8)
+            sel = []
             for i in range(5):
                 if i == 0:
-                    new_idxs = np.nonzero(y==i)[0][:4*n_batch]
+                    new_idxs = np.nonzero(yp==i)[0][:4*n_batch]
                 else:
-                    new_idxs = np.nonzero(y==i)[0][:n_batch]
-                x2 = np.vstack((x2, x[new_idxs,:]))
-                y2 = np.concatenate((y2, y[new_idxs]))
-                coord2 = np.vstack((coord2, coord[new_idxs]))
-            x = x2
-            y = y2
-            coord = coord2
-
-    dim = data[3, :3]
+                    new_idxs = np.nonzero(yp==i)[0][:n_batch]
+                sel.append(idxs[new_idxs])
+            idxs = np.concatenate(sel)
+        y = y[idxs]
+        x = x[idxs,:]
+        coord = coord[idxs,:]
 
-    # Make sure data type is float32 as it might be more memory efficient sklearn.fit
-    x = np.asarray(x, dtype=np.float32)
-
-    # Remove bad values
-    print "Max:", x.max(), " Min:", x.min()
-    x[np.isnan(x)] = 0
+    dim = np.asarray(meta['dim'], dtype=int)
 
     return x, y, coord, dim
 
+def count_patient_voxels(number, do_preprocess=True, n_voxels=None,
+                         stratified=False, resolution=1, load_hog=False):
+    """
+    Return the number of voxels and features load_patient would return for
+    the given sampling parameters, without reading the features.
+    """
+    if fc.is_stale(number, resolution, load_hog, do_preprocess):
+        cache_patient(number, do_preprocess, resolution, load_hog)
+    x, y, coord, meta = fc.open_patient(number, resolution, load_hog,
+                                        do_preprocess)
+    n = len(y)
+    if n_voxels is not None and isinstance(n_voxels, int):
+        if not stratified:
+            n = min(n_voxels, n)
+        else:
+            counts = np.bincount(y, minlength=5)[:5]
+            n_batch = int(n_voxels / 8)
+            n = min(counts[0], 4*n_batch) + \
+                sum(min(c, n_batch) for c in counts[1:])
+    return n, meta['n_features']
+
 def load_patients(pats, stratified=False, resolution=1, n_voxels=30000,
-                  load_hog=False):
-    xtr = np.zeros((0,0), dtype=np.float32)
-    ytr = np.zeros(0)
-    coordtr = np.zeros((0,3))
-    patient_idxs_tr = [0]
+                  load_hog=False, out_fname=None, binner=None, n_workers=None):
+    """
+    Load a sample of voxels from each patient into a single training set.
+
+    Patients missing from the feature cache are first converted by a pool
+    of n_workers processes. The first pass then counts the sampled voxels of
+    every patient, the second pass fills one preallocated buffer. If
+    out_fname is given, the features are written into a np.memmap file of
+    that name instead of memory.
+
+    Input:
+        binner -- A binning.QuantileBinner to load the uint8 bin codes of the
+                  features instead.
+        n_workers -- Processes converting and prefetching the patients (see
+                     iter_patients), n_prefetch_workers if None.
+
+    Output:
+        xtr -- (n, n_features) float32 features (uint8 codes with binner).
+        ytr -- (n,) int8 labels.
+        coordtr -- (n, 3) int16 coordinates.
+        patient_idxs_tr -- Offsets of the patients, patient i is in rows
+                           patient_idxs_tr[i]:patient_idxs_tr[i+1].
+        dims_tr -- List of patient dims.
+    """
+    if n_workers is None:
+        n_workers = n_prefetch_workers
+    # The count pass needs the caches, convert them in parallel first
+    convert_patients(pats, resolution=resolution, load_hog=load_hog,
+                     n_workers=n_workers)
+
+    # First pass: number of sampled voxels per patient
+    counts = []
+    n_features = None
+    for pat in pats:
+        n, nf = count_patient_voxels(pat, n_voxels=n_voxels,
+                                     stratified=stratified,
+                                     resolution=resolution, load_hog=load_hog)
+        assert n_features is None or nf == n_features, \
+                "Patient %d has %d features instead of %d" % (pat, nf, n_features)
+        n_features = nf
+        counts.append(n)
+    patient_idxs_tr = [0] + list(np.cumsum(counts))
+    n_total = patient_idxs_tr[-1]
+    if n_features is None:
+        n_features = 0
+
+    x_dtype = np.float32 if binner is None else np.uint8
+    if out_fname is not None:
+        xtr = np.memmap(out_fname, dtype=x_dtype, mode='w+',
+                        shape=(n_total, n_features))
+    else:
+        xtr = np.empty((n_total, n_features), dtype=x_dtype)
+    ytr = np.empty(n_total, dtype=np.int8)
+    coordtr = np.empty((n_total, 3), dtype=np.int16)
     dims_tr = []
-    for i, pat in enumerate(pats):
-        print "Loading patient %d..." % i
-        x, y, coord, dim = load_patient(pat, n_voxels=n_voxels,
-                                        stratified=stratified,
-                                        resolution=resolution,
-                                        load_hog=load_hog)
-        ytr = np.concatenate((ytr, y))
-        if xtr.shape[0] == 0:
-            xtr = x
-        else:
-            xtr = np.vstack((xtr, x))
-        coordtr = np.vstack((coordtr, coord))
-        patient_idxs_tr.append(len(ytr))
+
+    # Second pass: fill the buffers
+    for i, (pat, (x, y, coord, dim)) in enumerate(iter_patients(
+            pats, n_voxels=n_voxels, stratified=stratified,
+            resolution=resolution, load_hog=load_hog, n_workers=n_workers,
+            binner=binner)):
+        print "Loaded patient %d." % i
+        i0, i1 = patient_idxs_tr[i], patient_idxs_tr[i+1]
+        assert len(y) == i1 - i0, "Patient %d: expected %d voxels, got %d" % (pat, i1-i0, len(y))
+        xtr[i0:i1,:] = x
+        ytr[i0:i1] = y
+        coordtr[i0:i1,:] = coord
         dims_tr.append(dim)
     return xtr, ytr, coordtr, patient_idxs_tr, dims_tr
 
-def extract_label_features(coords, dims, pred_probs, patient_idxs):
+# Defaults of the patient prefetcher
+n_prefetch_workers = 4
+n_prefetch = 2
+prefetch_memory_budget = 4 * 1024**3
+
+# Process pool of convert_patients and iter_patients, kept between calls
+_pool = None
+_pool_size = 0
+_pool_pid = None
+
+def _worker_pool(n_workers):
+    """
+    Pool of n_workers processes, reused while n_workers does not change,
+    None if this process cannot start one (e.g. a pool worker itself).
+    """
+    global _pool, _pool_size, _pool_pid
+    if multiprocessing.current_process().daemon:
+        return None
+    if _pool is not None and (_pool_size != n_workers or
+                              _pool_pid != os.getpid()):
+        close_pool()
+    if _pool is None:
+        _pool = multiprocessing.Pool(n_workers)
+        _pool_size = n_workers
+        _pool_pid = os.getpid()
+    return _pool
+
+def close_pool():
+    global _pool, _pool_pid
+    if _pool is not None:
+        # A pool inherited from the parent process is not ours to stop
+        if _pool_pid == os.getpid():
+            _pool.terminate()
+            _pool.join()
+        _pool = None
+        _pool_pid = None
+
+def _warm_patient(args):
+    """
+    Make sure the feature cache of a patient is up to date and read it once
+    so that the following load_patient finds it in the page cache.
+    """
+    number, do_preprocess, resolution, load_hog = args
+    if fc.is_stale(number, resolution, load_hog, do_preprocess):
+        cache_patient(number, do_preprocess, resolution, load_hog)
+    pdir = fc.patient_dir(number, resolution, load_hog, do_preprocess)
+    n_bytes = 0
+    for fname in os.listdir(pdir):
+        with open(os.path.join(pdir, fname), 'rb') as f:
+            while True:
+                chunk = f.read(1 << 24)
+                if not chunk:
+                    break
+                n_bytes += len(chunk)
+    return n_bytes
+
+def _patient_bytes(number, do_preprocess, resolution, load_hog):
+    meta = fc.read_meta(number, resolution, load_hog, do_preprocess)
+    if meta is not None:
+        return meta['n_voxels'] * (4*meta['n_features'] + 7)
+    # Not cached yet, estimate from the size of the source files
+    n_bytes = 0
+    fnames = fc.source_fnames(number, resolution)
+    for fname in (fnames if load_hog else fnames[:1]):
+        if os.path.isfile(fname):
+            n_bytes += os.path.getsize(fname)
+    return n_bytes
+
+def iter_patients(pats, do_preprocess=True, n_voxels=None, stratified=False,
+                  resolution=1, load_hog=False, n_workers=None,
+                  prefetch=None, memory_budget=None, binner=None):
+    """
+    Iterate over (patient, (x, y, coord, dim)) with the arguments of
+    load_patient.
+
+    While a patient is being processed, the next prefetch patients are
+    converted into the feature cache and read into the page cache by a pool
+    of n_workers processes, as long as they fit into memory_budget bytes.
+    The pool is shared with convert_patients and kept between calls, so it
+    is started once per process rather than once per set of patients.
+    The patients themselves are loaded in the calling process in order, so
+    the results (including the seeded voxel sampling) are identical to
+    calling load_patient in a loop.
+    """
+    if n_workers is None:
+        n_workers = n_prefetch_workers
+    if prefetch is None:
+        prefetch = n_prefetch
+    if memory_budget is None:
+        memory_budget = prefetch_memory_budget
+    pats = list(pats)
+
+    pool = None
+    if n_workers > 0 and prefetch > 0 and len(pats) > 1:
+        pool = _worker_pool(n_workers)
+    pending = {}
+    warmed = set()
+    in_flight = 0
+    next_idx = 0
+    try:
+        for i, pat in enumerate(pats):
+            next_idx = max(next_idx, i+1)
+            # Submit the next patients to the workers
+            while pool is not None and next_idx < len(pats) and \
+                    next_idx <= i + prefetch:
+                next_pat = pats[next_idx]
+                if next_pat not in warmed:
+                    n_bytes = _patient_bytes(next_pat, do_preprocess,
+                                             resolution, load_hog)
+                    if pending and in_flight + n_bytes > memory_budget:
+                        break
+                    args = (next_pat, do_preprocess, resolution, load_hog)
+                    pending[next_idx] = (pool.apply_async(_warm_patient,
+                                                          (args,)), n_bytes)
+                    warmed.add(next_pat)
+                    in_flight += n_bytes
+                next_idx += 1
+            if i in pending:
+                result, n_bytes = pending.pop(i)
+                result.get()
+                in_flight -= n_bytes
+            data = load_patient(pat, do_preprocess=do_preprocess,
+                                n_voxels=n_voxels, stratified=stratified,
+                                resolution=resolution, load_hog=load_hog,
+                                binner=binner)
+            profiling.set_patient(pat)
+            yield pat, data
+    finally:
+        profiling.set_patient(None)
+        # The pool outlives the loop, so let unfinished conversions finish
+        # before the patients can be converted again by the caller
+        for result, n_bytes in pending.values():
+            result.wait()
+
+def extract_label_features(coords, dims, pred_probs, patient_idxs, radius=1):
     """
     Return histogram of predicted labels in the neighborhood for each voxel.
+
+    The probabilities of each class are scattered into a volume cropped to
+    the patient and summed over a (2r+1)^3 box with a separable box filter.
+
+    Input:
+        radius -- Neighborhood radius r or a list of radii.
+
+    Output:
+        (n_voxels, n_classes * n_radii) float32 array, the classes of the
+        first radius come first.
     """
-    t0 = time.time()
+    st = profiling.start('extract_label_features', len(coords))
     print "Extracting label features..."
-    n_modalities = 5
-    xlabel = np.zeros((coords.shape[0], n_modalities))
-    # Neighborhood radius
-    r = 1
-    # Neighborhood patch
-    patch = np.ones((2*r+1, 2*r+1, 2*r+1))
-    patch = patch[np.newaxis,:,:,:]
+    radii = radius if hasattr(radius, '__len__') else [radius]
+    n_modalities = pred_probs.shape[1]
+    xlabel = np.zeros((coords.shape[0], n_modalities*len(radii)),
+                      dtype=np.float32)
     # Go through patients
     for pi in range(len(patient_idxs)-1):
-        pidxs = range(patient_idxs[pi], patient_idxs[pi+1])
-        pcoords = coords[pidxs,:]
-        ppred_probs = pred_probs[pidxs,:]
-        dim = dims[pi]
-        # Histogram of predicted labels for neighbors
-        label_hist = np.zeros((n_modalities, dim[0], dim[1], dim[2]))
-        for i in range(pcoords.shape[0]):
-            coord = pcoords[i,:]
-            probs = ppred_probs[i,:]
-            x0 = max(coord[0]-r, 0)
-            x1 = min(coord[0]+r, dim[0])
-            dx0 = x0 - coord[0]
-            dx1 = x1 - coord[0]
-            y0 = max(coord[1]-r, 0)
-            y1 = min(coord[1]+r, dim[1])
-            dy0 = y0 - coord[1]
-            dy1 = y1 - coord[1]
-            z0 = max(coord[2]-r, 0)
-            z1 = min(coord[2]+r, dim[2])
-            dz0 = z0 - coord[2]
-            dz1 = z1 - coord[2]
-
-            # Go through modalities
-            #for mi in range(n_modalities):
-            #    label_hist[mi, x0:x1, y0:y1, z0:z1] += \
-            #            patch[r+dx0:r+dx1, r+dy0:r+dy1, r+dz0:r+dz1] * probs[mi]
-            probs = probs[:, np.newaxis, np.newaxis, np.newaxis]
-            label_hist[:, x0:x1, y0:y1, z0:z1] += patch[0, r+dx0:r+dx1, r+dy0:r+dy1, r+dz0:r+dz1] * probs
-        for i in range(pcoords.shape[0]):
-            coord = pcoords[i,:]
-            xlabel[pidxs[i],:] = label_hist[:, coord[0], coord[1], coord[2]]
-    print "Extracted (%.2f seconds)." % (time.time()-t0)
+        p0, p1 = patient_idxs[pi], patient_idxs[pi+1]
+        # Volume cropped to the brain of the patient
+        vol = PatientVolume(coords[p0:p1,:], dims[pi], margin=max(radii))
+        for mi in range(n_modalities):
+            P = vol.scatter(pred_probs[p0:p1,mi], dtype=np.float32, fill=0,
+                            reuse=True)
+            for ri, r in enumerate(radii):
+                size = 2*r + 1
+                # Mean over the box times its volume is the sum
+                S = scipy.ndimage.uniform_filter(P, size=size, mode='constant')
+                xlabel[p0:p1, ri*n_modalities + mi] = vol.gather(S) * size**3
+    print "Extracted (%.2f seconds)." % st.stop()
     return xlabel
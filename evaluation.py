@@ -1,24 +1,116 @@
 import numpy as np
 
+n_labels = 5
+# Labels of the evaluated tumor regions
+regions = [('Whole tumor', [1,2,3,4]),
+           ('Tumor core', [1,3,4]),
+           ('Active tumor', [4])]
+# Rows per bincount pass, bounds the memory of the label codes
+_block_size = 1 << 20
+
 def dice(y, ypred):
-    A = set(np.nonzero(y)[0])
-    B = set(np.nonzero(ypred)[0])
-    if len(A) == 0:
+    A = np.count_nonzero(y)
+    B = np.count_nonzero(ypred)
+    if A == 0:
         return 1 # Not sure how it should be computed in this case
-    score = 2*len(A & B) / max(float(len(A) + len(B)), 1)
+    score = 2*np.count_nonzero(np.logical_and(y, ypred)) / max(float(A + B), 1)
     return score
 
-def dice_scores(y, ypred, patient_idxs=None, label='Dice scores:', fscores=None):
+def confusion_matrices(y, ypred, patient_idxs=None, n_labels=n_labels):
+    """
+    Confusion matrices of every patient (and candidate) in one bincount pass.
+
+    Input:
+        y -- (n_voxels,) true labels in 0..n_labels-1.
+        ypred -- (n_voxels,) predicted labels or an (n_voxels, n_candidates)
+                 matrix with the predictions of several candidates.
+        patient_idxs -- Offsets of the patients, None for a single patient.
+
+    Output:
+        (n_patients, n_labels, n_labels) or (n_patients, n_candidates,
+        n_labels, n_labels) int64 array, true labels on the rows.
+    """
+    y = np.asarray(y)
+    ypred = np.asarray(ypred)
+    single = ypred.ndim == 1
+    if single:
+        ypred = ypred[:,np.newaxis]
+    n, n_cand = ypred.shape
+    assert len(y) == n, "Number of labels must match (%d != %d)" % (len(y), n)
     if patient_idxs is None:
-        patient_idxs = [0, len(y)]
-    ds = np.zeros((len(patient_idxs)-1,3))
-    for i in range(len(patient_idxs)-1):
-        yy = y[patient_idxs[i]:patient_idxs[i+1]]
-        yypred = ypred[patient_idxs[i]:patient_idxs[i+1]]
-        ds[i,0] = dice(yy>0, yypred>0)
-        ds[i,1] = dice(np.logical_and(yy>0, yy!=2),
-                       np.logical_and(yypred>0, yypred!=2))
-        ds[i,2] = dice(yy==4, yypred==4)
+        patient_idxs = [0, n]
+    n_pat = len(patient_idxs) - 1
+    L = n_labels
+    cand_offset = np.arange(n_cand, dtype=np.intp) * (L*L)
+    counts = np.zeros(n_pat * n_cand * L * L, dtype=np.int64)
+    for pi in range(n_pat):
+        for b0 in range(patient_idxs[pi], patient_idxs[pi+1], _block_size):
+            b1 = min(b0 + _block_size, patient_idxs[pi+1])
+            yy = y[b0:b1].astype(np.intp)
+            pp = ypred[b0:b1].astype(np.intp)
+            assert yy.min() >= 0 and yy.max() < L and pp.min() >= 0 and \
+                    pp.max() < L, "Labels must be in 0..%d" % (L-1)
+            code = cand_offset + (yy*L)[:,np.newaxis] + pp
+            code += pi * n_cand * L * L
+            counts += np.bincount(code.ravel(), minlength=len(counts))
+    cms = counts.reshape(n_pat, n_cand, L, L)
+    if single:
+        cms = cms[:,0]
+    return cms
+
+def confusion_matrix(y, ypred, n_labels=n_labels):
+    """
+    Confusion matrix of all voxels, true labels on the rows.
+    """
+    return confusion_matrices(y, ypred, n_labels=n_labels)[0]
+
+def region_scores(cms):
+    """
+    Dice, sensitivity and specificity of the tumor regions from confusion
+    matrices of shape (..., n_labels, n_labels).
+
+    Output:
+        Dictionary of (..., n_regions) arrays 'dice', 'sensitivity' and
+        'specificity'. Regions without true voxels get dice and sensitivity 1.
+    """
+    cms = np.asarray(cms, dtype=np.float64)
+    L = cms.shape[-1]
+    total = cms.sum(axis=(-2,-1))
+    out = {'dice': [], 'sensitivity': [], 'specificity': []}
+    for name, labels in regions:
+        s = np.zeros(L, dtype=bool)
+        s[[l for l in labels if l < L]] = True
+        tp = cms[..., s, :][..., s].sum(axis=(-2,-1))
+        a = cms[..., s, :].sum(axis=(-2,-1))
+        b = cms[..., :, s].sum(axis=(-2,-1))
+        tn = total - a - b + tp
+        ones = np.ones_like(tp)
+        out['dice'].append(np.where(a > 0, 2*tp / np.maximum(a+b, 1), ones))
+        out['sensitivity'].append(np.where(a > 0, tp / np.maximum(a, 1), ones))
+        out['specificity'].append(np.where(total-a > 0,
+                                           tn / np.maximum(total-a, 1), ones))
+    for k in out:
+        out[k] = np.stack(out[k], axis=-1)
+    return out
+
+def candidate_dice_scores(y, ypred, patient_idxs=None):
+    """
+    Mean (over patients) dice scores of every candidate prediction.
+
+    Input:
+        ypred -- (n_voxels, n_candidates) predictions.
+
+    Output:
+        (n_candidates, n_regions) array.
+    """
+    cms = confusion_matrices(y, ypred, patient_idxs)
+    return region_scores(cms)['dice'].mean(axis=0)
+
+def print_dice_scores(ds, label='Dice scores:', fscores=None):
+    """
+    Print the mean, std, min and max over patients of (n_patients, 3) dice
+    scores and return the mean.
+    """
     ds_mean = np.mean(ds,0)
     ds_std = np.std(ds,0)
     ds_min = np.min(ds,0)
@@ -33,3 +125,17 @@ def dice_scores(y, ypred, patient_idxs=None, label='Dice scores:', fscores=None)
     if fscores is not None:
         fscores.write(scores_str)
     return ds_mean
+
+def dice_scores(y, ypred, patient_idxs=None, label='Dice scores:', fscores=None,
+                cms=None):
+    """
+    Print and return the mean dice scores over patients.
+
+    Input:
+        cms -- Per-patient confusion matrices of y and ypred, if they have
+               already been computed (see confusion_matrices).
+    """
+    if cms is None:
+        cms = confusion_matrices(y, ypred, patient_idxs)
+    ds = region_scores(cms)['dice']
+    return print_dice_scores(ds, label, fscores)
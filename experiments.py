@@ -8,6 +8,10 @@ import sys
 from sklearn.cross_validation import KFold
 
 import methods
+import morphology
+import mrf_solver
+import profiling
+import cv_runner
 
 # Experiment parameters
 seed = 982341119
@@ -27,6 +31,18 @@ n_folds = 2
 load_hog = False
 use_mrf = True
 fresh_models = True
+n_workers = 1 # Processes evaluating test patients in parallel
+n_fold_workers = 1 # CV folds running in parallel
+tuning_mode = 'separate' # 'separate', 'grid' or 'halving' (see tuning.py)
+cascade_stride = None # Coarse-to-fine first stage (see cascade.py)
+memory_budget = None # Bytes per streamed training sample (see streaming.py)
+n_bins = None # Train on quantile-binned features (see binning.py)
+mrf_backend = 'qpbo' # 'qpbo' or 'icm' (see mrf_solver.py)
+mrf_jobs = 1 # Processes solving the components of the tumor graph
+block_size = None # Voxels per block of out-of-core inference (see chunked.py)
+closing_jobs = 1 # Threads closing slabs of the volume (see morphology.py)
+se_mode = 'exact' # 'exact' or 'decomposed' ball of the closings
+profile = True # Record the time of the pipeline stages (see profiling.py)
 
 def run_experiment(method):
     # Plot parameters to store them to output log
@@ -43,6 +59,24 @@ def run_experiment(method):
     print "load_hog", load_hog
     print "use_mrf", use_mrf
     print "fresh_models", fresh_models
+    print "n_workers", n_workers
+    print "n_fold_workers", n_fold_workers
+    print "tuning_mode", tuning_mode
+    print "cascade_stride", cascade_stride
+    print "memory_budget", memory_budget
+    print "n_bins", n_bins
+    print "mrf_backend", mrf_backend
+    print "mrf_jobs", mrf_jobs
+    print "block_size", block_size
+    print "closing_jobs", closing_jobs
+    print "se_mode", se_mode
+    print "profile", profile
+    # Inherited by the forked worker processes
+    mrf_solver.backend = mrf_backend
+    mrf_solver.n_jobs = mrf_jobs
+    morphology.n_jobs = closing_jobs
+    morphology.se_mode = se_mode
+    profiling.enabled = profile
 
     method_names = {1:'RF', 2:'two-stage', 3:'online'}
     datestr = re.sub('[ :]','',str(dt.datetime.now())[:-7])
@@ -92,7 +126,12 @@ def run_experiment(method):
                                       plot_predictions, stratified, n_trees,
                                       dev_pats=dev_patients, use_mrf=use_mrf,
                                       resolution=resolution, n_voxels=n_voxels,
-                                      fresh_models=fresh_models, load_hog=load_hog)
+                                      fresh_models=fresh_models, load_hog=load_hog,
+                                      n_workers=n_workers,
+                                      tuning_mode=tuning_mode,
+                                      cascade_stride=cascade_stride,
+                                      memory_budget=memory_budget,
+                                      n_bins=n_bins, block_size=block_size)
         elif method == 3:
             methods.predict_online(train_patients, test_patients, fscores,
                                    plot_predictions)
@@ -103,17 +142,23 @@ def run_experiment(method):
         os.makedirs(mat_dir)
         kf = KFold(len(patients), n_folds)
         patients = np.asarray(patients)
+        folds = []
         for train, test in kf:
-            train_patients = patients[train]
-            test_patients = patients[test]
-            dev_patients = []
-            methods.predict_two_stage(
-                    train_patients[:80], test_patients, fscores, plot_predictions,
-                    stratified, n_trees, dev_pats=dev_patients, use_mrf=False,
-                    resolution=resolution, n_voxels=n_voxels, mat_dir=mat_dir,
-                    fresh_models=True, load_hog=load_hog)
+            folds.append((patients[train][:80], patients[test]))
+        cv_runner.run_cv(
+                folds, os.path.join('results', res_dir), seed, fscores,
+                n_fold_workers=n_fold_workers,
+                do_plot_predictions=plot_predictions, stratified=stratified,
+                n_trees=n_trees, dev_pats=[], use_mrf=False,
+                resolution=resolution, n_voxels=n_voxels, mat_dir=mat_dir,
+                fresh_models=True, load_hog=load_hog, n_workers=n_workers)
 
     print "Total time: %.2f seconds." % (time.time()-t_beg)
+    if profile:
+        profiling.write(os.path.join('results', res_dir), 'profile_%s' % datestr)
+        s = "\nProfile of the pipeline stages:" + profiling.summary(top=15)
+        print s
+        fscores.write(s)
     fscores.close()
 
 def main():
@@ -0,0 +1,154 @@
+"""
+Columnar on-disk cache of the patient feature files.
+
+Each patient is stored in its own directory as raw binary columns that can be
+opened zero-copy with np.memmap:
+
+    x.f32      -- (n_voxels, n_features) float32 features
+    y.i8       -- (n_voxels,) int8 labels
+    coord.i16  -- (n_voxels, 3) int16 coordinates
+    meta.json  -- dims, tumor grade, shapes and source file stamps
+
+The cache is keyed by resolution, load_hog and do_preprocess. It is rebuilt
+when the source .mat files change (see is_stale).
+
+Convert all patients once with:
+    python feature_cache.py [resolution] [hog]
+"""
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+data_dir = 'data'
+cache_dir = os.path.join('data', 'cache')
+cache_version = 1
+
+def source_fnames(number, resolution=1):
+    if resolution == 1:
+        pat_fname = "Patient_Features_%d.mat" % number
+        pat_diff_fname = "Patient_Diff_Features_%d.mat" % number
+    elif resolution == 2:
+        pat_fname = "Patient_Features_SubsampleX2_%d.mat" % number
+        pat_diff_fname = "Patient_Diff_Features_SubsampleX2_%d.mat" % number
+    elif resolution == 4:
+        pat_fname = "Patient_Features_SubsampleX4_%d.mat" % number
+        pat_diff_fname = "Patient_Diff_Features_SubsampleX4_%d.mat" % number
+    else:
+        raise ValueError('Resolution must be 1, 2, or 4')
+    return os.path.join(data_dir, pat_fname), \
+           os.path.join(data_dir, pat_diff_fname)
+
+def patient_dir(number, resolution=1, load_hog=False, do_preprocess=True):
+    key = 'res%d' % resolution
+    if load_hog:
+        key += '_hog'
+    if not do_preprocess:
+        key += '_raw'
+    return os.path.join(cache_dir, key, 'pat%d' % number)
+
+def _source_stamps(number, resolution, load_hog):
+    fnames = source_fnames(number, resolution)
+    if not load_hog:
+        fnames = fnames[:1]
+    stamps = []
+    for fname in fnames:
+        if os.path.isfile(fname):
+            st = os.stat(fname)
+            stamps.append([os.path.basename(fname), st.st_size, int(st.st_mtime)])
+        else:
+            stamps.append([os.path.basename(fname), None, None])
+    return stamps
+
+def read_meta(number, resolution=1, load_hog=False, do_preprocess=True):
+    fname = os.path.join(patient_dir(number, resolution, load_hog,
+                                     do_preprocess), 'meta.json')
+    if not os.path.isfile(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f)
+
+def is_stale(number, resolution=1, load_hog=False, do_preprocess=True):
+    """
+    Return True if the cache of the patient is missing or older than its
+    source .mat files. A cache whose sources have been removed is kept.
+    """
+    meta = read_meta(number, resolution, load_hog, do_preprocess)
+    if meta is None or meta.get('version') != cache_version:
+        return True
+    for old, new in zip(meta['sources'],
+                        _source_stamps(number, resolution, load_hog)):
+        if new[1] is not None and list(old) != list(new):
+            return True
+    return False
+
+def write_patient(number, x, y, coord, dim, tumor_grade, resolution=1,
+                  load_hog=False, do_preprocess=True):
+    pdir = patient_dir(number, resolution, load_hog, do_preprocess)
+    tmp_dir = pdir + '.tmp%d' % os.getpid()
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    np.asarray(x, dtype=np.float32).tofile(os.path.join(tmp_dir, 'x.f32'))
+    np.asarray(y, dtype=np.int8).tofile(os.path.join(tmp_dir, 'y.i8'))
+    np.asarray(coord, dtype=np.int16).tofile(os.path.join(tmp_dir, 'coord.i16'))
+    meta = {'version': cache_version,
+            'n_voxels': int(x.shape[0]),
+            'n_features': int(x.shape[1]),
+            'dim': [int(d) for d in dim],
+            'tumor_grade': int(tumor_grade),
+            'sources': _source_stamps(number, resolution, load_hog)}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    # Swap the new cache in place of the old one
+    if os.path.isdir(pdir):
+        shutil.rmtree(pdir)
+    os.rename(tmp_dir, pdir)
+    return meta
+
+def open_patient(number, resolution=1, load_hog=False, do_preprocess=True,
+                 mode='r'):
+    """
+    Open a cached patient without copying it into memory.
+
+    Output:
+        x, y, coord -- np.memmap arrays (read-only by default).
+        meta -- Dictionary with 'dim', 'tumor_grade', 'n_voxels' and
+                'n_features'.
+    """
+    pdir = patient_dir(number, resolution, load_hog, do_preprocess)
+    meta = read_meta(number, resolution, load_hog, do_preprocess)
+    assert meta is not None, "Patient %d is not cached in %s" % (number, pdir)
+    n = meta['n_voxels']
+    x = np.memmap(os.path.join(pdir, 'x.f32'), dtype=np.float32, mode=mode,
+                  shape=(n, meta['n_features']))
+    y = np.memmap(os.path.join(pdir, 'y.i8'), dtype=np.int8, mode=mode,
+                  shape=(n,))
+    coord = np.memmap(os.path.join(pdir, 'coord.i16'), dtype=np.int16,
+                      mode=mode, shape=(n, 3))
+    return x, y, coord, meta
+
+def available_patients(resolution=1):
+    fname = os.path.basename(source_fnames(0, resolution)[0])
+    prefix = fname[:fname.rindex('0')]
+    patients = []
+    for f in os.listdir(data_dir):
+        if f.startswith(prefix) and f.endswith('.mat'):
+            number = f[len(prefix):-4]
+            if number.isdigit():
+                patients.append(int(number))
+    return sorted(patients)
+
+def main():
+    import data_processing as dp
+    resolution = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    load_hog = len(sys.argv) > 2 and sys.argv[2] == 'hog'
+    pats = available_patients(resolution)
+    dp.convert_patients(pats, resolution=resolution, load_hog=load_hog)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Packed-array inference of trained random forests.
+
+pack_forest exports the trees of a fitted sklearn forest into one set of
+flat node arrays (feature, float32 threshold, children and float32 leaf
+probabilities). PackedForest.predict_proba walks the trees over blocks of
+voxels with the compiled traversal of sklearn (Tree.apply, which releases the
+GIL) and sums the float32 leaf probabilities of all trees into one
+accumulator per block, instead of allocating a float64 probability matrix per
+tree. Blocks are evaluated in a pool of threads.
+
+The trees are rebuilt through the pickle state of the private sklearn Tree,
+whose node layout can change between sklearn versions. tree_layout_error
+checks it on a small tree; if it fails, predict_two_stage falls back to the
+sklearn models.
+"""
+import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import sklearn
+
+_node_fields = ['left_child', 'right_child', 'feature', 'threshold',
+                'n_node_samples', 'weighted_n_node_samples']
+# Result of tree_layout_error, computed once
+_layout_error = None
+_layout_checked = False
+
+def _node_dtype():
+    from sklearn.tree._tree import Tree
+    return Tree(1, np.array([1], dtype=np.intp), 1).__getstate__()[
+            'nodes'].dtype
+
+def _build_tree(n_features, n_classes, max_depth, nodes, values):
+    from sklearn.tree._tree import Tree
+    tree = Tree(n_features, np.array([n_classes], dtype=np.intp), 1)
+    tree.__setstate__({'max_depth': max_depth, 'node_count': len(nodes),
+                       'nodes': nodes, 'values': values})
+    return tree
+
+def _check_layout():
+    names = _node_dtype().names
+    missing = [f for f in _node_fields if f not in names]
+    if missing:
+        return "no node fields %s" % ', '.join(missing)
+    # A stump: feature 0 <= 0.5 goes to node 1, otherwise node 2
+    nodes = np.zeros(3, dtype=_node_dtype())
+    nodes['left_child'] = [1, -1, -1]
+    nodes['right_child'] = [2, -1, -1]
+    nodes['feature'] = [0, -2, -2]
+    nodes['threshold'] = [0.5, -2, -2]
+    nodes['n_node_samples'] = 1
+    nodes['weighted_n_node_samples'] = 1
+    values = np.array([[[1, 1]], [[1, 0]], [[0, 1]]], dtype=np.float64)
+    tree = _build_tree(1, 2, 1, nodes, values)
+    leaves = tree.apply(np.array([[0], [1]], dtype=np.float32))
+    if not np.array_equal(leaves, [1, 2]):
+        return "a rebuilt tree gives leaves %s instead of [1 2]" % leaves
+    return None
+
+def tree_layout_error():
+    """
+    None if sklearn trees can be rebuilt from node arrays (by PackedForest
+    and binning.raw_thresholds), otherwise the reason.
+    """
+    global _layout_error, _layout_checked
+    if not _layout_checked:
+        try:
+            _layout_error = _check_layout()
+        except Exception as e:
+            _layout_error = "%s: %s" % (type(e).__name__, e)
+        _layout_checked = True
+    return _layout_error
+
+def check_tree_layout(what):
+    error = tree_layout_error()
+    if error is not None:
+        raise RuntimeError("%s is not supported with sklearn %s, whose "
+                           "trees cannot be rebuilt from node arrays: %s" %
+                           (what, sklearn.__version__, error))
+
+class PackedForest(object):
+    """
+    Trees of a forest classifier in flat node arrays. The nodes of tree t
+    are roots[t]..roots[t+1]-1 and children are global node indices. Leaves
+    point to themselves.
+
+    Input:
+        feature -- (n_nodes,) int32 split feature, 0 at the leaves.
+        threshold -- (n_nodes,) float32 split threshold, a voxel goes left if
+                     its feature value is <= threshold.
+        left, right -- (n_nodes,) int32 children.
+        value -- (n_nodes, n_classes) float32 class probabilities of the
+                 leaves.
+        roots -- (n_trees,) int32 root nodes.
+        max_depths -- (n_trees,) depths of the trees.
+        classes_ -- Class labels as in the sklearn model.
+    """
+    def __init__(self, feature, threshold, left, right, value, roots,
+                 max_depths, classes_, n_features, n_jobs=1,
+                 block_size=65536):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.max_depths = max_depths
+        self.classes_ = classes_
+        self.n_classes_ = len(classes_)
+        self.n_features_ = n_features
+        self.n_jobs = n_jobs
+        self.block_size = block_size
+        self._trees = None
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def _compiled_trees(self):
+        """
+        sklearn Tree objects rebuilt from the packed arrays, used for the
+        traversal only.
+        """
+        if self._trees is not None:
+            return self._trees
+        check_tree_layout('PackedForest')
+        ends = np.r_[self.roots[1:], len(self.feature)]
+        node_dtype = _node_dtype()
+        trees = []
+        for t, (b0, b1) in enumerate(zip(self.roots, ends)):
+            n = b1 - b0
+            ids = np.arange(b0, b1)
+            is_leaf = self.left[b0:b1] == ids
+            nodes = np.zeros(n, dtype=node_dtype)
+            nodes['left_child'] = np.where(is_leaf, -1, self.left[b0:b1] - b0)
+            nodes['right_child'] = np.where(is_leaf, -1, self.right[b0:b1] - b0)
+            nodes['feature'] = np.where(is_leaf, -2, self.feature[b0:b1])
+            nodes['threshold'] = np.where(is_leaf, -2, self.threshold[b0:b1])
+            nodes['n_node_samples'] = 1
+            nodes['weighted_n_node_samples'] = 1
+            trees.append(_build_tree(self.n_features_, self.n_classes_,
+                                     int(self.max_depths[t]), nodes,
+                                     self.value[b0:b1,np.newaxis,:]
+                                     .astype(np.float64)))
+        self._trees = trees
+        return trees
+
+    def compile(self):
+        """
+        Build the compiled trees now, e.g. before forking worker processes,
+        which then share them copy-on-write instead of each building its own.
+        """
+        self._compiled_trees()
+        return self
+
+    def _predict_block(self, x):
+        acc = np.zeros((x.shape[0], self.n_classes_), dtype=np.float32)
+        for root, tree in zip(self.roots, self._compiled_trees()):
+            acc += self.value.take(tree.apply(x) + root, axis=0)
+        return acc
+
+    def predict_proba(self, x, n_jobs=None):
+        """
+        Class probabilities of x, the mean of the leaf probabilities over
+        the trees as in sklearn, accumulated in float32.
+        """
+        assert x.ndim == 2 and x.shape[1] == self.n_features_, \
+                "Expected %d features" % self.n_features_
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+        if n_jobs is not None and n_jobs < 0:
+            n_jobs = cpu_count()
+        self._compiled_trees()
+        n = x.shape[0]
+        out = np.zeros((n, self.n_classes_), dtype=np.float32)
+        starts = range(0, n, self.block_size)
+
+        def run(b0):
+            b1 = min(b0 + self.block_size, n)
+            xb = np.ascontiguousarray(x[b0:b1], dtype=np.float32)
+            out[b0:b1] = self._predict_block(xb)
+
+        if n_jobs is not None and n_jobs > 1 and len(starts) > 1:
+            pool = ThreadPool(min(n_jobs, len(starts)))
+            try:
+                pool.map(run, starts)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for b0 in starts:
+                run(b0)
+        # Dividing the sums keeps e.g. 18 of 30 pure leaves exactly at 0.6
+        out /= self.n_trees
+        return out
+
+    def predict(self, x, n_jobs=None):
+        probs = self.predict_proba(x, n_jobs)
+        return self.classes_.take(np.argmax(probs, axis=1))
+
+def _float32_below(threshold):
+    """
+    Largest float32 values <= the float64 thresholds, so that comparing a
+    float32 feature against them gives the same result as sklearn, which
+    compares the float32 feature against the float64 threshold.
+    """
+    t32 = threshold.astype(np.float32)
+    over = t32.astype(np.float64) > threshold
+    t32[over] = np.nextafter(t32[over], np.float32(-np.inf))
+    return t32
+
+def pack_forest(model, n_jobs=None, block_size=65536):
+    """
+    Export a fitted sklearn RandomForestClassifier (or ExtraTreesClassifier)
+    with a single output into a PackedForest.
+    """
+    assert getattr(model, 'n_outputs_', 1) == 1, "Only single output forests"
+    t0 = time.time()
+    features = []
+    thresholds = []
+    lefts = []
+    rights = []
+    values = []
+    roots = []
+    max_depths = []
+    offset = 0
+    for est in model.estimators_:
+        tree = est.tree_
+        n = tree.node_count
+        is_leaf = tree.children_left < 0
+        node_ids = np.arange(offset, offset + n)
+        left = np.where(is_leaf, node_ids, tree.children_left + offset)
+        right = np.where(is_leaf, node_ids, tree.children_right + offset)
+        feature = np.where(is_leaf, 0, tree.feature)
+        threshold = _float32_below(tree.threshold)
+        threshold[is_leaf] = 0
+        value = tree.value[:,0,:].astype(np.float64)
+        value /= np.maximum(value.sum(axis=1), 1e-300)[:,np.newaxis]
+        features.append(feature.astype(np.int32))
+        thresholds.append(threshold)
+        lefts.append(left.astype(np.int32))
+        rights.append(right.astype(np.int32))
+        values.append(value.astype(np.float32))
+        roots.append(offset)
+        max_depths.append(tree.max_depth)
+        offset += n
+    if n_jobs is None:
+        n_jobs = getattr(model, 'n_jobs', 1)
+    packed = PackedForest(np.concatenate(features), np.concatenate(thresholds),
+                          np.concatenate(lefts), np.concatenate(rights),
+                          np.concatenate(values),
+                          np.asarray(roots, dtype=np.int32),
+                          np.asarray(max_depths, dtype=np.int32),
+                          model.classes_, model.n_features_, n_jobs, block_size)
+    print "Packed %d trees (%d nodes) in %.2f seconds." % \
+            (len(roots), offset, time.time()-t0)
+    return packed
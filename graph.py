@@ -0,0 +1,128 @@
+"""
+Voxel neighbourhood graphs for the MRF post-processing.
+"""
+import collections
+import hashlib
+
+import numpy as np
+import scipy.sparse
+
+import profiling
+
+def neighbour_offsets(connectivity=26):
+    """
+    Return the offsets of the positive half of the 6-, 18- or 26-neighbourhood
+    so that every undirected edge is generated exactly once.
+    """
+    if connectivity not in (6, 18, 26):
+        raise ValueError('Connectivity must be 6, 18, or 26')
+    max_l1 = {6: 1, 18: 2, 26: 3}[connectivity]
+    offsets = []
+    for i in range(-1,2):
+        for j in range(-1,2):
+            for k in range(-1,2):
+                o = (i, j, k)
+                if abs(i) + abs(j) + abs(k) > max_l1:
+                    continue
+                # Lexicographically positive offsets only
+                if o > (0, 0, 0):
+                    offsets.append(o)
+    return np.asarray(offsets, dtype=np.int64)
+
+def build_graph(coords, connectivity=26, method='auto'):
+    """
+    Build the neighbourhood graph of a set of voxels.
+
+    Input:
+        coords -- (n, 3) array of unique voxel coordinates.
+        connectivity -- 6, 18 or 26.
+        method -- 'dense' looks neighbours up from an index volume covering the
+                  bounding box of the voxels, 'sorted' uses searchsorted on the
+                  sorted linear indices. 'auto' picks 'dense' unless the
+                  bounding box is very sparsely filled.
+
+    Output:
+        edges -- (n_edges, 2) int32 array, each undirected edge once.
+        adj -- Symmetric (n, n) scipy.sparse CSR adjacency matrix.
+    """
+    coords = np.asarray(coords, dtype=np.int64)
+    n = coords.shape[0]
+    offsets = neighbour_offsets(connectivity)
+    if n == 0:
+        edges = np.zeros((0,2), dtype=np.int32)
+        return edges, scipy.sparse.csr_matrix((0,0), dtype=np.int8)
+
+    origin = coords.min(axis=0)
+    local = coords - origin
+    shape = tuple(local.max(axis=0) + 1)
+    lin = np.ravel_multi_index((local[:,0], local[:,1], local[:,2]), shape)
+    n_cells = np.prod(shape)
+    if method == 'auto':
+        method = 'dense' if n_cells <= 64 * n else 'sorted'
+
+    if method == 'dense':
+        index_vol = np.empty(n_cells, dtype=np.int32)
+        index_vol.fill(-1)
+        index_vol[lin] = np.arange(n, dtype=np.int32)
+        assert np.sum(index_vol >= 0) == n, "Same coordinate appearing twice"
+    elif method == 'sorted':
+        order = np.argsort(lin, kind='mergesort')
+        sorted_lin = lin[order]
+        assert not np.any(sorted_lin[1:] == sorted_lin[:-1]), \
+                "Same coordinate appearing twice"
+    else:
+        raise ValueError("Method must be 'auto', 'dense', or 'sorted'")
+
+    sources = []
+    targets = []
+    all_idxs = np.arange(n, dtype=np.int32)
+    for o in offsets:
+        neigh = local + o
+        valid = np.all((neigh >= 0) & (neigh < shape), axis=1)
+        neigh = neigh[valid]
+        neigh_lin = np.ravel_multi_index((neigh[:,0], neigh[:,1], neigh[:,2]),
+                                         shape)
+        if method == 'dense':
+            target = index_vol[neigh_lin]
+            found = target >= 0
+        else:
+            pos = np.searchsorted(sorted_lin, neigh_lin)
+            pos[pos == n] = n - 1
+            found = sorted_lin[pos] == neigh_lin
+            target = order[pos]
+        sources.append(all_idxs[valid][found])
+        targets.append(target[found].astype(np.int32))
+    edges = np.column_stack((np.concatenate(sources),
+                             np.concatenate(targets))).astype(np.int32)
+
+    data = np.ones(2*len(edges), dtype=np.int8)
+    rows = np.concatenate((edges[:,0], edges[:,1]))
+    cols = np.concatenate((edges[:,1], edges[:,0]))
+    adj = scipy.sparse.csr_matrix((data, (rows, cols)), shape=(n,n))
+    return edges, adj
+
+# Graphs of the most recently used (patient, tumor mask) pairs
+_graph_cache = collections.OrderedDict()
+_max_cached = 8
+
+def tumor_graph(patient, coord, mask, connectivity=26):
+    """
+    Return the (edges, adj) graph of the voxels coord[mask]. Graphs are
+    memoized per patient and tumor mask, so evaluating several potentials or
+    settings on the same tumor builds the graph only once.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    digest = hashlib.sha1(np.packbits(mask).tostring()).hexdigest()
+    key = (patient, len(mask), digest, connectivity)
+    if key in _graph_cache:
+        graph = _graph_cache.pop(key)
+        _graph_cache[key] = graph
+        return graph
+    st = profiling.start('create_graph', np.count_nonzero(mask))
+    graph = build_graph(coord[mask,:], connectivity)
+    print "Graph creation took %.2f seconds (%d edges)." % (st.stop(),
+                                                            len(graph[0]))
+    _graph_cache[key] = graph
+    if len(_graph_cache) > _max_cached:
+        _graph_cache.popitem(last=False)
+    return graph
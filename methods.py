@@ -1,10 +1,10 @@
-from evaluation import dice_scores
+from evaluation import dice_scores, confusion_matrix, confusion_matrices
+from sweep import CandidateSweep
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.ensemble import ExtraTreesClassifier
 from sklearn.linear_model import PassiveAggressiveClassifier
 from sklearn import svm
-from sklearn.metrics import confusion_matrix
 from sklearn.externals import joblib
 import time
 import os
@@ -13,13 +13,33 @@ import matplotlib.pyplot as plt
 
 import patient_plotting as pp
 import extras
+import binning
+import cascade
 import data_processing as dp
+import forest
+import model_store
+import morphology
+import profiling
+import graph
+import pipeline
+import prob_cache
+import streaming
+import tuning
 from experiments import seed
 
+# Candidate hyperparameters of the dev set tuning
+closing_radii = [1,2,3,4,5,6,7,8,9,10]
+#thresholds = [0.25, 0.35, 0.4, 0.45, 0.5, 0.6]
+thresholds = [0.55, 0.57, 0.58, 0.59, 0.6, 0.61, 0.62, 0.63, 0.65]
+
 def predict_two_stage(train_pats, test_pats, fscores=None,
                       do_plot_predictions=False, stratified=False, n_trees=30,
                       dev_pats=[], use_mrf=True, resolution=1, n_voxels=30000,
-                      mat_dir=None, fresh_models=False, load_hog=False):
+                      mat_dir=None, fresh_models=False, load_hog=False,
+                      n_workers=1, model_tag='', seed=seed, prune_after=None,
+                      tuning_mode='separate', packed_forest=True,
+                      cascade_stride=None, memory_budget=None,
+                      trees_per_chunk=5, n_bins=None, block_size=None):
     """
     Predict tumor voxels for given test patients.
 
@@ -27,83 +47,129 @@ def predict_two_stage(train_pats, test_pats, fscores=None,
         train_pats -- list of patient IDs used for training a model.
         test_pats -- list of patient IDs used for testing a model.
         fscores -- An opened output file to which we write the results.
+        n_workers -- Number of processes evaluating test patients in
+                     parallel (see pipeline.imap_patients).
+        model_tag -- Suffix of the model file names, e.g. the CV fold.
+        seed -- Random seed the models are trained with, part of their keys.
+        prune_after -- Number of dev patients after which clearly dominated
+                       hyperparameter candidates are dropped (see
+                       sweep.CandidateSweep), None to evaluate all of them.
+        tuning_mode -- 'separate' tunes the MRF potential, the closing radius
+                       and the threshold one after the other, 'grid' and
+                       'halving' tune them jointly (see tuning.tune_two_stage).
+        packed_forest -- Keep the models in model_store as packed forests
+                         (see forest.PackedForest), otherwise as joblib
+                         files of the sklearn models.
+        cascade_stride -- Run the first stage coarse-to-fine on every
+                          cascade_stride-th voxel first (see cascade.py),
+                          None to run it on all voxels. The speedup and dice
+                          loss are reported on the dev patients.
+        memory_budget -- If given, the forests are grown trees_per_chunk
+                         trees at a time, each chunk fit on a new sample of
+                         memory_budget bytes from all voxels of the training
+                         patients (see streaming.py), instead of on n_voxels
+                         voxels per patient.
+        n_bins -- If given, the forests are trained on the features
+                  quantized into n_bins quantile bins (see binning.py). Not
+                  supported with a memory_budget.
+        block_size -- If given, the test patients are streamed through the
+                      forests block_size voxels at a time and their
+                      probabilities kept in memmaps (see chunked.py).
+
+    Output:
+        Dictionary with the mean dice scores (whole, core, active) before
+        ('dice_no_pp') and after ('dice') the final post-processing.
     """
-    model_str = ""
+    if memory_budget is not None and n_bins is not None:
+        raise ValueError('Binned features are not supported with a memory budget')
+    if n_bins is not None:
+        # Fail before training rather than in binning.raw_thresholds
+        forest.check_tree_layout('Binned training')
+    if packed_forest and forest.tree_layout_error() is not None:
+        print "Packed forests are not supported (%s), using the sklearn models." % \
+                forest.tree_layout_error()
+        packed_forest = False
+    model_str = model_tag
     if resolution != 1:
         model_str += '_res%d' % resolution
     if load_hog:
         model_str += '_hog'
+    if memory_budget is not None:
+        # Trained on streamed samples instead of n_voxels per patient
+        model_str += '_mem%d_tpc%d' % (memory_budget, trees_per_chunk)
+    if n_bins is not None:
+        # Thresholds rewritten from bin codes, see binning.raw_thresholds
+        model_str += '_bins%d' % n_bins
     model1_fname = os.path.join('models', 'model1_seed%d_ntrp%d_ntep%d_ntrees%d_nvox%s%s.jl' %
                                 (seed, len(train_pats), len(test_pats), n_trees, n_voxels, model_str))
     model2_fname = os.path.join('models', 'model2_seed%d_ntrp%d_ntep%d_ntrees%d_nvox%s%s.jl' %
                                 (seed, len(train_pats), len(test_pats), n_trees, n_voxels, model_str))
 
-    # Load models if available
-    if not fresh_models and os.path.isfile(model1_fname) and \
-            os.path.isfile(model2_fname):
-        model1 = joblib.load(model1_fname)
-        model2 = joblib.load(model2_fname)
-        min_voxels = 3000
+    # Compute minimum number of tumor voxels in a train patient
+    min_voxels = 3000#get_min_voxels(ytr, patient_idxs_tr)
+    print "Minimum number of voxels in a tumor: %d" % min_voxels
+
+    if packed_forest:
+        # Packed models in the store, keyed by the training configuration
+        extra = {}
+        if memory_budget is not None:
+            extra = {'memory_budget': memory_budget,
+                     'trees_per_chunk': trees_per_chunk}
+        elif n_bins is not None:
+            extra = {'n_bins': n_bins}
+        configs = [model_store.training_config(
+                       stage, seed, train_pats, n_trees, n_voxels, stratified,
+                       resolution, load_hog, **extra) for stage in (1, 2)]
+        keys = [model_store.config_key(c) for c in configs]
+        if fresh_models or not all(model_store.exists(k) for k in keys):
+            models = train_two_stage_models(
+                    train_pats, stratified, n_trees, n_voxels, resolution,
+                    load_hog, memory_budget=memory_budget,
+                    trees_per_chunk=trees_per_chunk, n_bins=n_bins)
+            for key, config, model in zip(keys, configs, models):
+                model_store.save(key, forest.pack_forest(model), config)
+        # Opened on the first prediction
+        model1, model2 = [model_store.LazyForest(k) for k in keys]
+        # Probabilities are cached under the digests of the stored arrays
+        prob_cache.register_model(model1, digest=model1.digest)
+        prob_cache.register_model(model2, digest=model2.digest)
+        worker_models = [model1, model2]
     else:
-        xtr, ytr, coordtr, patient_idxs_tr, dims_tr = dp.load_patients(
-                train_pats, stratified, resolution=resolution,
-                n_voxels=n_voxels, load_hog=load_hog)
-
-        # Make all tumor labels equal to 1 and train the first model
-        ytr1 = np.array(ytr, copy=True)
-        ytr1[ytr1>0] = 1
-        if stratified:
-            # Class frequencies in the whole dataset
-            class_counts = [dp.class_counts[0], sum(dp.class_counts[1:])]
-            class_freqs = np.asarray(class_counts) / float(sum(class_counts))
-            print "Class frequencies (model 1):", class_freqs*100
-            # Class frequencies in the sample
-            sample_counts = np.histogram(ytr, [0,1,5])[0]
-            sample_freqs = sample_counts / float(sum(sample_counts))
-            print "Sample frequencies:", sample_freqs*100
-            weights = np.ones(len(ytr))
-            for i in range(2):
-                weights[ytr==i] = class_freqs[i] / sample_freqs[i]
-        else:
-            weights = None
-        model1 = train_RF_model(xtr, ytr1, n_trees=n_trees,
-                                sample_weight=weights, fname=model1_fname)
-
-        # Compute minimum number of tumor voxels in a train patient
-        min_voxels = 3000#get_min_voxels(ytr, patient_idxs_tr)
-        print "Minimum number of voxels in a tumor: %d" % min_voxels
-
-        # Train the second model to separate tumor classes
-        ok_idxs = ytr > 0
-        xtr2 = np.asarray(xtr[ok_idxs,:])
-        ytr2 = np.asarray(ytr[ok_idxs])
-        if stratified:
-            # Class frequencies in the whole dataset
-            class_counts = dp.class_counts[1:]
-            class_freqs = np.asarray(class_counts) / float(sum(class_counts))
-            print "Class frequencies (model 2):", class_freqs*100
-            # Class frequencies in the sample
-            sample_counts = np.histogram(ytr, range(1,6))[0]
-            sample_freqs = sample_counts / float(sum(sample_counts))
-            print "Sample frequencies:", sample_freqs*100
-            weights = np.ones(len(ytr2))
-            for i in range(4):
-                weights[ytr2==i+1] = class_freqs[i] / sample_freqs[i]
+        # Load models if available
+        if not fresh_models and os.path.isfile(model1_fname) and \
+                os.path.isfile(model2_fname):
+            model1 = joblib.load(model1_fname)
+            model2 = joblib.load(model2_fname)
         else:
-            weights = None
-        model2 = train_RF_model(xtr2, ytr2, n_trees=n_trees,
-                                sample_weight=weights, fname=model2_fname)
+            model1, model2 = train_two_stage_models(
+                    train_pats, stratified, n_trees, n_voxels, resolution,
+                    load_hog, model1_fname, model2_fname, memory_budget,
+                    trees_per_chunk, n_bins)
+        # Probabilities are cached under the digests of the model files
+        prob_cache.register_model(model1, model1_fname)
+        prob_cache.register_model(model2, model2_fname)
+        worker_models = [model1_fname, model2_fname]
 
     print "\n----------------------------------\n"
 
-    if len(dev_pats) > 0:
+    if len(dev_pats) > 0 and tuning_mode in ('grid', 'halving'):
+        potentials = mrf_potentials() if use_mrf else [None]
+        best_th, best_radius, best_potential = tuning.tune_two_stage(
+                dev_pats, model1, model2, thresholds, closing_radii,
+                potentials, min_voxels=min_voxels, resolution=resolution,
+                load_hog=load_hog, n_workers=n_workers,
+                halving=tuning_mode == 'halving', fscores=fscores)
+    elif len(dev_pats) > 0:
         best_potential = optimize_potential(
                 dev_pats, model1, model2, stratified, fscores,
-                do_plot_predictions, resolution=resolution, load_hog=load_hog)
+                do_plot_predictions, resolution=resolution, load_hog=load_hog,
+                prune_after=prune_after)
         best_radius = optimize_closing(dev_pats, model1, stratified, fscores,
-                                       resolution=resolution, load_hog=load_hog)
+                                       resolution=resolution, load_hog=load_hog,
+                                       prune_after=prune_after)
         best_th = optimize_threshold1(dev_pats, model1, stratified, fscores,
-                                      resolution, load_hog, best_radius)
+                                      resolution, load_hog, best_radius,
+                                      prune_after=prune_after)
     else:
         best_radius = 6
         best_th = 0.6
@@ -113,95 +179,251 @@ def predict_two_stage(train_pats, test_pats, fscores=None,
                                    [0.02222222, 0., 0.03555556, 0.04]])
 
 
-    yte = np.zeros(0)
-    predte = np.zeros(0)
-    predte_no_pp = np.zeros(0)
-    patient_idxs_te = [0]
+    if morphology.se_mode == 'decomposed' and len(dev_pats) > 0:
+        compare_se_modes(dev_pats, model1, fscores=fscores,
+                         resolution=resolution, load_hog=load_hog)
+
+    if cascade_stride is not None and len(dev_pats) > 0:
+        cascade.compare_cascade(dev_pats, model1, best_th, best_radius,
+                                min_voxels, [cascade_stride],
+                                resolution=resolution, load_hog=load_hog,
+                                fscores=fscores)
+
+    params = dict(best_th=best_th, best_radius=best_radius,
+                  best_potential=best_potential, min_voxels=min_voxels,
+                  use_mrf=use_mrf, resolution=resolution, load_hog=load_hog,
+                  do_plot_predictions=do_plot_predictions, mat_dir=mat_dir,
+                  cascade_stride=cascade_stride, block_size=block_size)
     print "Test users:"
+    if n_workers > 1:
+        # Patients in parallel, models loaded once per worker
+        results = pipeline.imap_patients(
+                predict_patient_two_stage, test_pats,
+                worker_models, n_workers, **params)
+    else:
+        results = (predict_patient_two_stage(te_pat, model1, model2,
+                                             data=data, **params)
+                   for te_pat, data in dp.iter_patients(
+                       test_pats, n_voxels=None, resolution=resolution,
+                       load_hog=load_hog))
+
     # Iterate over test users
-    for te_idx, te_pat in enumerate(test_pats):
-        print "Test patient number %d" % (te_idx+1)
-        x, y, coord, dim = dp.load_patient(te_pat, n_voxels=None,
-                                           resolution=resolution,
-                                           load_hog=load_hog)
-
-        #pred = model1.predict(x)
-        pred_probs = model1.predict_proba(x)
-        #pred = np.argmax(pred_probs, axis=1)
-        pred = pred_probs[:,1] >= best_th
-        # If the predicted tumor is too small set the most probable tumor
-        # voxels to one
-        if sum(pred > 0) < min_voxels:
-            print "Patient having too few voxels (%d < %d)" % (sum(pred > 0), min_voxels)
-            pred = np.zeros(pred.shape)
-            new_idxs = np.argsort(pred_probs[:,1])[-min_voxels:]
-            pred[new_idxs] = 1
-        pp_pred = dp.post_process(coord, dim, pred, binary_closing=True,
-                                  radius=best_radius)
+    ys = []
+    preds = []
+    preds_no_pp = []
+    patient_idxs_te = [0]
+    for te_idx, (y, pp_pred15, pp_pred) in enumerate(results):
+        print "Test patient number %d done." % (te_idx+1)
+        ys.append(y)
+        preds.append(pp_pred)
+        preds_no_pp.append(pp_pred15)
+        patient_idxs_te.append(patient_idxs_te[-1] + len(y))
+    yte = np.concatenate(ys)
+    predte = np.concatenate(preds)
+    predte_no_pp = np.concatenate(preds_no_pp)
 
-        tumor_idxs = pp_pred > 0
-        if sum(tumor_idxs) > 0:
-            pred_probs2 = model2.predict_proba(x[tumor_idxs,:])
-            pred2 = np.argmax(pred_probs2, axis=1) + 1
-            pp_pred[tumor_idxs] = pred2
+    print "\nOverall confusion matrix:"
+    cms = confusion_matrices(yte, predte, patient_idxs_te)
+    print cms.sum(axis=0)
+
+    ds_no_pp = dice_scores(yte, predte_no_pp, patient_idxs=patient_idxs_te,
+                           label='Overall dice scores (two-stage, no pp):',
+                           fscores=fscores)
+
+    ds = dice_scores(yte, predte, patient_idxs=patient_idxs_te,
+                     label='Overall dice scores (two-stage):', fscores=fscores,
+                     cms=cms)
+    return {'dice_no_pp': list(ds_no_pp), 'dice': list(ds)}
+
+def train_two_stage_models(train_pats, stratified, n_trees, n_voxels,
+                           resolution=1, load_hog=False, model1_fname=None,
+                           model2_fname=None, memory_budget=None,
+                           trees_per_chunk=5, n_bins=None):
+    """
+    Train the tumor/background model and the tumor class model.
 
-        pp_pred15 = np.array(pp_pred)
-        print "\nConfusion matrix:"
-        cm = confusion_matrix(y, pp_pred15)
-        print cm
-        dice_scores(y, pp_pred15, label='Dice scores:')
-
-        if use_mrf:
-            # MRF post processing
-            if sum(tumor_idxs) > 0:
-                edges = dp.create_graph(coord[tumor_idxs,:])
-                pp_pred[tumor_idxs] = dp.mrf(pred_probs2, edges,
-                                             potential=best_potential) + 1
-            method = 'MRF'
-        else:
-            # Closing post processing
-            if sum(tumor_idxs) > 0:
-                pp_pred[tumor_idxs] = dp.post_process(coord[tumor_idxs,:], dim,
-                                                      pred2, remove_components=False,
-                                                      radius=best_radius)
-            method = 'closing'
-
-        print "\nConfusion matrix (pp):"
-        cm = confusion_matrix(y, pp_pred)
-        print cm
+    Output:
+        model1, model2
+    """
+    if memory_budget is not None and n_bins is not None:
+        raise ValueError('Binned features are not supported with a memory budget')
+    if memory_budget is not None:
+        model1 = streaming.train_forest(
+                train_pats, range(5), n_trees, trees_per_chunk, memory_budget,
+                stratified, binary=True, resolution=resolution,
+                load_hog=load_hog)
+        model2 = streaming.train_forest(
+                train_pats, range(1,5), n_trees, trees_per_chunk,
+                memory_budget, stratified, resolution=resolution,
+                load_hog=load_hog)
+        for model, fname in [(model1, model1_fname), (model2, model2_fname)]:
+            if fname is not None:
+                joblib.dump(model, fname)
+        return model1, model2
+
+    binner = None
+    if n_bins is not None:
+        binner = binning.fit_binner(train_pats, n_bins, resolution=resolution,
+                                    load_hog=load_hog)
+    xtr, ytr, coordtr, patient_idxs_tr, dims_tr = dp.load_patients(
+            train_pats, stratified, resolution=resolution,
+            n_voxels=n_voxels, load_hog=load_hog, binner=binner)
+
+    # Make all tumor labels equal to 1 and train the first model
+    ytr1 = np.array(ytr, copy=True)
+    ytr1[ytr1>0] = 1
+    if stratified:
+        # Class frequencies in the whole dataset
+        class_counts = [dp.class_counts[0], sum(dp.class_counts[1:])]
+        class_freqs = np.asarray(class_counts) / float(sum(class_counts))
+        print "Class frequencies (model 1):", class_freqs*100
+        # Class frequencies in the sample
+        sample_counts = np.histogram(ytr, [0,1,5])[0]
+        sample_freqs = sample_counts / float(sum(sample_counts))
+        print "Sample frequencies:", sample_freqs*100
+        weights = np.ones(len(ytr))
+        for i in range(2):
+            weights[ytr==i] = class_freqs[i] / sample_freqs[i]
+    else:
+        weights = None
+    model1 = train_RF_model(xtr, ytr1, n_trees=n_trees,
+                            sample_weight=weights, fname=model1_fname)
 
-        yte = np.concatenate((yte, y))
-        patient_idxs_te.append(len(yte))
-        predte = np.concatenate((predte, pp_pred))
-        predte_no_pp = np.concatenate((predte_no_pp, pp_pred15))
+    # Train the second model to separate tumor classes
+    ok_idxs = ytr > 0
+    xtr2 = np.asarray(xtr[ok_idxs,:])
+    ytr2 = np.asarray(ytr[ok_idxs])
+    if stratified:
+        # Class frequencies in the whole dataset
+        class_counts = dp.class_counts[1:]
+        class_freqs = np.asarray(class_counts) / float(sum(class_counts))
+        print "Class frequencies (model 2):", class_freqs*100
+        # Class frequencies in the sample
+        sample_counts = np.histogram(ytr, range(1,6))[0]
+        sample_freqs = sample_counts / float(sum(sample_counts))
+        print "Sample frequencies:", sample_freqs*100
+        weights = np.ones(len(ytr2))
+        for i in range(4):
+            weights[ytr2==i+1] = class_freqs[i] / sample_freqs[i]
+    else:
+        weights = None
+    model2 = train_RF_model(xtr2, ytr2, n_trees=n_trees,
+                            sample_weight=weights, fname=model2_fname)
+    if binner is not None:
+        # Back to thresholds on the raw features
+        for model, fname in [(model1, model1_fname), (model2, model2_fname)]:
+            binning.raw_thresholds(model, binner)
+            if fname is not None:
+                joblib.dump(model, fname)
+    return model1, model2
+
+def predict_patient_two_stage(te_pat, model1, model2, data=None, best_th=0.6,
+                              best_radius=6, best_potential=None,
+                              min_voxels=3000, use_mrf=True, resolution=1,
+                              load_hog=False, do_plot_predictions=False,
+                              mat_dir=None, cascade_stride=None,
+                              block_size=None):
+    """
+    Run the two-stage pipeline for one test patient.
+
+    Input:
+        data -- (x, y, coord, dim) of the patient, loaded if None.
 
-        dice_scores(y, pp_pred, label='Dice scores (pp):')
+    Output:
+        y -- Ground truth labels.
+        pp_pred15 -- Prediction of the two stages before smoothing.
+        pp_pred -- Final prediction.
+    """
+    print "Test patient %d" % te_pat
+    profiling.set_patient(te_pat)
+    st_patient = profiling.start('predict_patient')
+    if data is None:
+        data = dp.load_patient(te_pat, n_voxels=None, resolution=resolution,
+                               load_hog=load_hog)
+    x, y, coord, dim = data
+    st_patient.n_voxels = len(y)
+
+    #pred = model1.predict(x)
+    st = profiling.start('stage1_inference', len(y))
+    if cascade_stride is not None:
+        pred_probs = cascade.predict_proba(model1, x, coord, dim,
+                                           cascade_stride, patient=te_pat,
+                                           resolution=resolution,
+                                           load_hog=load_hog,
+                                           block_size=block_size)[0]
+    else:
+        pred_probs = prob_cache.predict_proba(model1, x, te_pat,
+                                              resolution=resolution,
+                                              load_hog=load_hog,
+                                              block_size=block_size)
+    st.stop()
+    #pred = np.argmax(pred_probs, axis=1)
+    # If the predicted tumor is too small set the most probable tumor
+    # voxels to one
+    pred = tuning.stage1_prediction(pred_probs[:,1], best_th, min_voxels)
+    pp_pred = dp.post_process(coord, dim, pred, binary_closing=True,
+                              radius=best_radius)
+
+    tumor_idxs = pp_pred > 0
+    if sum(tumor_idxs) > 0:
+        st = profiling.start('stage2_inference', np.count_nonzero(tumor_idxs))
+        pred_probs2 = prob_cache.predict_proba(model2, x, te_pat,
+                                               rows=tumor_idxs,
+                                               resolution=resolution,
+                                               load_hog=load_hog,
+                                               block_size=block_size)
+        st.stop()
+        pred2 = np.argmax(pred_probs2, axis=1) + 1
+        pp_pred[tumor_idxs] = pred2
 
-        if do_plot_predictions:
-            # Plot the patient
-            pif = os.path.join('results', 'pat%d_slices_2S_%s.png' % (te_pat, method))
-            if mat_dir is not None:
-                fmat = os.path.join(mat_dir, 'pat%d.mat' % te_pat)
-            else:
-                fmat = None
-            pp.plot_predictions(coord, dim, pp_pred15, y, pp_pred, fname=pif,
-                                fmat=fmat)
-            #if pred_fname is not None:
-            #    extras.save_predictions(coord, dim_list[0], pred, yte, pred_fname)
+    pp_pred15 = np.array(pp_pred)
+    print "\nConfusion matrix:"
+    cm = confusion_matrix(y, pp_pred15)
+    print cm
+    dice_scores(y, pp_pred15, label='Dice scores:', cms=cm[np.newaxis])
 
-    print "\nOverall confusion matrix:"
-    cm = confusion_matrix(yte, predte)
+    if use_mrf:
+        # MRF post processing
+        if sum(tumor_idxs) > 0:
+            edges, adj = graph.tumor_graph(te_pat, coord, tumor_idxs)
+            pp_pred[tumor_idxs] = dp.mrf(pred_probs2, edges,
+                                         potential=best_potential, adj=adj,
+                                         coord=coord[tumor_idxs]) + 1
+        method = 'MRF'
+    else:
+        # Closing post processing
+        if sum(tumor_idxs) > 0:
+            pp_pred[tumor_idxs] = dp.post_process(coord[tumor_idxs,:], dim,
+                                                  pred2, remove_components=False,
+                                                  radius=best_radius)
+        method = 'closing'
+
+    print "\nConfusion matrix (pp):"
+    cm = confusion_matrix(y, pp_pred)
     print cm
 
-    dice_scores(yte, predte_no_pp, patient_idxs=patient_idxs_te,
-                label='Overall dice scores (two-stage, no pp):', fscores=fscores)
+    dice_scores(y, pp_pred, label='Dice scores (pp):', cms=cm[np.newaxis])
 
-    dice_scores(yte, predte, patient_idxs=patient_idxs_te,
-                label='Overall dice scores (two-stage):', fscores=fscores)
+    if do_plot_predictions:
+        # Plot the patient
+        pif = os.path.join('results', 'pat%d_slices_2S_%s.png' % (te_pat, method))
+        if mat_dir is not None:
+            fmat = os.path.join(mat_dir, 'pat%d.mat' % te_pat)
+        else:
+            fmat = None
+        pp.plot_predictions(coord, dim, pp_pred15, y, pp_pred, fname=pif,
+                            fmat=fmat)
+        #if pred_fname is not None:
+        #    extras.save_predictions(coord, dim_list[0], pred, yte, pred_fname)
+
+    st_patient.stop()
+    profiling.set_patient(None)
+    return np.asarray(y, dtype=np.int8), np.asarray(pp_pred15, dtype=np.int8), \
+           np.asarray(pp_pred, dtype=np.int8)
 
 def train_RF_model(xtr, ytr, n_trees=30, sample_weight=None, fname=None):
     # Train classifier
-    t0 = time.time()
+    st = profiling.start('train_RF_model', len(ytr))
     model = RandomForestClassifier(n_trees, oob_score=True, verbose=1,
                                    n_jobs=16)#, class_weight='auto')
     #model = ExtraTreesClassifier(n_trees, verbose=1, n_jobs=4)
@@ -209,7 +431,7 @@ def train_RF_model(xtr, ytr, n_trees=30, sample_weight=None, fname=None):
     model.fit(xtr, ytr, sample_weight=sample_weight)
     if fname is not None:
         joblib.dump(model, fname)
-    print "Training/loading took %.2f seconds" % (time.time()-t0)
+    print "Training/loading took %.2f seconds" % st.stop()
     #print "OOB score: %.2f%%" % (model.oob_score_*100)
     '''
     print "Feature importances:"
@@ -221,107 +443,139 @@ def train_RF_model(xtr, ytr, n_trees=30, sample_weight=None, fname=None):
     print model.feature_importances_[best_feats]
     return model
 
+def report_sweep(sweep, labels, fscores=None):
+    """
+    Print the overall confusion matrix and dice scores of every candidate of
+    a sweep.CandidateSweep and return the index of the best one.
+
+    Input:
+        labels -- Label of each candidate, e.g. 'r=3'.
+    """
+    for i, label in enumerate(labels):
+        cms = sweep.patient_cms(i)
+        if len(cms) == 0:
+            continue
+        if not sweep.active[i]:
+            label += ', dropped after %d patients' % len(cms)
+        print "\nOverall confusion matrix (%s):" % label
+        print cms.sum(axis=0)
+        dice_scores(None, None, label='Overall dice scores (two-stage, %s):' % label,
+                    fscores=fscores, cms=cms)
+    return sweep.best()
+
 def optimize_closing(dev_pats, model1, stratified, fscores=None, resolution=1,
-                     load_hog=False):
-    radii = [1,2,3,4,5,6,7,8,9,10]
-    nr = len(radii)
-
-    yde = np.zeros(0)
-    predde = np.zeros((0, nr))
-    predde_no_pp = np.zeros(0)
-    patient_idxs_de = [0]
+                     load_hog=False, prune_after=None, se_mode=None):
+    radii = closing_radii
+
+    # Only running confusion matrices are kept per candidate
+    sweep = CandidateSweep(radii, prune_after=prune_after)
+    sweep_no_pp = CandidateSweep(['no closing'])
     print "Development users:"
     # Iterate over dev users
-    for de_idx, de_pat in enumerate(dev_pats):
+    for de_idx, (de_pat, (x, y, coord, dim)) in enumerate(dp.iter_patients(
+            dev_pats, n_voxels=None, resolution=resolution,
+            load_hog=load_hog)):
         print "Development patient number %d" % (de_idx+1)
-        x, y, coord, dim = dp.load_patient(de_pat, n_voxels=None,
-                                           resolution=resolution,
-                                           load_hog=load_hog)
-        yde = np.concatenate((yde, y))
-        patient_idxs_de.append(len(yde))
 
-        pred = model1.predict(x)
-        dice_scores(y, pred, label='Dice scores (dev, no closing):')
+        pred = prob_cache.predict(model1, x, de_pat, resolution=resolution,
+                                  load_hog=load_hog)
+        cms = sweep_no_pp.add_patient(y, pred)
+        dice_scores(y, pred, label='Dice scores (dev, no closing):', cms=cms)
 
-        predde_no_pp = np.concatenate((predde_no_pp, pred))
+        idxs = sweep.active_idxs()
         predde_part = dp.post_process_multi_radii(
-                coord, dim, pred, radii, y, remove_components=True,
-                binary_closing=True)
-        predde = np.vstack((predde, predde_part))
-
-    dice_scores(yde, predde_no_pp, patient_idxs=patient_idxs_de,
-                label='Overall dice scores (two-stage, no MRF):', fscores=fscores)
-
-    best_r = radii[0]
-    best_score = -1
-    for i in range(nr):
-        print "\nOverall confusion matrix (r=%d):" % radii[i]
-        cm = confusion_matrix(yde, predde[:,i])
-        print cm
+                coord, dim, pred, [radii[i] for i in idxs], y,
+                remove_components=True, binary_closing=True, se_mode=se_mode)
+        sweep.add_patient(y, predde_part, idxs)
+
+    dice_scores(None, None, label='Overall dice scores (two-stage, no MRF):',
+                fscores=fscores, cms=sweep_no_pp.patient_cms(0))
 
-        ds = dice_scores(yde, predde[:,i], patient_idxs=patient_idxs_de,
-                         label='Overall dice scores (two-stage, r=%d):' % radii[i],
-                         fscores=fscores)
-        score = sum(ds)
-        if score > best_score:
-            best_score = score
-            best_r = radii[i]
+    best = report_sweep(sweep, ['r=%d' % r for r in radii], fscores)
+    best_r = radii[best]
+    best_score = sum(sweep.mean_dice()[best])
     print "Best r=%d, score=%f:" % (best_r, best_score)
     return best_r
 
+def compare_se_modes(dev_pats, model1, radii=closing_radii, fscores=None,
+                     resolution=1, load_hog=False):
+    """
+    Report for every closing radius the whole tumor dice of the first stage
+    on the dev patients with the exact ball and with its decomposition (see
+    morphology.ball_decomposition), and the time of the closings.
+    """
+    modes = ['exact', 'decomposed']
+    sweeps = dict((mode, CandidateSweep(radii)) for mode in modes)
+    seconds = dict((mode, 0.0) for mode in modes)
+    for de_pat, (x, y, coord, dim) in dp.iter_patients(
+            dev_pats, n_voxels=None, resolution=resolution,
+            load_hog=load_hog):
+        pred = prob_cache.predict(model1, x, de_pat, resolution=resolution,
+                                  load_hog=load_hog)
+        for mode in modes:
+            t0 = time.time()
+            preds = dp.post_process_multi_radii(coord, dim, pred, radii,
+                                                remove_components=True,
+                                                binary_closing=True,
+                                                se_mode=mode)
+            seconds[mode] += time.time() - t0
+            sweeps[mode].add_patient(y, preds)
+
+    s = "\nExact against decomposed ball (%.2f s, %.2f s):\n" % \
+            (seconds['exact'], seconds['decomposed'])
+    s += "r\tElements (6/18/26)\tWhole tumor dice (exact, decomposed, loss)\n"
+    d_exact = sweeps['exact'].mean_dice()[:,0]
+    d_dec = sweeps['decomposed'].mean_dice()[:,0]
+    for i, r in enumerate(radii):
+        s += "%d\t%d/%d/%d\t\t%.4f\t%.4f\t%.4f\n" % \
+                ((r,) + morphology.ball_decomposition(r) +
+                 (d_exact[i], d_dec[i], d_exact[i] - d_dec[i]))
+    print s
+    if fscores is not None:
+        fscores.write(s)
+    return d_exact, d_dec
+
 def optimize_threshold1(dev_pats, model1, stratified, fscores=None, resolution=1,
-                        load_hog=False, best_radius=3):
-    #ths = [0.25, 0.35, 0.4, 0.45, 0.5, 0.6]
-    ths = [0.55, 0.57, 0.58, 0.59, 0.6, 0.61, 0.62, 0.63, 0.65]
-    nt = len(ths)
+                        load_hog=False, best_radius=3, prune_after=None):
+    ths = thresholds
 
-    yde = np.zeros(0)
-    preds = []
-    for i in range(nt):
-        preds.append(np.zeros(0))
-    patient_idxs_de = [0]
+    sweep = CandidateSweep(ths, prune_after=prune_after)
     print "Development users:"
     # Iterate over dev users
-    for de_idx, de_pat in enumerate(dev_pats):
+    for de_idx, (de_pat, (x, y, coord, dim)) in enumerate(dp.iter_patients(
+            dev_pats, n_voxels=None, resolution=resolution,
+            load_hog=load_hog)):
         print "Development patient number %d" % (de_idx+1)
-        x, y, coord, dim = dp.load_patient(de_pat, n_voxels=None,
-                                           resolution=resolution,
-                                           load_hog=load_hog)
-        yde = np.concatenate((yde, y))
-        patient_idxs_de.append(len(yde))
 
-        pred_probs = model1.predict_proba(x)
-        for i in range(nt):
+        pred_probs = prob_cache.predict_proba(model1, x, de_pat,
+                                              resolution=resolution,
+                                              load_hog=load_hog)
+        idxs = sweep.active_idxs()
+        preds = np.zeros((len(y), len(idxs)), dtype=np.int8)
+        for j, i in enumerate(idxs):
             threshold = ths[i]
             pred = pred_probs[:,1] >= threshold
-            pp_pred = dp.post_process(coord, dim, pred, binary_closing=True,
-                                      radius=best_radius)
-            preds[i] = np.concatenate((preds[i], pp_pred))
-            dice_scores(y, pp_pred, patient_idxs=None,
-                        label='Dice scores (two-stage, th=%.2f):' % ths[i])
-
-    best_th = ths[0]
-    best_score = -1
-    for i in range(nt):
-        print "\nOverall confusion matrix (th=%.2f):" % ths[i]
-        cm = confusion_matrix(yde, preds[i])
-        print cm
-
-        ds = dice_scores(yde, preds[i], patient_idxs=patient_idxs_de,
-                         label='Overall dice scores (two-stage, th=%.2f):' % ths[i],
-                         fscores=fscores)
-        score = sum(ds)
-        if score > best_score:
-            best_score = score
-            best_th = ths[i]
+            preds[:,j] = dp.post_process(coord, dim, pred, binary_closing=True,
+                                         radius=best_radius)
+        cms = sweep.add_patient(y, preds, idxs)
+        for j, i in enumerate(idxs):
+            dice_scores(y, preds[:,j], patient_idxs=None,
+                        label='Dice scores (two-stage, th=%.2f):' % ths[i],
+                        cms=cms[j:j+1])
+
+    best = report_sweep(sweep, ['th=%.2f' % th for th in ths], fscores)
+    best_th = ths[best]
+    best_score = sum(sweep.mean_dice()[best])
     print "Best th=%.2f, score=%f:" % (best_th, best_score)
     return best_th
 
-def optimize_potential(dev_pats, model1, model2, stratified, fscores=None,
-                       do_plot_predictions=False, resolution=1, load_hog=False):
+def mrf_potentials(factors=[0.02, 0.03, 0.04, 0.05, 0.06, 0.07, 0.08, 0.09, 0.1]):
+    """
+    Return the candidate MRF potentials, a quadratic potential over the
+    tumor labels scaled by each factor.
+    """
     n_labels = 4
     potentials = []
-    factors = [0.02, 0.03, 0.04, 0.05, 0.06, 0.07, 0.08, 0.09, 0.1]
     #factors = [0.00001, 0.0001, 0.001, 0.01, 0.02, 0.05, 0.1]
     # Quadratic potential
     order = [2,1,3,4]
@@ -334,50 +588,63 @@ def optimize_potential(dev_pats, model1, model2, stratified, fscores=None,
     for f in factors:
         #potentials.append(f * np.eye(n_labels))
         potentials.append(f * pot_mat)
+    return potentials
+
+def optimize_potential(dev_pats, model1, model2, stratified, fscores=None,
+                       do_plot_predictions=False, resolution=1, load_hog=False,
+                       prune_after=None):
+    potentials = mrf_potentials()
     n_pots = len(potentials)
 
-    yde = np.zeros(0)
-    predde = np.zeros((0, n_pots))
-    predde_no_pp = np.zeros(0)
-    patient_idxs_de = [0]
+    sweep = CandidateSweep(range(n_pots), prune_after=prune_after)
+    sweep_no_pp = CandidateSweep(['no MRF'])
     print "Development users:"
     # Iterate over dev users
-    for de_idx, de_pat in enumerate(dev_pats):
+    for de_idx, (de_pat, (x, y, coord, dim)) in enumerate(dp.iter_patients(
+            dev_pats, n_voxels=None, resolution=resolution,
+            load_hog=load_hog)):
         print "Development patient number %d" % (de_idx+1)
-        x, y, coord, dim = dp.load_patient(de_pat, n_voxels=None,
-                                           resolution=resolution,
-                                           load_hog=load_hog)
-        yde = np.concatenate((yde, y))
-        patient_idxs_de.append(len(yde))
 
-        pred = model1.predict(x)
+        pred = prob_cache.predict(model1, x, de_pat, resolution=resolution,
+                                  load_hog=load_hog)
         pp_pred = dp.post_process(coord, dim, pred, binary_closing=True)
 
         tumor_idxs = pp_pred > 0
-        pred_probs2 = model2.predict_proba(x[tumor_idxs,:])
+        pred_probs2 = prob_cache.predict_proba(model2, x, de_pat,
+                                               rows=tumor_idxs,
+                                               resolution=resolution,
+                                               load_hog=load_hog)
         pred2 = np.argmax(pred_probs2, axis=1) + 1
         pp_pred[tumor_idxs] = pred2
 
         pp_pred15 = np.array(pp_pred)
         print "\nConfusion matrix (dev):"
-        cm = confusion_matrix(y, pp_pred15)
+        cm = sweep_no_pp.add_patient(y, pp_pred15)[0]
         print cm
-        dice_scores(y, pp_pred15, label='Dice scores (dev, no MRF):')
-        predde_no_pp = np.concatenate((predde_no_pp, pp_pred15))
-        predde_part = np.zeros((len(pp_pred15), 0))
-
-        edges = dp.create_graph(coord[tumor_idxs,:])
-        for pi, pot in enumerate(potentials):
+        dice_scores(y, pp_pred15, label='Dice scores (dev, no MRF):',
+                    cms=cm[np.newaxis])
+
+        idxs = sweep.active_idxs()
+        predde_part = np.zeros((len(pp_pred15), len(idxs)), dtype=np.int8)
+        edges, adj = graph.tumor_graph(de_pat, coord, tumor_idxs)
+        # The potentials grow in strength, so each one is started from the
+        # solution of the previous one (used by the 'icm' backend)
+        smoothed = None
+        for j, pi in enumerate(idxs):
+            pot = potentials[pi]
             print "  Patient %d, potential %d." % (de_idx+1, pi+1)
-            pp_pred[tumor_idxs] = dp.mrf(pred_probs2, edges, potential=pot) + 1
+            smoothed = dp.mrf(pred_probs2, edges, potential=pot, adj=adj,
+                              coord=coord[tumor_idxs], init=smoothed)
+            pp_pred[tumor_idxs] = smoothed + 1
 
             print "\nConfusion matrix (MRF-%d):" % (pi+1)
             cm = confusion_matrix(y, pp_pred)
             print cm
 
-            predde_part = np.hstack((predde_part, pp_pred.reshape(len(pp_pred),1)))
+            predde_part[:,j] = pp_pred
 
-            dice_scores(y, pp_pred, label='Dice scores (pp):')
+            dice_scores(y, pp_pred, label='Dice scores (pp):',
+                        cms=cm[np.newaxis])
 
             if do_plot_predictions or de_idx < 5:
                 # Plot the patient
@@ -385,25 +652,14 @@ def optimize_potential(dev_pats, model1, model2, stratified, fscores=None,
                 pp.plot_predictions(coord, dim, pp_pred15, y, pp_pred, fname=pif)
                 #if pred_fname is not None:
                 #    extras.save_predictions(coord, dim_list[0], pred, yte, pred_fname)
-        predde = np.vstack((predde, predde_part))
+        sweep.add_patient(y, predde_part, idxs)
 
-    dice_scores(yde, predde_no_pp, patient_idxs=patient_idxs_de,
-                label='Overall dice scores (two-stage, no MRF):', fscores=fscores)
-
-    best_potential = potentials[0]
-    best_score = -1
-    for i in range(n_pots):
-        print "\nOverall confusion matrix (%d):" % i
-        cm = confusion_matrix(yde, predde[:,i])
-        print cm
+    dice_scores(None, None, label='Overall dice scores (two-stage, no MRF):',
+                fscores=fscores, cms=sweep_no_pp.patient_cms(0))
 
-        ds = dice_scores(yde, predde[:,i], patient_idxs=patient_idxs_de,
-                         label='Overall dice scores (two-stage, MRF-%d):' % i,
-                         fscores=fscores)
-        score = sum(ds)
-        if score > best_score:
-            best_score = score
-            best_potential = potentials[i]
+    best = report_sweep(sweep, ['MRF-%d' % i for i in range(n_pots)], fscores)
+    best_potential = potentials[best]
+    best_score = sum(sweep.mean_dice()[best])
     print "Best potential (score=%f):" % (best_score)
     print best_potential
     return best_potential
@@ -452,9 +708,9 @@ def predict_RF(train_pats, test_pats, fscores=None, do_plot_predictions=False,
     patient_idxs_te = [0]
     print "Test users:"
     # Iterate over test users
-    for te_idx, te_pat in enumerate(test_pats):
+    for te_idx, (te_pat, (x, y, coord, dim)) in enumerate(dp.iter_patients(
+            test_pats, n_voxels=None)):
         print "Test patient number %d" % (te_idx+1)
-        x, y, coord, dim = dp.load_patient(te_pat, n_voxels=None)
 
         if do_plot_predictions:
             pif = os.path.join('plots', 'pat%d_slices_0_RF.png' % te_pat)
@@ -505,9 +761,9 @@ def predict_online(train_pats, test_pats, fscores=None, do_plot_predictions=Fals
     #xtr, ytr, coordtr, patient_idxs_tr, dims_tr = dp.load_patients(train_pats,
     #                                                               stratified)
     model = None
-    for tr_idx, tr_pat in enumerate(train_pats):
+    for tr_idx, (tr_pat, (x, y, coord, dim)) in enumerate(dp.iter_patients(
+            train_pats, n_voxels=10000)):
         print "Train patient number %d" % (tr_idx+1)
-        x, y, coord, dim = dp.load_patient(tr_pat, n_voxels=10000)
         model = train_online_model(x, y, model)
 
     print "\n----------------------------------\n"
@@ -517,9 +773,9 @@ def predict_online(train_pats, test_pats, fscores=None, do_plot_predictions=Fals
     patient_idxs_te = [0]
     print "Test users:"
     # Iterate over test users
-    for te_idx, te_pat in enumerate(test_pats):
+    for te_idx, (te_pat, (x, y, coord, dim)) in enumerate(dp.iter_patients(
+            test_pats, n_voxels=None)):
         print "Test patient number %d" % (te_idx+1)
-        x, y, coord, dim = dp.load_patient(te_pat, n_voxels=None)
 
         if do_plot_predictions:
             pif = os.path.join('plots', 'pat%d_slices_0_online.png' % te_pat)
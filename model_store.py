@@ -0,0 +1,142 @@
+"""
+Store of trained forests keyed by their training configuration.
+
+A model is saved under the sha1 of its full training configuration (stage,
+seed, training patients in order, number of trees and voxels, sampling,
+features and library versions), so an equivalent configuration finds the
+model trained before regardless of e.g. the number of test patients. Models
+are stored as the packed node arrays of forest.PackedForest in compact
+dtypes, one .npy file per array, which is a fraction of the size of a pickled
+sklearn forest and can be opened with np.memmap. LazyForest opens them only
+on the first prediction, so loading the models at startup is free. Before
+starting its worker processes, pipeline.imap_patients compiles the trees
+once in the parent, so the forked workers share them.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import sklearn
+
+import feature_cache as fc
+import forest
+
+store_dir = os.path.join('models', 'store')
+store_version = 1
+
+_arrays = ['feature', 'threshold', 'left', 'right', 'value', 'roots',
+           'max_depths']
+
+def training_config(stage, seed, train_pats, n_trees, n_voxels, stratified,
+                    resolution=1, load_hog=False, **extra):
+    """
+    Dictionary of everything the trained model depends on.
+    """
+    config = {'stage': stage, 'seed': seed,
+              'train_patients': [int(p) for p in train_pats],
+              'n_trees': n_trees, 'n_voxels': n_voxels,
+              'stratified': bool(stratified), 'resolution': resolution,
+              'load_hog': bool(load_hog),
+              'feature_cache_version': fc.cache_version,
+              'sklearn_version': sklearn.__version__,
+              'store_version': store_version}
+    config.update(extra)
+    return config
+
+def config_key(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True)).hexdigest()
+
+def model_dir(key):
+    return os.path.join(store_dir, key)
+
+def exists(key):
+    return os.path.isfile(os.path.join(model_dir(key), 'meta.json'))
+
+def save(key, packed, config):
+    """
+    Save a forest.PackedForest under key and return its LazyForest.
+    """
+    arrays = {'feature': packed.feature.astype(
+                  np.int16 if packed.n_features_ < 2**15 else np.int32),
+              'threshold': packed.threshold.astype(np.float32),
+              'left': packed.left.astype(np.int32),
+              'right': packed.right.astype(np.int32),
+              'value': packed.value.astype(np.float32),
+              'roots': packed.roots.astype(np.int32),
+              'max_depths': packed.max_depths.astype(np.int32)}
+    mdir = model_dir(key)
+    tmp_dir = mdir + '.tmp%d' % os.getpid()
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    h = hashlib.sha1()
+    for name in _arrays:
+        np.save(os.path.join(tmp_dir, name + '.npy'), arrays[name])
+        h.update(name)
+        h.update(np.ascontiguousarray(arrays[name]).tostring())
+    meta = {'config': config,
+            'classes': packed.classes_.tolist(),
+            'n_features': int(packed.n_features_),
+            'n_nodes': len(packed.feature),
+            'digest': h.hexdigest(),
+            'n_jobs': packed.n_jobs}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    if os.path.isdir(mdir):
+        shutil.rmtree(mdir)
+    os.rename(tmp_dir, mdir)
+    return LazyForest(key)
+
+class LazyForest(object):
+    """
+    Stored forest that is opened on the first prediction. Only the key is
+    pickled, so it can be sent to worker processes cheaply. Predictions run
+    on the n_jobs threads of the trained forest unless n_jobs is given.
+    """
+    def __init__(self, key, n_jobs=None):
+        self.key = key
+        with open(os.path.join(model_dir(key), 'meta.json')) as f:
+            meta = json.load(f)
+        if n_jobs is None:
+            # Stores written before n_jobs was recorded: all cores
+            n_jobs = meta.get('n_jobs', -1)
+        self.n_jobs = n_jobs
+        self.classes_ = np.asarray(meta['classes'])
+        self.n_features_ = meta['n_features']
+        self.digest = meta['digest']
+        self._forest = None
+
+    def __getstate__(self):
+        return {'key': self.key, 'n_jobs': self.n_jobs}
+
+    def __setstate__(self, state):
+        self.__init__(state['key'], state['n_jobs'])
+
+    def load(self):
+        if self._forest is None:
+            mdir = model_dir(self.key)
+            a = dict((name, np.load(os.path.join(mdir, name + '.npy'),
+                                    mmap_mode='r'))
+                     for name in _arrays)
+            self._forest = forest.PackedForest(
+                    a['feature'], a['threshold'], a['left'], a['right'],
+                    a['value'], a['roots'], a['max_depths'], self.classes_,
+                    self.n_features_)
+        self._forest.n_jobs = self.n_jobs
+        return self._forest
+
+    def compile(self):
+        """
+        Open the arrays and build the compiled trees (see
+        forest.PackedForest.compile). Returns the LazyForest.
+        """
+        self.load().compile()
+        return self
+
+    def predict_proba(self, x):
+        return self.load().predict_proba(x)
+
+    def predict(self, x):
+        return self.load().predict(x)
@@ -0,0 +1,242 @@
+"""
+Morphological post-processing of binary tumor masks.
+
+Closings can be computed on a thread pool of n_jobs threads: the volume is
+split along z into slabs, each slab is closed together with a halo of 2r
+slices on both sides and only its own slices are kept. The closing of a
+voxel depends on the voxels within r of the dilation within r of it, so
+the result is identical to closing the whole volume.
+
+With se_mode 'decomposed' the ball is approximated by a sequence of 3x3x3
+elements (the 6-, 18- and 26-neighbourhoods, see ball_decomposition), so a
+closing costs O(r) instead of O(r^3) operations per voxel.
+"""
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import scipy.ndimage
+import skimage.morphology
+
+n_jobs = 1
+# 'exact' or 'decomposed' structuring elements
+se_mode = 'exact'
+
+# Distances are compared against the radius with a small tolerance. The
+# squared distance between two voxels is an integer, so sqrt(r^2+1) - r is
+# far larger than this.
+_eps = 1e-6
+
+def bounding_box(mask, margin=0):
+    """
+    Return the bounding box of the nonzero voxels of mask, grown by margin
+    voxels on each side and clipped to the volume, as a tuple of slices.
+    Returns None if the mask is empty.
+    """
+    box = []
+    for axis in range(mask.ndim):
+        other = tuple(a for a in range(mask.ndim) if a != axis)
+        nz = np.nonzero(np.any(mask, axis=other))[0]
+        if len(nz) == 0:
+            return None
+        box.append(slice(max(nz[0]-margin, 0),
+                         min(nz[-1]+margin+1, mask.shape[axis])))
+    return tuple(box)
+
+def binary_closings(mask, radii, jobs=None, mode=None):
+    """
+    Binary closing of mask with skimage.morphology.ball(r) for every r in
+    radii, computed with Euclidean distance transforms.
+
+    The distance to the tumor is computed once and thresholded to get the
+    dilation for every radius; each erosion is one more distance transform of
+    the dilated mask. All work is restricted to the bounding box of the mask
+    grown by max(radii)+1 voxels, since no closing reaches beyond it. The
+    result is identical to skimage.morphology.binary_closing. The box is
+    closed in slabs on jobs threads (see slab_map).
+
+    With mode 'decomposed' (the module setting se_mode if None) the ball is
+    replaced by its decomposition instead, see ball_decomposition.
+
+    Output:
+        box -- Tuple of slices of the volume covered by the result, or None if
+               the mask is empty.
+        closed -- (len(radii),) + box shape boolean array. Outside the box all
+                  closings are zero.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    box = bounding_box(mask, max(radii) + 1)
+    if box is None:
+        return None, np.zeros((len(radii),0,0,0), dtype=bool)
+    mode = se_mode if mode is None else mode
+    if mode == 'exact':
+        func = lambda sub: _closings(sub, radii)
+    elif mode == 'decomposed':
+        func = lambda sub: _decomposed_closings(sub, radii)
+    else:
+        raise ValueError("Mode must be 'exact' or 'decomposed'")
+    closed = slab_map(func, mask[box], 2*max(radii), jobs)
+    return box, closed
+
+def _closings(sub, radii):
+    closed = np.zeros((len(radii),) + sub.shape, dtype=bool)
+    if sub.all():
+        closed[:] = True
+        return closed
+    # Distance of every voxel to the nearest tumor voxel
+    dist_out = scipy.ndimage.distance_transform_edt(~sub)
+    for i, r in enumerate(radii):
+        dilated = dist_out <= r + _eps
+        if dilated.all():
+            # Erosion treats the outside of the volume as foreground
+            closed[i] = True
+            continue
+        # Distance of every voxel to the nearest voxel outside the dilation
+        dist_in = scipy.ndimage.distance_transform_edt(dilated)
+        closed[i] = dist_in > r + _eps
+    return closed
+
+def _decomposed_closings(sub, radii):
+    closed = np.zeros((len(radii),) + sub.shape, dtype=bool)
+    for i, r in enumerate(radii):
+        dilated = sub
+        erosion_steps = []
+        for structure, n in zip(_elements, ball_decomposition(r)):
+            if n > 0:
+                dilated = scipy.ndimage.binary_dilation(dilated, structure,
+                                                        iterations=n)
+                erosion_steps.append((structure, n))
+        # The outside of the volume is foreground, as in _closings
+        for structure, n in erosion_steps:
+            dilated = scipy.ndimage.binary_erosion(dilated, structure,
+                                                   iterations=n,
+                                                   border_value=1)
+        closed[i] = dilated
+    return closed
+
+def closing(D, radius, jobs=None, mode=None):
+    """
+    skimage.morphology.closing of the labels D with ball(radius), on slabs
+    of the volume in parallel. With mode 'decomposed' (the module setting
+    se_mode if None) the ball is replaced by its decomposition.
+    """
+    mode = se_mode if mode is None else mode
+    if mode == 'exact':
+        selem = skimage.morphology.ball(radius)
+        func = lambda sub: skimage.morphology.closing(sub, selem)
+    elif mode == 'decomposed':
+        func = lambda sub: _decomposed_closing(sub, radius)
+    else:
+        raise ValueError("Mode must be 'exact' or 'decomposed'")
+    return slab_map(func, D, 2*radius, jobs)
+
+def _decomposed_closing(D, radius):
+    steps = [(structure, n) for structure, n in
+             zip(_elements, ball_decomposition(radius)) if n > 0]
+    for structure, n in steps:
+        for i in range(n):
+            D = scipy.ndimage.grey_dilation(D, footprint=structure)
+    for structure, n in steps:
+        for i in range(n):
+            D = scipy.ndimage.grey_erosion(D, footprint=structure)
+    return D
+
+# 6-, 18- and 26-neighbourhoods
+_elements = [scipy.ndimage.generate_binary_structure(3, c) for c in (1, 2, 3)]
+_decompositions = {}
+
+def decomposed_ball(counts, radius):
+    """
+    Footprint of the successive dilations by counts[i] times _elements[i],
+    in a (2*radius+1)^3 box.
+    """
+    fp = np.zeros((2*radius+1,) * 3, dtype=bool)
+    fp[radius, radius, radius] = True
+    for structure, n in zip(_elements, counts):
+        if n > 0:
+            fp = scipy.ndimage.binary_dilation(fp, structure, iterations=n)
+    return fp
+
+def ball_decomposition(radius):
+    """
+    Numbers of dilations by the 6-, 18- and 26-neighbourhoods whose
+    combined footprint differs from skimage.morphology.ball(radius) in the
+    fewest voxels. The footprint reaches as far as the sum of the numbers,
+    at most radius.
+    """
+    if radius < 1:
+        return (0, 0, 0)
+    if radius not in _decompositions:
+        ball = skimage.morphology.ball(radius).astype(bool)
+        best = None
+        for n6 in range(radius + 1):
+            for n18 in range(radius + 1 - n6):
+                for n26 in range(radius + 1 - n6 - n18):
+                    counts = (n6, n18, n26)
+                    if sum(counts) == 0:
+                        continue
+                    n_diff = np.count_nonzero(decomposed_ball(counts, radius)
+                                              ^ ball)
+                    if best is None or n_diff < best[0]:
+                        best = (n_diff, counts)
+        _decompositions[radius] = best[1]
+    return _decompositions[radius]
+
+def slabs(n, n_slabs, halo):
+    """
+    Split range(n) into n_slabs slabs. Returns (lo, hi, c0, c1) for each
+    slab: the slab with its halo is lo:hi and its own slices are c0:c1.
+    """
+    edges = np.linspace(0, n, n_slabs + 1).astype(int)
+    return [(max(c0 - halo, 0), min(c1 + halo, n), c0, c1)
+            for c0, c1 in zip(edges[:-1], edges[1:]) if c1 > c0]
+
+def slab_map(func, volume, halo, jobs=None, axis=2):
+    """
+    Apply func to overlapping slabs of volume along axis in parallel and
+    stitch the results. The output of func at a voxel must only depend on
+    the input within halo slices of it; func may prepend dimensions to the
+    output (e.g. one per radius).
+
+    Input:
+        jobs -- Number of threads, the module setting n_jobs if None.
+    """
+    jobs = n_jobs if jobs is None else jobs
+    n = volume.shape[axis]
+    # Slabs at least twice as thick as their halo, so that no thread does
+    # more than twice its share of the work
+    n_slabs = min(jobs, max(n // max(2*halo, 1), 1))
+    if n_slabs <= 1:
+        return func(volume)
+    parts = slabs(n, n_slabs, halo)
+
+    def run(part):
+        lo, hi, c0, c1 = part
+        idx = [slice(None)] * volume.ndim
+        idx[axis] = slice(lo, hi)
+        out = func(volume[tuple(idx)])
+        idx = [slice(None)] * out.ndim
+        idx[out.ndim - volume.ndim + axis] = slice(c0 - lo, c1 - lo)
+        return out[tuple(idx)]
+
+    pool = ThreadPool(n_slabs)
+    try:
+        results = pool.map(run, parts)
+    finally:
+        pool.close()
+        pool.join()
+    out_axis = results[0].ndim - volume.ndim + axis
+    return np.concatenate(results, axis=out_axis)
+
+def binary_dilation(mask, radius):
+    """
+    Binary dilation of mask with skimage.morphology.ball(radius), computed
+    with a Euclidean distance transform within the bounding box of the mask.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    out = np.zeros(mask.shape, dtype=bool)
+    box = bounding_box(mask, radius)
+    if box is None:
+        return out
+    dist_out = scipy.ndimage.distance_transform_edt(~mask[box])
+    out[box] = dist_out <= radius + _eps
+    return out
@@ -0,0 +1,272 @@
+"""
+MRF smoothing of the second-stage labels over the tumor graph.
+
+The energy of a labelling is the one of pystruct,
+    sum_i unary[i, y_i] + sum_(s,t) pairwise[y_s, y_t],
+and it is maximized. The tumor graph is split into its connected
+components, which are independent subproblems. They are grouped into n_jobs
+batches of about equal size and the batches are solved in a pool of n_jobs
+processes, kept between calls. Processes rather than threads because neither
+backend releases the GIL for long: pyqpbo holds it and ICM spends its time
+in short numpy and scipy.sparse calls. Inside a daemonic process (e.g. a
+worker of pipeline.py), which cannot start a pool, the batches are solved
+one after another.
+
+Backends:
+    'qpbo' -- pystruct's QPBO alpha-expansion, as before. Starts from
+              scratch, init is ignored.
+    'icm' -- Iterated conditional modes on the CSR graph. The voxels are
+             split into 8 colour classes by the parity of their coordinates;
+             no two voxels of a class are 26-neighbours, so a whole class is
+             updated at once with a few sparse products. Every update can
+             only increase the energy and it starts from init, e.g. the
+             solution for the previous potential.
+"""
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+from pystruct.inference import inference_dispatch
+
+backend = 'qpbo'
+n_jobs = 1
+max_iter = 30
+
+# Process pool of the batches, created by _batch_pool
+_pool = None
+_pool_size = 0
+_pool_pid = None
+
+def energy(unary, pairwise, edges, labels):
+    """
+    Same value as pystruct's compute_energy, without its loop over the edges.
+    """
+    labels = np.asarray(labels)
+    e = np.sum(unary[np.arange(len(labels)), labels])
+    if len(edges) > 0:
+        e += np.sum(pairwise[labels[edges[:,0]], labels[edges[:,1]]])
+    return e
+
+def adjacency(edges, n):
+    data = np.ones(2*len(edges), dtype=np.int8)
+    rows = np.concatenate((edges[:,0], edges[:,1]))
+    cols = np.concatenate((edges[:,1], edges[:,0]))
+    return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(n,n))
+
+def parity_colours(coord):
+    """
+    Colour 0-7 of each voxel from the parities of its coordinates.
+    """
+    coord = np.asarray(coord, dtype=np.int64)
+    return (4*(coord[:,0] & 1) + 2*(coord[:,1] & 1) +
+            (coord[:,2] & 1)).astype(np.int8)
+
+def greedy_colours(adj, seed=0):
+    """
+    Colouring of a general graph by repeatedly taking the uncoloured nodes
+    whose random priority is above that of all their uncoloured neighbours.
+    """
+    n = adj.shape[0]
+    prio = np.random.RandomState(seed).permutation(n) + 1.0
+    colours = np.empty(n, dtype=np.int32)
+    colours.fill(-1)
+    adj = adj.tocsr()
+    c = 0
+    while np.any(colours < 0):
+        p = np.where(colours < 0, prio, 0)
+        neigh_max = adj.multiply(p[np.newaxis,:]).max(axis=1).toarray().ravel()
+        colours[(colours < 0) & (p > neigh_max)] = c
+        c += 1
+    return colours
+
+def component_batches(adj, n_batches):
+    """
+    Split the nodes into at most n_batches sets of whole connected
+    components, the largest components first into the smallest batch.
+
+    Output:
+        batches -- List of sorted node index arrays.
+        n_components, largest -- Number of components and size of the
+                                 largest one.
+    """
+    n = adj.shape[0]
+    n_comp, comp = scipy.sparse.csgraph.connected_components(adj,
+                                                             directed=False)
+    sizes = np.bincount(comp, minlength=n_comp)
+    n_batches = max(1, min(n_batches, n_comp))
+    if n_batches == 1:
+        return [np.arange(n)], n_comp, sizes.max() if n > 0 else 0
+    loads = np.zeros(n_batches, dtype=np.int64)
+    batch_of_comp = np.empty(n_comp, dtype=np.int32)
+    for ci in np.argsort(-sizes, kind='mergesort'):
+        b = np.argmin(loads)
+        batch_of_comp[ci] = b
+        loads[b] += sizes[ci]
+    batch = batch_of_comp[comp]
+    batches = [np.nonzero(batch == b)[0] for b in range(n_batches)]
+    return [b for b in batches if len(b) > 0], n_comp, sizes.max()
+
+def icm(unary, pairwise, edges, colours, init=None, max_iter=max_iter):
+    """
+    Maximize the energy with colour class-wise ICM.
+
+    Input:
+        colours -- Colour of every node such that no edge joins two nodes of
+                   the same colour.
+        init -- Starting labels, argmax of unary if None.
+
+    Output:
+        labels, number of sweeps
+    """
+    n, n_labels = unary.shape
+    unary = np.asarray(unary, dtype=np.float64)
+    pairwise = np.asarray(pairwise, dtype=np.float64)
+    if init is None:
+        labels = np.argmax(unary, axis=1)
+    else:
+        labels = np.array(init, dtype=np.intp)
+    if len(edges) == 0:
+        return labels, 0
+    # A[s,t] = 1 for every edge, so that A counts the labels of the targets
+    # and A.T those of the sources of the edges of a node
+    data = np.ones(len(edges), dtype=np.float64)
+    A = scipy.sparse.csr_matrix((data, (edges[:,0], edges[:,1])), shape=(n,n))
+    AT = A.T.tocsr()
+    classes = [np.nonzero(colours == c)[0] for c in np.unique(colours)]
+    A_c = [A[idxs] for idxs in classes]
+    AT_c = [AT[idxs] for idxs in classes]
+    Y = np.zeros((n, n_labels))
+    Y[np.arange(n), labels] = 1
+
+    for it in range(max_iter):
+        n_changed = 0
+        for idxs, Ac, ATc in zip(classes, A_c, AT_c):
+            score = (unary[idxs] + Ac.dot(Y).dot(pairwise.T) +
+                     ATc.dot(Y).dot(pairwise))
+            old = labels[idxs]
+            new = np.argmax(score, axis=1)
+            # Ties keep the current label
+            keep = score[np.arange(len(idxs)), old] >= \
+                    score[np.arange(len(idxs)), new]
+            new[keep] = old[keep]
+            changed = np.nonzero(new != old)[0]
+            if len(changed) > 0:
+                rows = idxs[changed]
+                Y[rows, old[changed]] = 0
+                Y[rows, new[changed]] = 1
+                labels[rows] = new[changed]
+                n_changed += len(changed)
+        if n_changed == 0:
+            return labels, it+1
+    return labels, max_iter
+
+def _solve_batch(args):
+    unary, pairwise, edges, colours, init, method = args
+    t0 = time.time()
+    if method == 'qpbo':
+        labels = inference_dispatch(unary, pairwise, edges,
+                                    inference_method='qpbo')
+    elif method == 'icm':
+        labels = icm(unary, pairwise, edges, colours, init)[0]
+    else:
+        raise ValueError("Backend must be 'qpbo' or 'icm'")
+    return np.asarray(labels), time.time() - t0
+
+def _batch_pool(jobs):
+    """
+    Pool of jobs processes, reused while jobs does not change, None if this
+    process cannot start one.
+    """
+    global _pool, _pool_size, _pool_pid
+    if multiprocessing.current_process().daemon:
+        return None
+    if _pool is not None and (_pool_size != jobs or _pool_pid != os.getpid()):
+        close_pool()
+    if _pool is None:
+        _pool = multiprocessing.Pool(jobs)
+        _pool_size = jobs
+        _pool_pid = os.getpid()
+    return _pool
+
+def close_pool():
+    global _pool, _pool_pid
+    if _pool is not None:
+        if _pool_pid == os.getpid():
+            _pool.terminate()
+            _pool.join()
+        _pool = None
+        _pool_pid = None
+
+def solve(unary, pairwise, edges, adj=None, coord=None, init=None,
+          method=None, jobs=None):
+    """
+    Maximize the MRF energy over the graph of edges.
+
+    Input:
+        adj -- Symmetric CSR adjacency of the graph, built from edges if None.
+        coord -- Voxel coordinates of the nodes, used to colour the graph
+                 for 'icm'. A general colouring is computed if None.
+        init -- Starting labels for 'icm'.
+        method, jobs -- Backend and number of processes, the module
+                        settings backend and n_jobs if None.
+
+    Output:
+        labels -- (n,) labels.
+        info -- Dictionary with the energy, the number of components, the
+                size of the largest one, and the seconds of each batch.
+    """
+    method = backend if method is None else method
+    jobs = n_jobs if jobs is None else jobs
+    unary = np.asarray(unary)
+    edges = np.asarray(edges)
+    n = unary.shape[0]
+    if adj is None:
+        adj = adjacency(edges, n)
+    colours = None
+    if method == 'icm':
+        if coord is not None:
+            colours = parity_colours(coord)
+        else:
+            colours = greedy_colours(adj)
+
+    t0 = time.time()
+    batches, n_comp, largest = component_batches(adj, jobs)
+    if len(batches) == 1:
+        tasks = [(unary, pairwise, edges, colours, init, method)]
+        parts = [None]
+    else:
+        local = np.empty(n, dtype=np.int64)
+        batch_of = np.empty(n, dtype=np.int32)
+        for b, nodes in enumerate(batches):
+            local[nodes] = np.arange(len(nodes))
+            batch_of[nodes] = b
+        edge_batch = batch_of[edges[:,0]]
+        tasks = []
+        for b, nodes in enumerate(batches):
+            sub_edges = local[edges[edge_batch == b]].astype(np.int32)
+            tasks.append((unary[nodes], pairwise, sub_edges,
+                          None if colours is None else colours[nodes],
+                          None if init is None else np.asarray(init)[nodes],
+                          method))
+        parts = batches
+
+    pool = _batch_pool(jobs) if len(tasks) > 1 else None
+    if pool is not None:
+        results = pool.map(_solve_batch, tasks)
+    else:
+        results = [_solve_batch(task) for task in tasks]
+
+    if parts[0] is None:
+        labels = results[0][0]
+    else:
+        labels = np.empty(n, dtype=np.intp)
+        for nodes, (sub_labels, t) in zip(parts, results):
+            labels[nodes] = sub_labels
+    info = {'energy': energy(unary, pairwise, edges, labels),
+            'n_components': n_comp, 'largest': largest,
+            'batch_seconds': [t for sub_labels, t in results],
+            'seconds': time.time() - t0}
+    return labels, info
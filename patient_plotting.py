@@ -4,6 +4,7 @@ from matplotlib import colors
 import cPickle as pickle
 import data_processing as dp;
 import scipy.io
+from volume import patient_volume
 
 def plot_cm(cm, title='Confusion matrix', cmap=plt.cm.Blues):
     plt.imshow(cm, interpolation='nearest', cmap=cmap)
@@ -63,17 +64,12 @@ def plot_all_scatter_matrices(xx, yy):
 def plot_predictions(coord, dim, pred, gt=None, pp_pred=None, fname=None, fmat=None):
     assert coord.shape[0] == len(pred), "Number of coordinates must match to the number of labels (%d != %d)" % (coord.shape[0], len(pred))
     print "Plotting predictions..."
-    D = np.ones((dim[0], dim[1], dim[2])) * -1
-    for i in range(coord.shape[0]):
-        D[coord[i,0], coord[i,1], coord[i,2]] = pred[i]
+    vol = patient_volume(coord, dim)
+    D = vol.scatter(pred, dtype=np.int8, fill=-1)
     if gt is not None:
-        Dgt = np.ones((dim[0], dim[1], dim[2])) * -1
-        for i in range(coord.shape[0]):
-            Dgt[coord[i,0], coord[i,1], coord[i,2]] = gt[i]
+        Dgt = vol.scatter(gt, dtype=np.int8, fill=-1)
     if pp_pred is not None:
-        Dpp = np.ones((dim[0], dim[1], dim[2])) * -1
-        for i in range(coord.shape[0]):
-            Dpp[coord[i,0], coord[i,1], coord[i,2]] = pp_pred[i]
+        Dpp = vol.scatter(pp_pred, dtype=np.int8, fill=-1)
     n_layers = 7
     n_rows = 1
     if gt is not None:
@@ -90,16 +86,16 @@ def plot_predictions(coord, dim, pred, gt=None, pp_pred=None, fname=None, fmat=N
         row_idx = 0
         if gt is not None:
             plt.subplot(n_rows,n_layers, i+1)
-            plt.imshow(Dgt[:,:,zs[i]], interpolation='nearest', origin='lower', cmap=cmap, norm=norm)
+            plt.imshow(vol.full_slice(Dgt, zs[i]), interpolation='nearest', origin='lower', cmap=cmap, norm=norm)
             plt.title('Ground truth (z=%d)' % zs[i])
             row_idx += 1
         plt.subplot(n_rows,n_layers, i+1+(row_idx*n_layers))
-        plt.imshow(D[:,:,zs[i]], interpolation='nearest', origin='lower', cmap=cmap, norm=norm)
+        plt.imshow(vol.full_slice(D, zs[i]), interpolation='nearest', origin='lower', cmap=cmap, norm=norm)
         plt.title('Prediction (z=%d)' % zs[i])
         row_idx += 1
         if pp_pred is not None:
             plt.subplot(n_rows,n_layers, i+1+(row_idx*n_layers))
-            plt.imshow(Dpp[:,:,zs[i]], interpolation='nearest', origin='lower', cmap=cmap, norm=norm)
+            plt.imshow(vol.full_slice(Dpp, zs[i]), interpolation='nearest', origin='lower', cmap=cmap, norm=norm)
             plt.title('Post-processed (z=%d)' % zs[i])
             
     if fname is None:
@@ -107,7 +103,7 @@ def plot_predictions(coord, dim, pred, gt=None, pp_pred=None, fname=None, fmat=N
     else:
         plt.savefig(fname)
     if fmat is not None:
-        mdict = {'pred': D, 'dim': dim}
+        mdict = {'pred': vol.to_full(D).astype(float), 'dim': dim}
         scipy.io.savemat(fmat, mdict)
         #with open(fmat, 'wb') as fp:
         #    pickle.dump(D, fp)
@@ -0,0 +1,78 @@
+"""
+Patient-level parallel execution of the prediction pipeline.
+
+Every worker process loads the joblib models once. The model_store models
+are compiled once in the parent instead and the forked workers share them
+copy-on-write. Every worker then runs the whole per-patient pipeline
+(loading, forest inference, morphology, MRF, plotting) for one patient at a
+time. Different patients are thus at different stages
+concurrently and the evaluation scales with the number of cores. The
+profiling records of a patient are sent back with its result.
+"""
+import multiprocessing
+
+from sklearn.externals import joblib
+
+import forest
+import prob_cache
+import profiling
+
+# Models of the current worker process
+_models = []
+
+def _init_worker(models, n_jobs, pack_models):
+    global _models
+    # Records inherited from the parent are already there
+    profiling.drain()
+    _models = []
+    for model in models:
+        if isinstance(model, basestring):
+            fname = model
+            model = joblib.load(fname)
+            digest = prob_cache.file_digest(fname)
+        else:
+            # model_store.LazyForest, inherited from the parent
+            digest = model.digest
+        if hasattr(model, 'n_jobs'):
+            # The parallelism comes from the workers
+            model.n_jobs = n_jobs
+        if pack_models and not hasattr(model, 'digest') and \
+                forest.tree_layout_error() is None:
+            model = forest.pack_forest(model, n_jobs=n_jobs)
+        prob_cache.register_model(model, digest=digest)
+        _models.append(model)
+
+def _run_patient(args):
+    func, pat, kwargs = args
+    result = func(pat, *_models, **kwargs)
+    return result, profiling.drain()
+
+def imap_patients(func, pats, models, n_workers, n_jobs=1, pack_models=False,
+                  **kwargs):
+    """
+    Return an iterator of func(pat, model_1, ..., model_k, **kwargs) for
+    every patient, in the order of pats, computed in n_workers processes.
+    func must be a module-level function so that it can be pickled.
+
+    Input:
+        models -- joblib files of the models, loaded once per worker, or
+                  model_store.LazyForest objects.
+        n_jobs -- n_jobs of the models inside a worker.
+        pack_models -- Convert the joblib models to forest.PackedForest if
+                       forest.tree_layout_error() allows it.
+    """
+    if forest.tree_layout_error() is None:
+        for model in models:
+            if hasattr(model, 'compile'):
+                # Inherited by the forked workers instead of built by each
+                model.compile()
+    pool = multiprocessing.Pool(n_workers, initializer=_init_worker,
+                                initargs=(models, n_jobs, pack_models))
+    try:
+        tasks = ((func, pat, kwargs) for pat in pats)
+        for result, records in pool.imap(_run_patient, tasks):
+            profiling.extend(records)
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
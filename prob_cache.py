@@ -0,0 +1,253 @@
+"""
+Content-addressed on-disk cache of forest prediction probabilities.
+
+An entry is keyed by a digest of the model file and of the feature cache of
+the patient (see feature_cache.py), plus the rows of the patient the model
+was applied to. Running the same model on the same patient again, e.g. in
+every optimize_* pass and in the test loop, or when an experiment is re-run
+with fresh_models=False, then skips forest inference.
+
+Probabilities are stored quantized, as float16 or as uint8 (multiples of
+1/255). The dequantized values are returned on a miss as well, so results
+do not depend on whether the cache was hit. The least recently used entries
+are removed when the cache grows over max_bytes. The size of the cache is
+scanned once per process and then kept as a running total of the entries
+written, so entries written by other processes are only seen at the next
+scan, when the total goes over max_bytes.
+
+Only models registered with register_model are cached, other models are
+evaluated as usual.
+
+With a block_size the features are streamed through the model in blocks
+(see chunked.py); the entry is written and read as a memmap and the
+probabilities are returned in a temporary memmap.
+"""
+import hashlib
+import json
+import os
+import weakref
+
+import numpy as np
+
+import chunked
+import feature_cache as fc
+
+cache_dir = os.path.join('data', 'prob_cache')
+max_bytes = 20 * 1024**3
+# Fraction of max_bytes the cache is trimmed to, so that a full cache is not
+# scanned again on every write
+evict_to = 0.9
+# 'float16', 'uint8' or 'float32' (exact)
+storage_dtype = 'float16'
+enabled = True
+
+# Digest of the file of every registered model
+_model_digests = weakref.WeakKeyDictionary()
+# File digests by (path, size, mtime) so that a file is hashed only once
+_file_digests = {}
+# Bytes in cache_dir as of the last scan plus the entries written since,
+# None before the first scan
+_cache_bytes = None
+
+def file_digest(fname):
+    st = os.stat(fname)
+    stamp = (os.path.abspath(fname), st.st_size, st.st_mtime)
+    if stamp not in _file_digests:
+        h = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        _file_digests[stamp] = h.hexdigest()
+    return _file_digests[stamp]
+
+def register_model(model, fname=None, digest=None):
+    """
+    Cache the probabilities of model under the digest of its joblib file,
+    or under the given content digest (see model_store.py).
+    """
+    if digest is None:
+        digest = file_digest(fname)
+    _model_digests[model] = digest
+
+def patient_key(number, resolution=1, load_hog=False, do_preprocess=True):
+    """
+    Digest of the feature cache of a patient, None if it is not cached.
+    """
+    meta = fc.read_meta(number, resolution, load_hog, do_preprocess)
+    if meta is None:
+        return None
+    h = hashlib.sha1(fc.patient_dir(number, resolution, load_hog,
+                                    do_preprocess))
+    h.update(json.dumps(meta, sort_keys=True))
+    return h.hexdigest()
+
+def entry_fname(model_digest, pat_key, rows=None):
+    h = hashlib.sha1(model_digest)
+    h.update(pat_key)
+    h.update(storage_dtype)
+    if rows is not None:
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            h.update('mask%d' % len(rows))
+            h.update(np.packbits(rows).tostring())
+        else:
+            h.update(np.asarray(rows, dtype=np.int64).tostring())
+    key = h.hexdigest()
+    return os.path.join(cache_dir, key[:2], key + '.npy')
+
+def quantize(probs):
+    probs = np.asarray(probs)
+    if storage_dtype == 'uint8':
+        return np.round(probs * 255).astype(np.uint8)
+    return probs.astype(storage_dtype)
+
+def dequantize(q):
+    if q.dtype == np.uint8:
+        return q.astype(np.float32) / 255
+    return q.astype(np.float32)
+
+def _evict():
+    """
+    Scan the cache and if it is over max_bytes, remove the least recently
+    used entries down to evict_to * max_bytes. Returns the remaining size.
+    """
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(cache_dir):
+        for f in files:
+            if f.endswith('.npy'):
+                fname = os.path.join(root, f)
+                st = os.stat(fname)
+                entries.append((st.st_mtime, st.st_size, fname))
+                total += st.st_size
+    if total <= max_bytes:
+        return total
+    # Least recently used first
+    for mtime, size, fname in sorted(entries):
+        if total <= evict_to * max_bytes:
+            break
+        os.remove(fname)
+        total -= size
+    return total
+
+def _add_bytes(n_bytes):
+    global _cache_bytes
+    if _cache_bytes is None:
+        # Includes the new entry
+        _cache_bytes = _evict()
+        return
+    _cache_bytes += n_bytes
+    if _cache_bytes > max_bytes:
+        _cache_bytes = _evict()
+
+def _storage_dtype():
+    return np.dtype(np.uint8 if storage_dtype == 'uint8' else storage_dtype)
+
+def _write_entry(fname, q=None, shape=None):
+    """
+    Write the quantized probabilities q to the entry fname atomically, or
+    if q is None return a writable memmap of the given shape and a function
+    that completes the entry once it is filled.
+    """
+    fdir = os.path.dirname(fname)
+    if not os.path.isdir(fdir):
+        try:
+            os.makedirs(fdir)
+        except OSError:
+            # Created by another process
+            pass
+    tmp_fname = fname + '.tmp%d' % os.getpid()
+
+    def finish():
+        os.rename(tmp_fname, fname)
+        _add_bytes(os.path.getsize(fname))
+
+    if q is None:
+        q = np.lib.format.open_memmap(tmp_fname, mode='w+',
+                                      dtype=_storage_dtype(), shape=shape)
+        return q, finish
+    with open(tmp_fname, 'wb') as f:
+        np.save(f, q)
+    finish()
+
+def _predict_blocks(model, x, fname, rows, block_size):
+    if fname is None:
+        return chunked.predict_proba(model, x, rows, block_size)
+    n = x.shape[0]
+    shape = (chunked.n_rows(n, rows), len(model.classes_))
+    out = chunked.temp_memmap(shape)
+    if os.path.isfile(fname):
+        try:
+            q = np.load(fname, mmap_mode='r')
+            os.utime(fname, None)
+            for o0 in range(0, shape[0], block_size):
+                out[o0:o0+block_size] = dequantize(q[o0:o0+block_size])
+            return out
+        except (IOError, ValueError):
+            pass
+    if shape[0] == 0:
+        return out
+    q, finish = _write_entry(fname, shape=shape)
+    for b0, b1, local, o0, o1 in chunked.blocks(n, rows, block_size):
+        xb = np.asarray(x[b0:b1])
+        if local is not None:
+            xb = xb[local]
+        qb = quantize(model.predict_proba(xb))
+        q[o0:o1] = qb
+        out[o0:o1] = dequantize(qb)
+    q.flush()
+    del q
+    finish()
+    return out
+
+def predict_proba(model, x, patient, rows=None, resolution=1, load_hog=False,
+                  do_preprocess=True, block_size=None):
+    """
+    Return model.predict_proba(x[rows]) from the cache if possible.
+
+    Input:
+        x -- All voxels of the patient (n_voxels=None when loading).
+        patient -- Patient number.
+        rows -- Boolean mask or indices of the voxels to predict, None for
+                all voxels.
+        block_size -- If given, predict block_size voxels at a time and
+                      return a memmap (see chunked.py).
+
+    Output:
+        (n_rows, n_classes) float32 probabilities, quantized to the storage
+        dtype if the model is registered.
+    """
+    model_digest = _model_digests.get(model) if enabled else None
+    pat_key = None
+    if model_digest is not None:
+        pat_key = patient_key(patient, resolution, load_hog, do_preprocess)
+    fname = None
+    if pat_key is not None:
+        fname = entry_fname(model_digest, pat_key, rows)
+    if block_size is not None:
+        return _predict_blocks(model, x, fname, rows, block_size)
+    if fname is None:
+        xr = x if rows is None else x[rows,:]
+        return model.predict_proba(xr)
+
+    if os.path.isfile(fname):
+        try:
+            q = np.load(fname)
+            # Mark as recently used
+            os.utime(fname, None)
+            return dequantize(q)
+        except (IOError, ValueError):
+            pass
+    xr = x if rows is None else x[rows,:]
+    q = quantize(model.predict_proba(xr))
+    _write_entry(fname, q)
+    return dequantize(q)
+
+def predict(model, x, patient, rows=None, resolution=1, load_hog=False,
+            do_preprocess=True, block_size=None):
+    """
+    Return model.predict(x[rows]) computed from the cached probabilities.
+    """
+    probs = predict_proba(model, x, patient, rows, resolution, load_hog,
+                          do_preprocess, block_size)
+    return model.classes_.take(np.argmax(probs, axis=1))
@@ -0,0 +1,194 @@
+"""
+Profiling of the pipeline stages.
+
+    st = profiling.start('post_process', n_voxels=len(pred))
+    ...
+    print "Post-processing took %.2f seconds." % st.stop()
+
+or `with profiling.stage(name, n_voxels) as st:`. Every stage appends a record
+with its name, its patient (by default the one of set_patient), the number
+of voxels, its wall and CPU time, the resident memory of the process at its
+start and stop and the peak resident memory of the process so far (which is
+not specific to the stage) to a ring buffer of the last capacity records.
+The patient workers of pipeline.py and the folds of cv_runner.py send their
+records back to the main process. With
+enabled = False a stage only measures its wall time for the messages and
+records nothing.
+
+At the end of a run write() stores the records as JSON and CSV and summary()
+tabulates the stages by their total time.
+"""
+import collections
+import csv
+import json
+import os
+import resource
+import time
+
+enabled = True
+capacity = 100000
+
+fields = ['stage', 'patient', 'n_voxels', 'wall', 'cpu', 'rss_start_mb',
+          'rss_stop_mb', 'process_peak_rss_mb', 'pid', 'start']
+
+_records = collections.deque(maxlen=capacity)
+_patient = None
+_page_mb = os.sysconf('SC_PAGE_SIZE') / 1024.0**2
+
+def rss_mb():
+    """
+    Current resident memory of the process in MB, None if unknown.
+    """
+    try:
+        fd = os.open('/proc/self/statm', os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        return int(os.read(fd, 128).split()[1]) * _page_mb
+    finally:
+        os.close(fd)
+
+def set_patient(patient):
+    """
+    Patient the following stages are recorded for, None for none.
+    """
+    global _patient
+    _patient = patient
+
+class Stage(object):
+    """
+    Context manager timing one stage, see the module docstring.
+    """
+    __slots__ = ('name', 'n_voxels', 'patient', 'recording', 't0', 'cpu0',
+                 'rss0', 'seconds')
+
+    def __init__(self, name, n_voxels=None, patient=None):
+        self.name = name
+        self.n_voxels = n_voxels
+        self.patient = patient
+        self.seconds = 0.0
+
+    def start(self):
+        self.recording = enabled
+        if self.recording:
+            ru = resource.getrusage(resource.RUSAGE_SELF)
+            self.cpu0 = ru.ru_utime + ru.ru_stime
+            self.rss0 = rss_mb()
+        self.t0 = time.time()
+        return self
+
+    def stop(self):
+        """
+        Record the stage and return its wall time in seconds.
+        """
+        self.seconds = time.time() - self.t0
+        if self.recording:
+            ru = resource.getrusage(resource.RUSAGE_SELF)
+            n_voxels = None if self.n_voxels is None else int(self.n_voxels)
+            # ru_maxrss is in kilobytes on Linux
+            patient = _patient if self.patient is None else self.patient
+            _records.append((self.name, patient, n_voxels, self.seconds,
+                             ru.ru_utime + ru.ru_stime - self.cpu0,
+                             self.rss0, rss_mb(), ru.ru_maxrss / 1024.0,
+                             os.getpid(), self.t0))
+        return self.seconds
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+        return False
+
+def start(name, n_voxels=None, patient=None):
+    return Stage(name, n_voxels, patient).start()
+
+def stage(name, n_voxels=None, patient=None):
+    return Stage(name, n_voxels, patient)
+
+def records():
+    """
+    List of the buffered records as dictionaries.
+    """
+    return [dict(zip(fields, r)) for r in _records]
+
+def drain():
+    """
+    Remove and return the buffered records as tuples.
+    """
+    recs = list(_records)
+    _records.clear()
+    return recs
+
+def extend(recs):
+    """
+    Add records of another process, tuples or dictionaries.
+    """
+    for r in recs:
+        if isinstance(r, dict):
+            r = tuple(r[f] for f in fields)
+        _records.append(tuple(r))
+
+def write_json(fname, recs=None):
+    if recs is None:
+        recs = records()
+    with open(fname, 'w') as f:
+        json.dump(recs, f)
+
+def read_json(fname):
+    with open(fname) as f:
+        return json.load(f)
+
+def write(res_dir, prefix='profile'):
+    """
+    Write the records to res_dir/<prefix>.json and res_dir/<prefix>.csv.
+    """
+    recs = records()
+    json_fname = os.path.join(res_dir, prefix + '.json')
+    write_json(json_fname, recs)
+    csv_fname = os.path.join(res_dir, prefix + '.csv')
+    with open(csv_fname, 'wb') as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(recs)
+    return json_fname, csv_fname
+
+def summary(recs=None, top=None):
+    """
+    Table of the stages by total wall time: number of calls, total and mean
+    wall time, CPU time over wall time, voxels per second, the largest growth
+    of the resident memory during a call and the peak resident memory of the
+    process by the end of a call. Stages nested in others (e.g.
+    remove_small_components in post_process) are counted in both.
+    """
+    if recs is None:
+        recs = records()
+    stages = collections.OrderedDict()
+    for r in recs:
+        s = stages.setdefault(r['stage'], {'calls': 0, 'wall': 0.0,
+                                           'cpu': 0.0, 'voxels': 0,
+                                           'voxel_wall': 0.0, 'growth': 0.0,
+                                           'peak': 0.0})
+        s['calls'] += 1
+        s['wall'] += r['wall']
+        s['cpu'] += r['cpu']
+        if r['n_voxels'] is not None:
+            s['voxels'] += r['n_voxels']
+            s['voxel_wall'] += r['wall']
+        if r['rss_start_mb'] is not None and r['rss_stop_mb'] is not None:
+            s['growth'] = max(s['growth'],
+                              r['rss_stop_mb'] - r['rss_start_mb'])
+        s['peak'] = max(s['peak'], r['process_peak_rss_mb'])
+    order = sorted(stages, key=lambda name: -stages[name]['wall'])
+    if top is not None:
+        order = order[:top]
+    total = sum(s['wall'] for s in stages.values())
+    out = "\nStage\t\t\tCalls\tTotal (s)\t%\tMean (s)\tCPU/wall\tVoxels/s\tRSS growth (MB)\tProcess peak RSS (MB)\n"
+    for name in order:
+        s = stages[name]
+        vps = s['voxels'] / s['voxel_wall'] if s['voxel_wall'] > 0 else 0
+        out += "%-24s%d\t%.2f\t\t%.1f\t%.3f\t\t%.2f\t\t%.0f\t\t%.0f\t\t%.0f\n" % \
+                (name, s['calls'], s['wall'], 100 * s['wall'] / max(total, 1e-9),
+                 s['wall'] / s['calls'], s['cpu'] / max(s['wall'], 1e-9), vps,
+                 s['growth'], s['peak'])
+    return out
@@ -0,0 +1,144 @@
+"""
+Training of random forests from samples streamed out of the feature cache.
+
+The forest is grown in chunks of trees with warm_start. Every chunk is fit on
+a fresh sample of voxels drawn uniformly (per class) from all voxels of all
+training patients and gathered from the memory-mapped feature cache, so only
+the sampled rows are read. The size of a sample is set by a memory budget
+instead of by n_voxels x n_patients, and over the chunks every voxel can
+contribute to the forest.
+"""
+import time
+
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+
+import data_processing as dp
+import feature_cache as fc
+
+def _open(pat, resolution, load_hog):
+    if fc.is_stale(pat, resolution, load_hog):
+        dp.cache_patient(pat, resolution=resolution, load_hog=load_hog)
+    return fc.open_patient(pat, resolution, load_hog)
+
+def label_counts(pats, resolution=1, load_hog=False):
+    """
+    (n_patients, 5) number of voxels of each label in every patient.
+    """
+    counts = np.zeros((len(pats), 5), dtype=np.int64)
+    for i, pat in enumerate(pats):
+        y = _open(pat, resolution, load_hog)[1]
+        counts[i] = np.bincount(y, minlength=5)[:5]
+    return counts
+
+def rows_for_budget(memory_budget, n_features, n_jobs=1):
+    """
+    Number of sampled voxels that fit in memory_budget bytes: the float32
+    features, label and weight of a voxel, plus the bootstrap weights of the
+    trees being fit in parallel.
+    """
+    bytes_per_row = 4*n_features + 1 + 8 + 8*max(n_jobs, 1)
+    return int(memory_budget // bytes_per_row)
+
+def sample_voxels(pats, counts, n_rows, labels, stratified=False,
+                  resolution=1, load_hog=False):
+    """
+    Draw about n_rows voxels with the given labels from all patients.
+
+    Without stratification every voxel of the labels is equally likely. With
+    stratification the sample has the class ratios of load_patient (four
+    times as many background voxels as voxels of each tumor class). Every
+    label present in the patients gets at least one voxel, so that all
+    samples have the same classes. The rows are drawn with replacement and
+    duplicates dropped, so the sample can be slightly smaller than n_rows.
+
+    Output:
+        x -- (n, n_features) float32 features.
+        y -- (n,) int8 labels.
+    """
+    avail = counts[:,labels].sum(axis=0)
+    if stratified:
+        ratios = np.array([4. if l == 0 else 1. for l in labels])
+        quotas = np.minimum(n_rows * ratios / ratios.sum(), avail)
+    else:
+        quotas = n_rows * avail / float(max(avail.sum(), 1))
+    quotas = np.maximum(quotas.astype(np.int64), np.minimum(avail, 1))
+
+    # Rows of each label, numbered over all patients
+    picks = [[] for pat in pats]
+    for li, l in enumerate(labels):
+        if quotas[li] == 0:
+            continue
+        idxs = np.unique(np.random.randint(0, avail[li], quotas[li]))
+        offsets = np.r_[0, np.cumsum(counts[:,l])]
+        pat_of = np.searchsorted(offsets, idxs, side='right') - 1
+        for pi in np.unique(pat_of):
+            picks[pi].append((l, idxs[pat_of == pi] - offsets[pi]))
+
+    xs = []
+    ys = []
+    for pi, pat in enumerate(pats):
+        if len(picks[pi]) == 0:
+            continue
+        x, y, coord, meta = _open(pat, resolution, load_hog)
+        y = np.asarray(y)
+        rows = np.sort(np.concatenate([np.nonzero(y == l)[0][local]
+                                       for l, local in picks[pi]]))
+        # Sorted rows so that the memmap is read front to back
+        xs.append(np.asarray(x[rows,:]))
+        ys.append(y[rows])
+    return np.concatenate(xs), np.concatenate(ys)
+
+def train_forest(pats, labels, n_trees=30, trees_per_chunk=5,
+                 memory_budget=2 * 1024**3, stratified=False, binary=False,
+                 resolution=1, load_hog=False, n_jobs=16):
+    """
+    Grow a RandomForestClassifier in chunks of trees_per_chunk trees, each
+    chunk fit on a new sample of the voxels with the given labels.
+
+    Input:
+        labels -- Labels to sample, e.g. range(5) for the first stage and
+                  range(1,5) for the second.
+        binary -- Train tumor (label > 0) against background.
+        memory_budget -- Bytes of one sample, see rows_for_budget.
+    """
+    t0 = time.time()
+    counts = label_counts(pats, resolution, load_hog)
+    n_features = _open(pats[0], resolution, load_hog)[3]['n_features']
+    n_rows = rows_for_budget(memory_budget, n_features, n_jobs)
+    print "Streaming %d trees, %d voxels per %d trees." % \
+            (n_trees, n_rows, trees_per_chunk)
+
+    # Classes of every sample, see sample_voxels
+    present = np.array([l for l in labels if counts[:,l].sum() > 0])
+    classes = np.unique((present > 0).astype(np.int8)) if binary else present
+
+    if stratified:
+        # Weights from the class frequencies of the whole dataset, as in
+        # predict_two_stage
+        total = counts.sum(axis=0)
+        if binary:
+            groups = [[0], [1,2,3,4]]
+        else:
+            groups = [[l] for l in classes]
+        class_freqs = np.array([total[g].sum() for g in groups], dtype=float)
+        class_freqs /= class_freqs.sum()
+
+    model = RandomForestClassifier(0, warm_start=True, verbose=1,
+                                   n_jobs=n_jobs)
+    while model.n_estimators < n_trees:
+        x, y = sample_voxels(pats, counts, n_rows, labels, stratified,
+                             resolution, load_hog)
+        if binary:
+            y = (y > 0).astype(np.int8)
+        weights = None
+        if stratified:
+            sample_freqs = np.array([np.mean(y == c) for c in classes])
+            weights = (class_freqs / sample_freqs)[np.searchsorted(classes, y)]
+        model.n_estimators = min(model.n_estimators + trees_per_chunk, n_trees)
+        model.fit(x, y, sample_weight=weights)
+        print "Fit %d/%d trees on %d voxels." % (model.n_estimators, n_trees,
+                                                len(y))
+        del x, y, weights
+    print "Streaming training took %.2f seconds" % (time.time()-t0)
+    return model
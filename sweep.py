@@ -0,0 +1,135 @@
+"""
+Streaming evaluation of hyperparameter candidates over patients.
+
+Only the per-patient confusion matrices of every candidate are kept, so the
+predictions of a patient can be discarded right after they are scored.
+Candidates that are clearly dominated after the first patients can be
+dropped so that they are not computed for the remaining patients.
+"""
+import numpy as np
+
+from evaluation import confusion_matrices, region_scores, n_labels
+
+class CandidateSweep(object):
+    """
+    Running per-patient confusion matrices of a set of candidates.
+
+    Input:
+        candidates -- List of the candidate values (used for reporting only).
+        prune_after -- Drop dominated candidates once this many patients have
+                       been added, None to keep all candidates.
+        margin -- A candidate is dominated if its mean dice of every region
+                  is more than margin below that of the best candidate.
+    """
+    def __init__(self, candidates, prune_after=None, margin=0.05,
+                 n_labels=n_labels):
+        self.candidates = list(candidates)
+        self.prune_after = prune_after
+        self.margin = margin
+        self.n_labels = n_labels
+        self.active = np.ones(len(self.candidates), dtype=bool)
+        # (n_candidates, n_labels, n_labels) per patient
+        self._cms = []
+        # Which candidates were scored on each patient
+        self._seen = []
+
+    def active_idxs(self):
+        return np.nonzero(self.active)[0]
+
+    def n_patients(self):
+        return len(self._cms)
+
+    def add_patient(self, y, preds, idxs=None):
+        """
+        Score the predictions of one patient.
+
+        Input:
+            preds -- (n_voxels, len(idxs)) predictions, or (n_voxels,) for a
+                     single candidate.
+            idxs -- Candidates of the columns of preds, the active ones by
+                    default.
+
+        Output:
+            (len(idxs), n_labels, n_labels) confusion matrices of the patient.
+        """
+        if idxs is None:
+            idxs = self.active_idxs()
+        preds = np.asarray(preds)
+        if preds.ndim == 1:
+            preds = preds[:,np.newaxis]
+        assert preds.shape[1] == len(idxs), \
+                "Got %d predictions for %d candidates" % (preds.shape[1], len(idxs))
+        cms = confusion_matrices(y, preds, n_labels=self.n_labels)[0]
+        self.add_patient_cms(cms, idxs)
+        return cms
+
+    def add_patient_cms(self, cms, idxs=None):
+        """
+        Add the (len(idxs), n_labels, n_labels) confusion matrices of one
+        patient computed elsewhere.
+        """
+        if idxs is None:
+            idxs = self.active_idxs()
+        full = np.zeros((len(self.candidates), self.n_labels, self.n_labels),
+                        dtype=np.int64)
+        full[idxs] = cms
+        seen = np.zeros(len(self.candidates), dtype=bool)
+        seen[idxs] = True
+        self._cms.append(full)
+        self._seen.append(seen)
+        if self.prune_after is not None and \
+                self.n_patients() >= self.prune_after:
+            self._prune()
+
+    def patient_cms(self, i):
+        """
+        Confusion matrices of candidate i on the patients it was scored on.
+        """
+        return np.asarray([cms[i] for cms, seen in zip(self._cms, self._seen)
+                           if seen[i]]).reshape(-1, self.n_labels, self.n_labels)
+
+    def mean_dice(self):
+        """
+        (n_candidates, n_regions) mean dice over the patients each candidate
+        was scored on.
+        """
+        ds = np.zeros((len(self.candidates), 3))
+        for i in range(len(self.candidates)):
+            cms = self.patient_cms(i)
+            if len(cms) > 0:
+                ds[i] = region_scores(cms)['dice'].mean(axis=0)
+        return ds
+
+    def best(self):
+        """
+        Index of the active candidate with the highest sum of mean dice
+        scores, the first one in case of ties.
+        """
+        scores = self.mean_dice().sum(axis=1)
+        scores[~self.active] = -np.inf
+        return int(np.argmax(scores))
+
+    def keep_best(self, n):
+        """
+        Drop all but the n active candidates with the highest sum of mean
+        dice scores.
+        """
+        idxs = self.active_idxs()
+        if len(idxs) <= n:
+            return
+        scores = self.mean_dice().sum(axis=1)[idxs]
+        # Stable so that ties keep the first candidates
+        order = np.argsort(-scores, kind='mergesort')
+        self.active[idxs[order[n:]]] = False
+
+    def _prune(self):
+        idxs = self.active_idxs()
+        if len(idxs) < 2:
+            return
+        ds = self.mean_dice()
+        best = self.best()
+        dominated = np.all(ds[idxs] < ds[best] - self.margin, axis=1)
+        for i in idxs[dominated]:
+            print "Dropping candidate %s after %d patients." % \
+                    (self.candidates[i], self.n_patients())
+            self.active[i] = False
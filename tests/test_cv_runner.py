@@ -0,0 +1,53 @@
+"""
+A failing fold is reported instead of discarding the other folds.
+
+Run from the repository root with:
+    python -m unittest discover tests
+"""
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')
+import json
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import cv_runner
+
+def _fake_predict_two_stage(train_pats, test_pats, fscores=None,
+                            model_tag='', seed=None, **kwargs):
+    if model_tag == '_fold1':
+        raise RuntimeError('Injected failure')
+    fscores.write("Fold with test patients %s\n" % test_pats)
+    return {'dice_no_pp': [0.5, 0.4, 0.3], 'dice': [0.6, 0.5, 0.4]}
+
+class SerialFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.res_dir = tempfile.mkdtemp()
+        self.orig_predict = cv_runner.methods.predict_two_stage
+        self.orig_convert = cv_runner.dp.convert_patients
+        cv_runner.methods.predict_two_stage = _fake_predict_two_stage
+        cv_runner.dp.convert_patients = lambda *args, **kwargs: None
+
+    def tearDown(self):
+        cv_runner.methods.predict_two_stage = self.orig_predict
+        cv_runner.dp.convert_patients = self.orig_convert
+        shutil.rmtree(self.res_dir)
+
+    def test_failed_fold_is_reported(self):
+        folds = [([1, 2], [3]), ([1, 3], [2]), ([2, 3], [1])]
+        fscores = StringIO.StringIO()
+        results = cv_runner.run_cv(folds, self.res_dir, 1, fscores=fscores,
+                                   n_fold_workers=1)
+        self.assertEqual([r['fold'] for r in results], [0, 2])
+        with open(os.path.join(self.res_dir, 'cv_results.json')) as f:
+            summary = json.load(f)
+        self.assertEqual(summary['failed_folds'], [1])
+        self.assertEqual(len(summary['folds']), 2)
+        log = fscores.getvalue()
+        self.assertIn('Injected failure', log)
+        self.assertIn('Fold 1 failed.', log)
+        self.assertIn('1 of 3 folds failed', log)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+Models saved by predict_two_stage are only reused for the same training mode.
+
+Run from the repository root with:
+    python -m unittest discover tests
+"""
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')
+import shutil
+import tempfile
+import unittest
+
+from sklearn.externals import joblib
+
+import methods
+
+class _Stop(Exception):
+    pass
+
+class ModelNamesTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+        os.makedirs('models')
+        self.trained = []
+        self.orig_train = methods.train_two_stage_models
+        self.orig_register = methods.prob_cache.register_model
+        methods.train_two_stage_models = self._train
+        # Stop once the models are loaded or trained
+        methods.prob_cache.register_model = self._stop
+
+    def tearDown(self):
+        methods.train_two_stage_models = self.orig_train
+        methods.prob_cache.register_model = self.orig_register
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def _train(self, train_pats, stratified, n_trees, n_voxels,
+               resolution=1, load_hog=False, model1_fname=None,
+               model2_fname=None, memory_budget=None, trees_per_chunk=5,
+               n_bins=None):
+        models = [{'memory_budget': memory_budget, 'n_bins': n_bins}] * 2
+        for model, fname in zip(models, [model1_fname, model2_fname]):
+            joblib.dump(model, fname)
+        self.trained.append((memory_budget, n_bins))
+        return models
+
+    def _stop(self, *args, **kwargs):
+        raise _Stop()
+
+    def _run(self, **kwargs):
+        with self.assertRaises(_Stop):
+            methods.predict_two_stage([1, 2], [3], packed_forest=False,
+                                      fresh_models=False, **kwargs)
+
+    def test_training_mode_retrains(self):
+        self._run()
+        self._run()
+        self.assertEqual(self.trained, [(None, None)])
+        self._run(n_bins=8)
+        self._run(n_bins=8)
+        self._run(n_bins=16)
+        self.assertEqual(self.trained, [(None, None), (None, 8), (None, 16)])
+        self._run(memory_budget=10**6)
+        self._run(memory_budget=10**6)
+        self._run()
+        self.assertEqual(self.trained, [(None, None), (None, 8), (None, 16),
+                                        (10**6, None)])
+
+if __name__ == '__main__':
+    unittest.main()
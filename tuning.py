@@ -0,0 +1,217 @@
+"""
+Joint tuning of the first-stage threshold, the closing radius and the MRF
+potential of the two-stage method.
+
+The probabilities of both forests are computed once per dev patient and
+cached: the first-stage tumor probabilities of all voxels and the
+second-stage class probabilities of the voxels that any (threshold, radius)
+candidate labels as tumor. Every combination of threshold x radius x
+potential is then scored from the cached arrays in parallel worker
+processes, either on the full grid or with successive halving, which drops
+the worse half of the candidates after each rung of dev patients.
+"""
+import multiprocessing
+import time
+
+import numpy as np
+
+import data_processing as dp
+import graph
+import prob_cache
+from evaluation import confusion_matrix, dice_scores
+from sweep import CandidateSweep
+
+# Cached arrays of the dev patients, inherited by the forked workers
+_dev_cache = []
+
+def stage1_prediction(probs, threshold, min_voxels=3000):
+    """
+    Threshold the first-stage tumor probabilities. If the predicted tumor is
+    too small the min_voxels most probable voxels are set to tumor instead.
+    """
+    pred = probs >= threshold
+    n_tumor = np.count_nonzero(pred)
+    if n_tumor < min_voxels:
+        print "Patient having too few voxels (%d < %d)" % (n_tumor, min_voxels)
+        pred = np.zeros(pred.shape, dtype=bool)
+        pred[np.argsort(probs)[-min_voxels:]] = True
+    return pred
+
+def _stage1_masks(args):
+    coord, dim, probs, threshold, radii, min_voxels = args
+    pred = stage1_prediction(probs, threshold, min_voxels)
+    masks = dp.post_process_multi_radii(coord, dim, pred, radii,
+                                        remove_components=True,
+                                        binary_closing=True) > 0
+    # (n_radii, n_voxels/8) bits
+    return np.packbits(masks.T, axis=1)
+
+def _evaluate(args):
+    pi, ti, pairs, radii, potentials = args
+    c = _dev_cache[pi]
+    n = len(c['y'])
+    coord = c['coord']
+    cms = []
+    # Previous MRF solution of each radius, to warm start the next potential
+    smoothed = {}
+    for ri, ki in pairs:
+        tumor_idxs = np.unpackbits(c['masks'][ti][ri])[:n].astype(bool)
+        probs2 = c['probs2'][c['rows2'][tumor_idxs]]
+        pred2 = np.argmax(probs2, axis=1) + 1
+        pp_pred = np.zeros(n, dtype=np.int8)
+        if len(pred2) > 0:
+            if potentials[ki] is None:
+                pp_pred[tumor_idxs] = dp.post_process(
+                        coord[tumor_idxs,:], c['dim'], pred2,
+                        remove_components=False, radius=radii[ri])
+            else:
+                edges, adj = graph.tumor_graph(c['patient'], coord, tumor_idxs)
+                smoothed[ri] = dp.mrf(probs2, edges, potential=potentials[ki],
+                                      adj=adj, coord=coord[tumor_idxs],
+                                      init=smoothed.get(ri))
+                pp_pred[tumor_idxs] = smoothed[ri] + 1
+        cms.append(confusion_matrix(c['y'], pp_pred))
+    return pi, ti, pairs, np.asarray(cms)
+
+def cache_dev_patients(dev_pats, model1, model2, ths, radii, min_voxels=3000,
+                       resolution=1, load_hog=False, pool=None):
+    """
+    Compute the first-stage masks of every (threshold, radius) candidate and
+    the probabilities of both models once per dev patient.
+
+    Output:
+        List of dictionaries with the patient number, y, coord, dim, the
+        packed masks per threshold, probs2 (the second-stage probabilities
+        on the union of the masks) and rows2 (the row of probs2 of every
+        voxel).
+    """
+    cache = []
+    for pat, (x, y, coord, dim) in dp.iter_patients(
+            dev_pats, n_voxels=None, resolution=resolution, load_hog=load_hog):
+        t0 = time.time()
+        probs = prob_cache.predict_proba(model1, x, pat, resolution=resolution,
+                                         load_hog=load_hog)[:,1]
+        probs = probs.astype(np.float32)
+        tasks = [(coord, dim, probs, th, radii, min_voxels) for th in ths]
+        if pool is not None:
+            masks = pool.map(_stage1_masks, tasks)
+        else:
+            masks = map(_stage1_masks, tasks)
+        union = np.unpackbits(np.bitwise_or.reduce(
+                np.vstack(masks), axis=0))[:len(y)].astype(bool)
+        rows2 = np.cumsum(union) - 1
+        probs2 = prob_cache.predict_proba(model2, x, pat, rows=union,
+                                          resolution=resolution,
+                                          load_hog=load_hog)
+        probs2 = probs2.astype(np.float32)
+        cache.append({'patient': pat, 'y': np.asarray(y, dtype=np.int8),
+                      'coord': coord, 'dim': dim, 'masks': masks,
+                      'probs2': probs2, 'rows2': rows2})
+        print "Cached dev patient %d (%d/%d tumor candidate voxels) in %.2f seconds." % \
+                (pat, np.count_nonzero(union), len(y), time.time()-t0)
+    return cache
+
+def tune_two_stage(dev_pats, model1, model2, ths, radii, potentials,
+                   min_voxels=3000, resolution=1, load_hog=False, n_workers=1,
+                   halving=False, eta=2, min_patients=2, fscores=None):
+    """
+    Select the threshold, closing radius and MRF potential jointly.
+
+    Input:
+        potentials -- Candidate MRF potentials, [None] to smooth the second
+                      stage by closing instead of MRF.
+        n_workers -- Number of processes scoring the candidates.
+        halving -- If True, the candidates are first scored on min_patients
+                   dev patients, after which only the best 1/eta of them are
+                   scored on eta times as many patients, and so on.
+                   Otherwise every candidate is scored on every patient.
+
+    Output:
+        best_th, best_radius, best_potential
+    """
+    global _dev_cache
+    t0 = time.time()
+    n_r = len(radii)
+    n_k = len(potentials)
+    candidates = [(th, r, ki) for th in ths for r in radii
+                  for ki in range(n_k)]
+    sweep = CandidateSweep(candidates)
+
+    pool = multiprocessing.Pool(n_workers) if n_workers > 1 else None
+    try:
+        _dev_cache = cache_dev_patients(dev_pats, model1, model2, ths, radii,
+                                        min_voxels, resolution, load_hog, pool)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    print "Caching the dev patients took %.2f seconds." % (time.time()-t0)
+
+    n_pats = len(_dev_cache)
+    if halving:
+        rungs = []
+        n = min(min_patients, n_pats)
+        while True:
+            rungs.append(n)
+            if n >= n_pats:
+                break
+            n = min(n * eta, n_pats)
+    else:
+        rungs = [n_pats]
+
+    # Fork the workers only now so that they inherit the cache
+    pool = multiprocessing.Pool(n_workers) if n_workers > 1 else None
+    try:
+        start = 0
+        for end in rungs:
+            t1 = time.time()
+            active = sweep.active_idxs()
+            print "Scoring %d candidates on dev patients %d-%d." % \
+                    (len(active), start+1, end)
+            # One task per patient and threshold
+            tasks = []
+            for pi in range(start, end):
+                for ti in range(len(ths)):
+                    pairs = [((i // n_k) % n_r, i % n_k) for i in active
+                             if i // (n_r * n_k) == ti]
+                    if len(pairs) > 0:
+                        tasks.append((pi, ti, pairs, radii, potentials))
+            if pool is not None:
+                results = pool.imap_unordered(_evaluate, tasks)
+            else:
+                results = (_evaluate(task) for task in tasks)
+            patient_cms = [dict() for pi in range(start, end)]
+            for pi, ti, pairs, cms in results:
+                for (ri, ki), cm in zip(pairs, cms):
+                    patient_cms[pi-start][(ti*n_r + ri)*n_k + ki] = cm
+            for cms in patient_cms:
+                sweep.add_patient_cms(np.asarray([cms[i] for i in active]),
+                                      active)
+            print "Rung took %.2f seconds." % (time.time()-t1)
+            if end < n_pats:
+                sweep.keep_best(max(1, int(np.ceil(len(active) / float(eta)))))
+            start = end
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        _dev_cache = []
+
+    ds = sweep.mean_dice()
+    scores = ds.sum(axis=1)
+    scores[~sweep.active] = -np.inf
+    print "\nBest candidates (mean dice over dev patients):"
+    print "th\tr\tpot\tWhole\tCore\tActive"
+    for i in np.argsort(-scores, kind='mergesort')[:10]:
+        if np.isinf(scores[i]):
+            break
+        th, r, ki = candidates[i]
+        print "%.2f\t%d\t%d\t%.4f\t%.4f\t%.4f" % (th, r, ki, ds[i,0], ds[i,1],
+                                                 ds[i,2])
+    best = sweep.best()
+    best_th, best_radius, best_k = candidates[best]
+    dice_scores(None, None, fscores=fscores, cms=sweep.patient_cms(best),
+                label='Overall dice scores (dev, th=%.2f, r=%d, potential %d):' %
+                (best_th, best_radius, best_k))
+    print "Joint tuning took %.2f seconds." % (time.time()-t0)
+    return best_th, best_radius, potentials[best_k]
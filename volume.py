@@ -0,0 +1,125 @@
+"""
+Scatter/gather between per-voxel arrays and dense 3D patient volumes.
+"""
+import weakref
+
+import numpy as np
+
+class PatientVolume(object):
+    """
+    Dense volume of a patient cropped to the bounding box of its voxel
+    coordinates plus a margin (clipped to the full dim). Volumes are filled
+    and read with a single fancy-indexing operation on the cached flat
+    indices of the voxels.
+
+    The margin must be at least the radius of the largest structuring element
+    applied to the volume (radius + 1 for binary closing), so that cropping
+    does not change the result at the voxels of the patient.
+    """
+    def __init__(self, coord, dim, margin=0):
+        self.full_shape = tuple(int(d) for d in dim[:3])
+        coord = np.asarray(coord, dtype=np.intp)
+        if coord.shape[0] > 0:
+            lo = np.maximum(coord.min(axis=0) - margin, 0)
+            hi = np.minimum(coord.max(axis=0) + margin + 1, self.full_shape)
+        else:
+            lo = np.zeros(3, dtype=np.intp)
+            hi = lo
+        self.margin = margin
+        self.origin = lo
+        self.shape = tuple(int(d) for d in hi - lo)
+        self.box = tuple(slice(int(a), int(b)) for a, b in zip(lo, hi))
+        local = coord - lo
+        self.flat_idxs = np.ravel_multi_index(
+                (local[:,0], local[:,1], local[:,2]), self.shape)
+        self.n_voxels = len(self.flat_idxs)
+        self._buffers = {}
+
+    def empty(self, dtype=np.int8, fill=-1, reuse=False):
+        """
+        Return a cropped volume filled with the given value. With reuse=True
+        the same preallocated buffer is returned on every call (per dtype) so
+        the previous contents are overwritten.
+        """
+        dtype = np.dtype(dtype)
+        if reuse:
+            D = self._buffers.get(dtype)
+            if D is None:
+                D = np.empty(self.shape, dtype=dtype)
+                self._buffers[dtype] = D
+        else:
+            D = np.empty(self.shape, dtype=dtype)
+        D.fill(fill)
+        return D
+
+    def scatter(self, values, dtype=np.int8, fill=-1, reuse=False, out=None):
+        """
+        Write values[i] to the position of voxel i. The rest of the volume is
+        set to fill.
+        """
+        assert len(values) == self.n_voxels, \
+                "Number of values must match to the number of coordinates (%d != %d)" % (len(values), self.n_voxels)
+        if out is None:
+            out = self.empty(dtype, fill, reuse)
+        else:
+            out.fill(fill)
+        out.reshape(-1)[self.flat_idxs] = values
+        return out
+
+    def gather(self, D, dtype=None):
+        """
+        Read the value of each voxel from cropped volume D.
+        """
+        values = np.ascontiguousarray(D).reshape(-1)[self.flat_idxs]
+        if dtype is not None:
+            values = values.astype(dtype)
+        return values
+
+    def to_full(self, D, fill=-1):
+        """
+        Embed cropped volume D into a volume of the full patient dim.
+        """
+        full = np.empty(self.full_shape, dtype=D.dtype)
+        full.fill(fill)
+        full[self.box] = D
+        return full
+
+    def full_slice(self, D, z, fill=-1):
+        """
+        Return the axial slice z of cropped volume D in full patient
+        coordinates.
+        """
+        S = np.empty(self.full_shape[:2], dtype=D.dtype)
+        S.fill(fill)
+        zl = z - self.origin[2]
+        if 0 <= zl < self.shape[2]:
+            S[self.box[:2]] = D[:, :, zl]
+        return S
+
+# Volumes of the most recently used patients, keyed by the coordinate array
+_volume_cache = {}
+_max_cached = 4
+
+def patient_volume(coord, dim, margin=0):
+    """
+    Return the (cached) PatientVolume of a patient. The cache is keyed by the
+    coordinate array object, so repeated post-processing of the same patient
+    reuses the flat indices and volume buffers.
+    """
+    key = (id(coord), tuple(int(d) for d in dim[:3]), margin)
+    entry = _volume_cache.get(key)
+    if entry is not None and entry[0]() is coord:
+        return entry[1]
+    vol = PatientVolume(coord, dim, margin)
+    try:
+        ref = weakref.ref(coord)
+    except TypeError:
+        # Not weak-referenceable (e.g. a list), do not cache
+        return vol
+    if len(_volume_cache) >= _max_cached:
+        for k in [k for k, e in _volume_cache.items() if e[0]() is None]:
+            del _volume_cache[k]
+        if len(_volume_cache) >= _max_cached:
+            _volume_cache.clear()
+    _volume_cache[key] = (ref, vol)
+    return vol